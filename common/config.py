@@ -295,3 +295,62 @@ def validate_config_for_replay(config):
     if not config["secret_name"]:
         config["secret_name"] = None
         logger.debug("SECRET_NAME property not specified.")
+    if config.get("replay_engine") not in (None, "", "thread", "asyncio"):
+        logger.error(
+            'Config file value for "replay_engine" must be either "thread" or "asyncio". Please '
+            'change the value for "replay_engine" to either "thread" or "asyncio".'
+        )
+        exit(-1)
+    if config.get("job_distribution") not in (None, "", "queue", "partitioned"):
+        logger.error(
+            'Config file value for "job_distribution" must be either "queue" or "partitioned". '
+            'Please change the value for "job_distribution" to either "queue" or "partitioned".'
+        )
+        exit(-1)
+    partition_strategies = (None, "", "round_robin", "bin_pack", "load_balance")
+    if config.get("partition_strategy") not in partition_strategies:
+        logger.error(
+            'Config file value for "partition_strategy" must be one of "round_robin", "bin_pack" '
+            'or "load_balance". Please change the value for "partition_strategy" to one of them.'
+        )
+        exit(-1)
+    if config.get("adaptive_workers") and config.get("job_distribution") == "partitioned":
+        logger.error(
+            'Config file value "adaptive_workers" requires "job_distribution" "queue", since '
+            "workers added during the replay take their connections off the shared job queue. "
+            'Please change the value for "job_distribution" to "queue" or disable '
+            '"adaptive_workers".'
+        )
+        exit(-1)
+    max_workers = config.get("max_workers")
+    if max_workers not in (None, "") and (not str(max_workers).isdigit() or int(max_workers) < 1):
+        logger.error(
+            'Config file value for "max_workers" must be a positive whole number. Please change '
+            'the value for "max_workers" or remove it to allow up to twice as many workers as '
+            "cpus."
+        )
+        exit(-1)
+    amplification_factor = config.get("amplification_factor")
+    if amplification_factor not in (None, "") and (
+        not str(amplification_factor).isdigit() or int(amplification_factor) < 1
+    ):
+        logger.error(
+            'Config file value for "amplification_factor" must be a positive whole number. '
+            'Please change the value for "amplification_factor" or remove it to replay the '
+            "workload once."
+        )
+        exit(-1)
+    for setting in ("replay_speed", "max_idle_gap_sec"):
+        value = config.get(setting)
+        if value is None or value == "":
+            continue
+        try:
+            valid = float(value) > 0
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            logger.error(
+                f'Config file value for "{setting}" must be a positive number. Please change the '
+                f'value for "{setting}" or remove it to replay the workload as recorded.'
+            )
+            exit(-1)
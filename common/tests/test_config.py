@@ -276,6 +276,62 @@ class TestValidateConfigForReplay(unittest.TestCase):
             config_helper.validate_config_for_replay(self.config)
         self.assertEqual(cm.exception.code, -1)
 
+    def test_validate_config_for_replay_replay_engine(self):
+        self.config["replay_engine"] = "asyncio"
+        config_helper.validate_config_for_replay(self.config)
+
+        self.config["replay_engine"] = "greenlet"
+        with self.assertRaises(SystemExit) as cm:
+            config_helper.validate_config_for_replay(self.config)
+        self.assertEqual(cm.exception.code, -1)
+
+    def test_validate_config_for_replay_job_distribution(self):
+        self.config["job_distribution"] = "partitioned"
+        self.config["partition_strategy"] = "bin_pack"
+        config_helper.validate_config_for_replay(self.config)
+        self.config["partition_strategy"] = "load_balance"
+        config_helper.validate_config_for_replay(self.config)
+
+        self.config["partition_strategy"] = "random"
+        with self.assertRaises(SystemExit) as cm:
+            config_helper.validate_config_for_replay(self.config)
+        self.assertEqual(cm.exception.code, -1)
+
+    def test_validate_config_for_replay_replay_speed(self):
+        self.config["replay_speed"] = 10
+        self.config["max_idle_gap_sec"] = None
+        config_helper.validate_config_for_replay(self.config)
+
+        self.config["replay_speed"] = 0
+        with self.assertRaises(SystemExit) as cm:
+            config_helper.validate_config_for_replay(self.config)
+        self.assertEqual(cm.exception.code, -1)
+
+    def test_validate_config_for_replay_amplification_factor(self):
+        self.config["amplification_factor"] = 3
+        config_helper.validate_config_for_replay(self.config)
+
+        self.config["amplification_factor"] = 1.5
+        with self.assertRaises(SystemExit) as cm:
+            config_helper.validate_config_for_replay(self.config)
+        self.assertEqual(cm.exception.code, -1)
+
+    def test_validate_config_for_replay_adaptive_workers(self):
+        self.config["adaptive_workers"] = True
+        self.config["max_workers"] = 16
+        config_helper.validate_config_for_replay(self.config)
+
+        self.config["max_workers"] = 0
+        with self.assertRaises(SystemExit) as cm:
+            config_helper.validate_config_for_replay(self.config)
+        self.assertEqual(cm.exception.code, -1)
+
+        self.config["max_workers"] = None
+        self.config["job_distribution"] = "partitioned"
+        with self.assertRaises(SystemExit) as cm:
+            config_helper.validate_config_for_replay(self.config)
+        self.assertEqual(cm.exception.code, -1)
+
     def test_validate_config_for_replay_nlb_nat(self):
         config_helper.validate_config_for_replay(self.config)
         self.assertEqual(self.config["nlb_nat_dns"], None)
@@ -1,3 +1,4 @@
+import datetime
 import unittest
 from unittest import TestCase
 from unittest.mock import patch, Mock
@@ -112,3 +113,35 @@ class TestBucketDict(unittest.TestCase):
         patched_url_parse.side_effect = [ValueError("Failed")]
         with self.assertRaises(SystemExit):
             common.util.bucket_dict("s3://test-bucket/test-key")
+
+
+class TestTimestamps(unittest.TestCase):
+    def test_parse_timestamp_us(self):
+        self.assertEqual(
+            common.util.parse_timestamp_us("1970-01-01T00:00:01.000002+00:00"), 1_000_002
+        )
+        self.assertEqual(common.util.parse_timestamp_us("1970-01-01 01:00:00+01:00"), 0)
+        self.assertEqual(common.util.parse_timestamp_us("1970-01-01T00:00:01"), 1_000_000)
+        self.assertEqual(
+            common.util.parse_timestamp_us(1_673_279_295_313_000), 1_673_279_295_313_000
+        )
+        self.assertIsNone(common.util.parse_timestamp_us(""))
+        self.assertIsNone(common.util.parse_timestamp_us(None))
+
+    def test_parse_timestamp_us_ignore_offset(self):
+        self.assertEqual(
+            common.util.parse_timestamp_us("1970-01-01 01:00:00+01:00", ignore_offset=True),
+            3_600_000_000,
+        )
+
+    def test_parse_timestamp_us_dateutil_fallback(self):
+        # compact ISO 8601, which datetime.fromisoformat doesn't read before python 3.11
+        self.assertEqual(common.util.parse_timestamp_us("19700101T000001Z"), 1_000_000)
+
+    def test_datetime_round_trip(self):
+        value = datetime.datetime(2023, 1, 9, 15, 48, 15, 313000, tzinfo=datetime.timezone.utc)
+        us = common.util.datetime_to_us(value)
+        self.assertEqual(us, int(value.timestamp()) * 1_000_000 + 313000)
+        self.assertEqual(common.util.us_to_datetime(us), value)
+        self.assertEqual(common.util.datetime_to_us(value.replace(tzinfo=None)), us)
+        self.assertIsNone(common.util.us_to_datetime(None))
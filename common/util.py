@@ -1,9 +1,11 @@
 import re
+import sys
 
 import logging.handlers
 import redshift_connector
 from urllib.parse import urlparse
 import datetime
+import dateutil.parser
 import common.aws_service as aws_service_helper
 
 logger = logging.getLogger("WorkloadReplicatorLogger")
@@ -147,26 +149,169 @@ def bucket_dict(bucket_url):
 def matches_filters(obj, filters):
     """Check if the object matches the filters.  The object just needs to
     provide a supported_filters() function.  This also assumes filters has already
-    been validated"""
-
-    included = 0
-    for field in obj.supported_filters():
-        include = filters["include"][field]
-        exclude = filters["exclude"][field]
-
-        # if include values were passed and its not a wildcard, check against it
-        if "*" in include or getattr(obj, field) in include:
-            included += 1
-        # if include = * and the user is in the exclude list, reject
-        if getattr(obj, field) in exclude:
+    been validated.  The filters are compiled on every call, so to check many objects
+    compile them once with compile_filters and call the predicate instead"""
+    fields = obj.supported_filters()
+    predicate = compile_filters(
+        {
+            "include": {f: filters["include"][f] for f in fields},
+            "exclude": {f: filters["exclude"][f] for f in fields},
+        }
+    )
+    return predicate({field: getattr(obj, field) for field in fields})
+
+
+# prefix of filter values that are regular expressions, e.g. "re:etl_[0-9]+"
+FILTER_REGEX_PREFIX = "re:"
+
+
+class FilterValues:
+    """The values of one include or exclude filter: exact values, prefixes such as
+    "etl_*", and regular expressions such as "re:etl_[0-9]+", which must match the
+    whole value. "*" alone matches everything if wildcard is set, as it is for include
+    filters."""
+
+    __slots__ = ("matches_all", "exact", "prefixes", "pattern")
+
+    def __init__(self, values, wildcard=True):
+        self.matches_all = wildcard and "*" in values
+        self.exact = set()
+        prefixes = []
+        patterns = []
+        for value in values:
+            if isinstance(value, str) and value.startswith(FILTER_REGEX_PREFIX):
+                patterns.append(f"(?:{value[len(FILTER_REGEX_PREFIX):]})")
+            elif isinstance(value, str) and len(value) > 1 and value.endswith("*"):
+                prefixes.append(value[:-1])
+            else:
+                self.exact.add(value)
+        self.prefixes = tuple(prefixes)
+        self.pattern = re.compile("|".join(patterns)) if patterns else None
+
+    def is_empty(self):
+        return not (self.matches_all or self.exact or self.prefixes or self.pattern)
+
+    def is_exact(self):
+        """Whether only exact values were given"""
+        return not (self.matches_all or self.prefixes or self.pattern)
+
+    def matches(self, value):
+        if self.matches_all or value in self.exact:
+            return True
+        if not isinstance(value, str):
             return False
+        if self.prefixes and value.startswith(self.prefixes):
+            return True
+        return self.pattern is not None and self.pattern.fullmatch(value) is not None
 
-        # otherwise include = * and there's no exclude, so continue checking
 
-    if included == len(obj.supported_filters()):
+def compile_filters(filters, field_keys=None):
+    """Compile validated include and exclude filters into a function that checks whether
+    a record matches them. The record is a dict, such as a connection of connections.json
+    or a transaction of SQLs.json.gz before it is parsed. field_keys maps the filter
+    fields to the keys of the record, if they differ."""
+    field_keys = field_keys or {}
+    include_filters = filters.get("include", {}) if filters else {}
+    exclude_filters = filters.get("exclude", {}) if filters else {}
+    checks = []
+    for field in sorted(set(include_filters) | set(exclude_filters)):
+        include = FilterValues(include_filters.get(field, ["*"]))
+        exclude = FilterValues(exclude_filters.get(field, []), wildcard=False)
+        if include.matches_all and exclude.is_empty():
+            continue
+        checks.append((field_keys.get(field, field), include, exclude))
+
+    def predicate(record):
+        for key, include, exclude in checks:
+            value = record[key]
+            if not include.matches(value) or exclude.matches(value):
+                return False
         return True
-    else:
+
+    return predicate
+
+
+def filter_time_window(filters):
+    """Start and end of the start_time and end_time filters, in microseconds since the
+    epoch. Either is None if it isn't set."""
+    if not filters:
+        return None, None
+    window = []
+    for key in ("start_time", "end_time"):
+        value = filters.get(key)
+        # yaml reads unquoted timestamps as datetimes, and unquoted dates as dates
+        if isinstance(value, datetime.datetime):
+            window.append(datetime_to_us(value))
+        elif isinstance(value, datetime.date):
+            window.append(datetime_to_us(datetime.datetime.combine(value, datetime.time())))
+        else:
+            window.append(parse_timestamp_us(value))
+    return tuple(window)
+
+
+def in_time_window(start_us, end_us, window_start_us, window_end_us):
+    """Whether something running from start_us to end_us overlaps the time window. An
+    unknown end is treated as still running."""
+    if window_end_us is not None and start_us is not None and start_us >= window_end_us:
         return False
+    if window_start_us is not None and end_us is not None and end_us < window_start_us:
+        return False
+    return True
+
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def datetime_to_us(value):
+    """Microseconds since the epoch of a datetime, assumed to be UTC if it is naive"""
+    if not value:
+        return None
+    us = (
+        (value.toordinal() - _EPOCH_ORDINAL) * 86400
+        + value.hour * 3600
+        + value.minute * 60
+        + value.second
+    ) * 1_000_000 + value.microsecond
+    offset = value.utcoffset()
+    if offset:
+        us -= offset // _ONE_MICROSECOND
+    return us
+
+
+def us_to_datetime(us):
+    """UTC datetime of a number of microseconds since the epoch"""
+    if us is None:
+        return None
+    return _EPOCH + datetime.timedelta(microseconds=us)
+
+
+def parse_timestamp_us(value, ignore_offset=False):
+    """Microseconds since the epoch of a workload timestamp. Workloads store them as
+    integers; older ones as ISO 8601 strings, which are read with datetime.fromisoformat
+    and only fall back to dateutil for formats it doesn't support. With ignore_offset,
+    the time is read as UTC regardless of its offset."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, int):
+        return value
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        parsed = dateutil.parser.isoparse(value)
+    if ignore_offset:
+        parsed = parsed.replace(tzinfo=None)
+    return datetime_to_us(parsed)
+
+
+def intern_str(value):
+    """Interned copy of a string, so repeated values such as users and databases are
+    stored once. Other values are returned as they are."""
+    if type(value) is str:
+        return sys.intern(value)
+    return value
+
 
 def get_connection_key(database_name, username, pid):
     return f"{database_name}_{username}_{pid}"
@@ -0,0 +1,160 @@
+"""
+memory.py
+====================================
+Peak memory of loading a workload. Writes a synthetic workload in the extract format,
+then reports the peak RSS of a process running the replay prep on it and of a process
+loading the prepared connections the way a worker loads its shard.
+
+    python -m core.benchmark.memory --connections 2000 --queries 50
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import resource
+import shutil
+import sys
+import tempfile
+
+from core.replay.prep import ReplayPrep
+
+all_filters = {
+    "include": {"database_name": ["*"], "username": ["*"], "pid": ["*"]},
+    "exclude": {"database_name": [], "username": [], "pid": []},
+}
+
+
+def write_workload(directory, num_connections, queries_per_connection, queries_per_transaction=5):
+    """Write connections.json and SQLs.json.gz with the given number of connections, each
+    running queries_per_connection queries"""
+    start = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    start_us = (start - epoch) // datetime.timedelta(microseconds=1)
+
+    connections = []
+    transactions = {}
+    xid = 0
+    for idx in range(num_connections):
+        username = f"user_{idx % 50}"
+        database = f"db_{idx % 4}"
+        pid = str(1_000_000 + idx)
+        session_start_us = start_us + idx * 100_000
+        connections.append(
+            {
+                "session_initiation_time": session_start_us,
+                "disconnection_time": session_start_us + 3_600_000_000,
+                "application_name": "",
+                "database_name": database,
+                "username": username,
+                "pid": pid,
+                "time_interval_between_transactions": True,
+                "time_interval_between_queries": "transaction",
+            }
+        )
+        query_us = session_start_us + 1_000_000
+        for first in range(0, queries_per_connection, queries_per_transaction):
+            xid += 1
+            queries = []
+            last = min(first + queries_per_transaction, queries_per_connection)
+            for query_idx in range(first, last):
+                queries.append(
+                    {
+                        "record_time": query_us + 500_000,
+                        "start_time": query_us,
+                        "end_time": query_us + 500_000,
+                        "text": f"select * from sales.orders where id = {query_idx};",
+                    }
+                )
+                query_us += 1_000_000
+            transactions[str(xid)] = {
+                "xid": str(xid),
+                "pid": pid,
+                "db": database,
+                "user": username,
+                "time_interval": True,
+                "queries": queries,
+            }
+
+    with open(os.path.join(directory, "connections.json"), "w") as fp:
+        json.dump(connections, fp)
+    with gzip.open(os.path.join(directory, "SQLs.json.gz"), "wt") as fp:
+        json.dump({"transactions": transactions}, fp)
+    return xid
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss / scale
+
+
+def run_prep(directory, results):
+    config = {
+        "workload_location": directory,
+        "time_interval_between_transactions": "",
+        "time_interval_between_queries": "",
+        "filters": all_filters,
+        "execute_copy_statements": "false",
+        "execute_unload_statements": "false",
+        "replay_output": None,
+        "split_multi": True,
+        "use_workload_store": False,
+    }
+    connection_logs = ReplayPrep(config).correlate_transactions_with_connections("benchmark")[0]
+    results["prep_rss_mb"] = peak_rss_mb()
+    # the connections are written the way partitioned job distribution writes the shards
+    with open(os.path.join(directory, "connections.pkl"), "wb") as fp:
+        pickle.dump(connection_logs, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    results["shard_rss_mb"] = peak_rss_mb()
+
+
+def run_worker(directory, results):
+    with open(os.path.join(directory, "connections.pkl"), "rb") as fp:
+        connection_logs = pickle.load(fp)
+    # touch every query, as the replay of the connections would
+    results["worker_queries"] = sum(
+        len(t.queries) for c in connection_logs for t in c.transactions
+    )
+    results["worker_rss_mb"] = peak_rss_mb()
+
+
+def run_in_process(target, directory, results):
+    process = multiprocessing.get_context("spawn").Process(
+        target=target, args=(directory, results)
+    )
+    process.start()
+    process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory of loading a synthetic workload")
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=50, help="queries per connection")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    try:
+        num_transactions = write_workload(directory, args.connections, args.queries)
+        with multiprocessing.Manager() as manager:
+            results = manager.dict()
+            run_in_process(run_prep, directory, results)
+            run_in_process(run_worker, directory, results)
+            print(
+                f"{args.connections} connections, {num_transactions} transactions, "
+                f"{results['worker_queries']} queries"
+            )
+            print(f"prep peak RSS:   {results['prep_rss_mb']:.1f} MB")
+            print(f"after writing the shard: {results['shard_rss_mb']:.1f} MB")
+            print(f"worker peak RSS: {results['worker_rss_mb']:.1f} MB")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,459 @@
+"""
+replay_engine.py
+====================================
+Overhead of the replay engine itself, without a Redshift cluster. Generates a synthetic
+workload, replaces db_connect with a fake driver whose connects and statements take a
+configurable time, and runs Replayer.start_replay on it end to end. Reports how many
+sessions and statements were dispatched per second, how late statements and connections
+started, and the CPU time and peak RSS of the parent and the workers.
+
+    python -m core.benchmark.replay_engine --sessions 2000 --sessions-per-sec 100 \\
+        --statement-latency lognormal:5:0.5 --set replay_engine=asyncio
+
+Latencies are given as constant:MS, uniform:MIN_MS:MAX_MS, exponential:MEAN_MS or
+lognormal:MEDIAN_MS:SIGMA. Any replay setting can be overridden with --set key=value.
+With --max-p99-lag-ms the benchmark exits with an error if statements start later than
+that, so it can be used to catch regressions of the engine in CI. Runs on platforms that
+can fork, as the fake driver is installed before the workers are started.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from core.benchmark.memory import peak_rss_mb
+from core.replay.connections_parser import ConnectionLog
+from core.replay.stats import (
+    CONNECTION_LATENESS_HISTOGRAM,
+    histogram_percentile,
+)
+from core.replay.transactions_parser import Query, Transaction, compile_query
+
+REPLAY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "replay")
+REPLAY_ID = "benchmark"
+
+DEFAULT_CONFIG = {
+    "num_workers": 2,
+    "target_cluster_endpoint": "benchmark.cluster.us-east-1.redshift.amazonaws.com:5439/dev",
+    "master_username": "awsuser",
+    "default_interface": "psql",
+    "odbc_driver": None,
+    "log_level": "ERROR",
+    "split_multi": True,
+    "execute_copy_statements": "false",
+    "execute_unload_statements": "false",
+    "replay_output": None,
+    "limit_concurrent_connections": None,
+    "empty_queue_timeout_sec": 10,
+    "statement_trace": True,
+}
+
+FAKE_CREDENTIALS = {
+    "host": "benchmark.cluster.us-east-1.redshift.amazonaws.com",
+    "port": 5439,
+    "username": "awsuser",
+    "password": "benchmark",
+    "database": "dev",
+    "odbc_driver": None,
+}
+
+
+class Latency:
+    """Distribution of a simulated latency in milliseconds"""
+
+    def __init__(self, kind, *params, seed=None):
+        self.kind = kind
+        self.params = params
+        self.random = random.Random(seed)
+        samplers = {
+            "constant": lambda ms: ms,
+            "uniform": lambda low_ms, high_ms: self.random.uniform(low_ms, high_ms),
+            "exponential": lambda mean_ms: self.random.expovariate(1 / mean_ms) if mean_ms else 0,
+            "lognormal": lambda median_ms, sigma: self.random.lognormvariate(
+                math.log(median_ms), sigma
+            ),
+        }
+        if kind not in samplers:
+            raise ValueError(
+                f"Unknown latency distribution {kind}, use one of {', '.join(samplers)}"
+            )
+        self.sampler = samplers[kind]
+        try:
+            self.sample_sec()
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid parameters for latency {self}: {e}")
+
+    @classmethod
+    def parse(cls, spec, seed=None):
+        """Latency of a spec like lognormal:5:0.5"""
+        kind, *params = spec.split(":")
+        return cls(kind, *(float(param) for param in params), seed=seed)
+
+    def sample_sec(self):
+        return max(self.sampler(*self.params), 0) / 1000
+
+    def __str__(self):
+        return ":".join([self.kind] + [f"{param:g}" for param in self.params])
+
+
+class FakeCursor:
+    def __init__(self, driver):
+        self.driver = driver
+        self.rowcount = -1
+
+    def execute(self, sql):
+        time.sleep(self.driver.statement_latency.sample_sec())
+        if self.driver.error_rate and self.driver.random.random() < self.driver.error_rate:
+            # shaped like the errors redshift_connector raises
+            raise Exception({"S": "ERROR", "C": "XX000", "M": "simulated error"})
+        self.rowcount = 1
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, driver):
+        self.driver = driver
+        self.autocommit = True
+
+    def cursor(self):
+        return FakeCursor(self.driver)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeDriver:
+    """Stands in for db_connect. Connecting and executing a statement sleep for a sample
+    of their latency, and error_rate of the statements fail."""
+
+    def __init__(self, connect_latency, statement_latency, error_rate=0, seed=None):
+        self.connect_latency = connect_latency
+        self.statement_latency = statement_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def connect(self, *args, **kwargs):
+        time.sleep(self.connect_latency.sample_sec())
+        return FakeConnection(self)
+
+
+def generate_workload(
+    num_sessions,
+    sessions_per_sec,
+    transactions_per_session,
+    statements_per_transaction,
+    statement_interval_ms=10,
+    config=DEFAULT_CONFIG,
+):
+    """Connections of a synthetic workload starting at sessions_per_sec, with their
+    statements statement_interval_ms apart. Returns the connections, the time of the first
+    event and the number of queries."""
+    first_event_time = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    interval = datetime.timedelta(milliseconds=statement_interval_ms)
+    statement_cache = {}
+    connection_logs = []
+    xid = 0
+    for idx in range(num_sessions):
+        username = f"user_{idx % 10}"
+        pid = str(1_000_000 + idx)
+        session_start = first_event_time + datetime.timedelta(seconds=idx / sessions_per_sec)
+        query_time = session_start + interval
+        transactions = []
+        for _ in range(transactions_per_session):
+            xid += 1
+            queries = []
+            for query_idx in range(statements_per_transaction):
+                text = f"select * from sales.orders where id = {query_idx};"
+                query = Query(query_time, query_time + interval / 2, text)
+                query.plan = compile_query(
+                    text, str(xid), query_idx, config, statement_cache=statement_cache
+                )
+                queries.append(query)
+                query_time += interval
+            transactions.append(
+                Transaction(True, "dev", username, pid, str(xid), queries, f"dev_{username}_{pid}")
+            )
+        connection_log = ConnectionLog(
+            session_start,
+            query_time + interval,
+            "dev",
+            username,
+            pid,
+            "",
+            True,
+            "all on",
+            f"dev_{username}_{pid}",
+        )
+        connection_log.transactions = transactions
+        connection_logs.append(connection_log)
+    return connection_logs, first_event_time, xid * statements_per_transaction
+
+
+def cpu_sec(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_replay(options, results):
+    """Replay a synthetic workload on the fake driver. Runs in a process of its own, which
+    forks the workers with the fake driver installed."""
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    # the replayer imports its siblings the way replay.py is run
+    sys.path.insert(0, REPLAY_DIR)
+    multiprocessing.set_start_method("fork", force=True)
+    import core.replay.connection_thread as connection_thread
+    from core.replay.prep import ReplayPrep
+    from replayer import Replayer
+
+    try:
+        config = dict(DEFAULT_CONFIG, **options["config"])
+        driver = FakeDriver(
+            Latency.parse(options["connect_latency"], options["seed"]),
+            Latency.parse(options["statement_latency"], options["seed"]),
+            options["error_rate"],
+            options["seed"],
+        )
+        connection_thread.db_connect = driver.connect
+        ReplayPrep.get_connection_credentials = lambda self, *args, **kwargs: FAKE_CREDENTIALS
+
+        connection_logs, first_event_time, total_queries = generate_workload(
+            options["sessions"],
+            options["sessions_per_sec"],
+            options["transactions"],
+            options["statements"],
+            options["statement_interval_ms"],
+            config,
+        )
+        # leave the workers time to start up before the first session is due
+        replay_start = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(
+            seconds=options["start_delay_sec"]
+        )
+
+        start = time.perf_counter()
+        stats = Replayer(config).start_replay(
+            connection_logs, first_event_time, total_queries, replay_start, REPLAY_ID
+        )
+        results["wall_sec"] = time.perf_counter() - start - options["start_delay_sec"]
+        results["parent_cpu_sec"] = cpu_sec(resource.getrusage(resource.RUSAGE_SELF))
+        results["workers_cpu_sec"] = cpu_sec(resource.getrusage(resource.RUSAGE_CHILDREN))
+        results["parent_rss_mb"] = peak_rss_mb()
+        results["worker_rss_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+
+        results["sessions"] = len(connection_logs)
+        results["queries"] = stats["query_success"] + stats["query_error"]
+        results["query_errors"] = stats["query_error"]
+        results["connection_errors"] = len(stats["connection_error_log"])
+        results["max_connection_lateness_ms"] = max(stats["max_connection_lateness_sec"], 0) * 1000
+        results["connection_lateness_ms"] = {
+            f"p{percentile}": histogram_ms(
+                stats,
+                CONNECTION_LATENESS_HISTOGRAM,
+                percentile,
+                results["max_connection_lateness_ms"],
+            )
+            for percentile in (50, 90, 99)
+        }
+
+        if config.get("statement_trace"):
+            with np.load(f"core/logs/replay_log-{REPLAY_ID}/statement_trace.npz") as trace:
+                results.update(trace_results(trace))
+    finally:
+        os.chdir("/")
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def trace_results(trace):
+    """Statement lateness and dispatch rates of a statement trace. The rates are measured
+    between the first and the last start, which leaves out the start up and shut down of
+    the workers."""
+    lateness_ms = np.maximum(trace["lateness_ns"], 0) / 1e6
+    results = {"statements": len(lateness_ms)}
+    if not len(lateness_ms):
+        return results
+    results["statement_lateness_ms"] = {
+        f"p{percentile}": float(np.percentile(lateness_ms, percentile))
+        for percentile in (50, 90, 99)
+    }
+    results["max_statement_lateness_ms"] = float(lateness_ms.max())
+
+    start_ns = trace["start_ns"]
+    # a session starts with its first statement
+    session_start_ns = np.full(int(trace["job_id"].max()) + 1, np.iinfo(np.int64).max)
+    np.minimum.at(session_start_ns, trace["job_id"], start_ns)
+    session_start_ns = session_start_ns[session_start_ns != np.iinfo(np.int64).max]
+    if len(session_start_ns) > 1:
+        span_sec = (session_start_ns.max() - session_start_ns.min()) / 1e9
+        results["sessions_per_sec"] = (len(session_start_ns) - 1) / span_sec
+    if len(start_ns) > 1:
+        results["statements_per_sec"] = (len(start_ns) - 1) / (
+            (start_ns.max() - start_ns.min()) / 1e9
+        )
+    return results
+
+
+def histogram_ms(stats, histogram, percentile, max_ms):
+    """Bound of a lateness histogram percentile in milliseconds. The maximum is a tighter
+    bound for the percentiles in the last buckets."""
+    bound = histogram_percentile(stats, histogram, percentile)
+    return max_ms if bound is None else min(bound * 1000, max_ms)
+
+
+def run_benchmark(
+    sessions=500,
+    sessions_per_sec=50,
+    transactions=2,
+    statements=5,
+    statement_interval_ms=10,
+    connect_latency="constant:2",
+    statement_latency="lognormal:2:0.5",
+    error_rate=0,
+    start_delay_sec=3,
+    seed=0,
+    config=None,
+):
+    """Run the benchmark in a new process and return its results"""
+    options = {
+        "sessions": sessions,
+        "sessions_per_sec": sessions_per_sec,
+        "transactions": transactions,
+        "statements": statements,
+        "statement_interval_ms": statement_interval_ms,
+        "connect_latency": connect_latency,
+        "statement_latency": statement_latency,
+        "error_rate": error_rate,
+        "start_delay_sec": start_delay_sec,
+        "seed": seed,
+        "config": config or {},
+    }
+    # fail on a bad latency before anything is started
+    Latency.parse(connect_latency)
+    Latency.parse(statement_latency)
+
+    context = multiprocessing.get_context("fork")
+    with context.Manager() as manager:
+        results = manager.dict()
+        process = context.Process(target=run_replay, args=(options, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Benchmark process exited with {process.exitcode}")
+        results = dict(results)
+
+    statements_executed = results.get("statements", results["queries"])
+    results["offered_sessions_per_sec"] = sessions_per_sec
+    # without a statement trace, the rates include the start up and shut down of the workers
+    results.setdefault("sessions_per_sec", results["sessions"] / results["wall_sec"])
+    results.setdefault("statements_per_sec", statements_executed / results["wall_sec"])
+    results["worker_cpu_us_per_statement"] = (
+        results["workers_cpu_sec"] / statements_executed * 1e6 if statements_executed else 0
+    )
+    return results
+
+
+def format_results(results):
+    def lateness(percentiles, max_ms):
+        text = ", ".join(f"{name} {value:.1f} ms" for name, value in percentiles.items())
+        return f"{text}, max {max_ms:.1f} ms"
+
+    lines = [
+        f"{results['sessions']} sessions, {results['queries']} queries in "
+        f"{results['wall_sec']:.1f} sec ({results['query_errors']} failed queries, "
+        f"{results['connection_errors']} failed connections)",
+        f"dispatch throughput: {results['sessions_per_sec']:.1f} sessions/sec (offered "
+        f"{results['offered_sessions_per_sec']:g}), {results['statements_per_sec']:.1f} "
+        "statements/sec",
+        "connection lateness: "
+        + lateness(results["connection_lateness_ms"], results["max_connection_lateness_ms"]),
+    ]
+    if "statement_lateness_ms" in results:
+        lines.append(
+            "statement lateness:  "
+            + lateness(results["statement_lateness_ms"], results["max_statement_lateness_ms"])
+        )
+    lines += [
+        f"cpu: parent {results['parent_cpu_sec']:.2f} sec, workers "
+        f"{results['workers_cpu_sec']:.2f} sec "
+        f"({results['worker_cpu_us_per_statement']:.0f} us per statement)",
+        f"peak RSS: parent {results['parent_rss_mb']:.1f} MB, largest worker "
+        f"{results['worker_rss_mb']:.1f} MB",
+    ]
+    return "\n".join(lines)
+
+
+def parse_setting(text):
+    key, _, value = text.partition("=")
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Overhead of the replay engine on a fake driver")
+    parser.add_argument("--sessions", type=int, default=500)
+    parser.add_argument("--sessions-per-sec", type=float, default=50)
+    parser.add_argument("--transactions", type=int, default=2, help="transactions per session")
+    parser.add_argument("--statements", type=int, default=5, help="statements per transaction")
+    parser.add_argument("--statement-interval-ms", type=float, default=10)
+    parser.add_argument("--connect-latency", default="constant:2")
+    parser.add_argument("--statement-latency", default="lognormal:2:0.5")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--set", action="append", default=[], type=parse_setting, metavar="KEY=VALUE"
+    )
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    parser.add_argument(
+        "--max-p99-lag-ms", type=float, help="fail if the p99 statement lateness is higher"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = run_benchmark(
+        args.sessions,
+        args.sessions_per_sec,
+        args.transactions,
+        args.statements,
+        args.statement_interval_ms,
+        args.connect_latency,
+        args.statement_latency,
+        args.error_rate,
+        seed=args.seed,
+        config=dict([("num_workers", args.workers)] + args.set),
+    )
+    print(json.dumps(results, indent=2) if args.json else format_results(results))
+
+    if args.max_p99_lag_ms is not None:
+        p99 = results.get("statement_lateness_ms", {}).get("p99")
+        if p99 is None or p99 > args.max_p99_lag_ms:
+            print(
+                f"p99 statement lateness {p99} ms exceeds {args.max_p99_lag_ms:g} ms",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import datetime
 import logging
 import re
+from sys import intern
 import dateutil.parser
 from core.replay.connections_parser import Log, ConnectionLog
 from core.util.log_validation import is_valid_log, is_duplicate
@@ -79,9 +80,9 @@ def _parse_user_activity_log(file, logs, databases, start_time, end_time):
             user_activity_log.record_time = dateutil.parser.parse(
                 query_information[0][1:]
             )
-            user_activity_log.username = query_information[4][5:]
-            user_activity_log.database_name = query_information[3][3:]
-            user_activity_log.pid = query_information[5][4:]
+            user_activity_log.username = intern(query_information[4][5:])
+            user_activity_log.database_name = intern(query_information[3][3:])
+            user_activity_log.pid = intern(query_information[5][4:])
             user_activity_log.xid = query_information[7][4:]
             user_activity_log.text = line_split[1]
         else:
@@ -123,9 +124,9 @@ def _parse_start_node_log(file, logs, databases, start_time, end_time):
                     + " "
                     + query_information[2]
                 )
-                start_node_log.database_name = query_information[4].split("@")[1]
-                start_node_log.username = query_information[4][3:].split(":")[0]
-                start_node_log.pid = query_information[5][4:]
+                start_node_log.database_name = intern(query_information[4].split("@")[1])
+                start_node_log.username = intern(query_information[4][3:].split(":")[0])
+                start_node_log.pid = intern(query_information[5][4:])
                 start_node_log.xid = query_information[7][4:]
                 start_node_log.text = line_split[1].strip()
         else:
@@ -21,6 +21,12 @@ from tqdm import tqdm
 from common import aws_service as aws_service_helper
 from common import util
 from core.replay.connections_parser import ConnectionLog
+from core.replay.workload_store import (
+    STORE_FILENAME,
+    WorkloadStoreWriter,
+    source_digests,
+    source_stats,
+)
 from core.util.log_validation import remove_line_comments
 from core.extract.cloudwatch_extractor import CloudwatchExtractor
 from core.extract.s3_extractor import S3Extractor
@@ -93,7 +99,8 @@ class Extractor:
     ):
         """
         saving the extracted logs in S3 location in the following format:
-        connections.json, copy_replacements.csv, SQLs.json.gz
+        connections.json, copy_replacements.csv, SQLs.json.gz and, unless
+        save_workload_store is false, the indexed copy of the workload in workload.db
         :param logs:
         :param last_connections:
         :param output_directory:
@@ -174,7 +181,7 @@ class Extractor:
         # Save the connections logs
         sorted_connections = connections.values()
         connections_string = json.dumps(
-            [connection.__dict__ for connection in sorted_connections],
+            [connection.to_json() for connection in sorted_connections],
             indent=4,
             default=str,
         )
@@ -187,6 +194,15 @@ class Extractor:
             connections_file.write(connections_string)
             connections_file.close()
 
+        if self.config.get("save_workload_store", True):
+            self.save_workload_store(
+                sql_json,
+                json.loads(connections_string),
+                output_directory,
+                bucket_name,
+                output_prefix,
+            )
+
         # Save the replacements
         copy_replacements = replacements
         logger.info("Generating the copy_replcaments........")
@@ -212,6 +228,34 @@ class Extractor:
             replacements_file.write(replacements_string)
             replacements_file.close()
 
+    def save_workload_store(
+        self, sql_json, connections_json, output_directory, bucket_name=None, output_prefix=None
+    ):
+        """
+        saving the workload store, which lets the replay read only the connections and
+        transactions it needs, next to the JSON files
+        :param sql_json: transactions in the format of SQLs.json.gz
+        :param connections_json: connections in the format of connections.json
+        :param output_directory:
+        :param bucket_name: set if the output directory is on S3
+        :param output_prefix:
+        :return:
+        """
+        if bucket_name:
+            store_filename = "/tmp/" + STORE_FILENAME
+        else:
+            store_filename = output_directory + "/" + STORE_FILENAME
+        writer = WorkloadStoreWriter(store_filename)
+        writer.add_connections(connections_json)
+        writer.add_transactions(sql_json["transactions"].values())
+        # the JSON files are saved first, so the replay can tell if they change later
+        writer.close(source_digests(output_directory), source_stats(output_directory))
+
+        if bucket_name:
+            dest = output_prefix + "/" + STORE_FILENAME
+            logger.info(f"Transferring workload store to {dest}")
+            aws_service_helper.s3_upload(store_filename, bucket_name, dest)
+
     def get_sql_connections_replacements(self, last_connections, log_items):
         # transactions has form { "xid": xxx, "pid": xxx, etc..., queries: [] }
         sql_json = {"transactions": OrderedDict()}
@@ -242,10 +286,11 @@ class Extractor:
                             "time_interval": True,
                             "queries": [],
                         }
+                    # times are saved as microseconds since the epoch
                     query_info = {
-                        "record_time": query.record_time.isoformat(),
-                        "start_time": query.start_time.isoformat() if query.start_time else None,
-                        "end_time": query.end_time.isoformat() if query.end_time else None,
+                        "record_time": util.datetime_to_us(query.record_time),
+                        "start_time": util.datetime_to_us(query.start_time),
+                        "end_time": util.datetime_to_us(query.end_time),
                     }
                 except AttributeError:
                     logger.error(f"Query is missing header info, skipping {filename}: {query}")
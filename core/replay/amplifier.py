@@ -0,0 +1,153 @@
+import copy
+import logging
+import random
+import re
+
+from common.util import us_to_datetime
+from core.replay.transactions_parser import QueryPlan, query_tag_prefix
+
+logger = logging.getLogger("WorkloadReplicatorLogger")
+
+
+class ConnectionClone:
+    """One of the extra copies of a connection replayed when amplification_factor is set.
+
+    A clone only records the original connection and how the copy differs from it: its
+    time shift, username, pid, xids and schema remapping. Everything else is read from the
+    original, so the parent holds a few small objects per clone instead of a copy of every
+    transaction and query. The actual copy is built by materialize() when the worker
+    dispatches the connection, and is dropped once the connection is done."""
+
+    def __init__(self, source, clone_idx, time_offset_us, username, schema_map=None):
+        self.source = source
+        self.clone_idx = clone_idx
+        self.time_offset_us = time_offset_us
+        self.username = username
+        self.pid = f"{source.pid}-{clone_idx}"
+        self.schema_map = schema_map or {}
+        self.session_initiation_us = shift(source.session_initiation_us, time_offset_us)
+        self.disconnection_us = shift(source.disconnection_us, time_offset_us)
+
+    def __getattr__(self, name):
+        # only called for attributes not set in __init__, which are the same as the original
+        if name == "source":
+            raise AttributeError(name)
+        return getattr(self.source, name)
+
+    def __str__(self):
+        return f"Clone {self.clone_idx} of {self.source}"
+
+    # defined here so that __getattr__ doesn't return the times of the original
+    @property
+    def session_initiation_time(self):
+        return us_to_datetime(self.session_initiation_us)
+
+    @property
+    def disconnection_time(self):
+        return us_to_datetime(self.disconnection_us)
+
+    def query_times_us(self):
+        """Shifted start and end of every query, without copying the transactions"""
+        for start_us, end_us in self.source.query_times_us():
+            yield shift(start_us, self.time_offset_us), shift(end_us, self.time_offset_us)
+
+    def materialize(self):
+        """Build the copy of the original connection that is replayed"""
+        connection = copy.copy(self.source)
+        connection.session_initiation_us = self.session_initiation_us
+        connection.disconnection_us = self.disconnection_us
+        connection.username = self.username
+        connection.pid = self.pid
+        connection.transactions = [self.clone_transaction(t) for t in self.source.transactions]
+        return connection
+
+    def clone_transaction(self, transaction):
+        clone = copy.copy(transaction)
+        clone.username = self.username
+        clone.pid = self.pid
+        clone.xid = clone_xid(transaction.xid, self.clone_idx)
+        clone.queries = []
+        for idx, query in enumerate(transaction.queries):
+            query = copy.copy(query)
+            query.start_us = shift(query.start_us, self.time_offset_us)
+            query.end_us = shift(query.end_us, self.time_offset_us)
+            if self.schema_map:
+                query.text = remap_schemas(query.text, self.schema_map)
+            if query.plan is not None:
+                plan = query.plan
+                if self.schema_map:
+                    plan = plan.map_statements(lambda text: remap_schemas(text, self.schema_map))
+                # tagged with the xid of the clone
+                query.plan = QueryPlan(
+                    plan.statements, plan.split, query_tag_prefix(clone.xid, idx)
+                )
+            clone.queries.append(query)
+        return clone
+
+
+# offset added to the xids of each clone, well above the xids of a cluster
+CLONE_XID_OFFSET = 10**15
+
+
+def clone_xid(xid, clone_idx):
+    """Xid of a transaction of the clone_idx-th clone, distinct from the original and the
+    other clones so that error logs, statement traces and query tags can tell them apart.
+    Numeric xids stay numeric, for the statement trace."""
+    try:
+        return str(int(xid) + clone_idx * CLONE_XID_OFFSET)
+    except (TypeError, ValueError):
+        return f"{xid}-{clone_idx}"
+
+
+def shift(timestamp_us, time_offset_us):
+    if timestamp_us is None:
+        return None
+    return timestamp_us + time_offset_us
+
+
+def remap_schemas(text, schema_map):
+    """Replace schema qualified names, e.g. sales.orders becomes sales_1.orders for a
+    schema_map of {"sales": "sales_1"}"""
+    if not schema_map or text is None:
+        return text
+    for schema, replacement in schema_map.items():
+        text = re.sub(
+            rf'(?<![\w."]){re.escape(schema)}(?=\s*\.)', replacement, text, flags=re.IGNORECASE
+        )
+    return text
+
+
+def amplify_connections(connection_logs, config):
+    """Add amplification_factor - 1 clones of every connection, each shifted by a random
+    jitter of up to amplification_jitter_sec and optionally replayed as a different user
+    or against different schemas. Returns the connections sorted by start time, with the
+    original connections unchanged."""
+    factor = int(config.get("amplification_factor") or 1)
+    if factor <= 1:
+        return connection_logs
+
+    jitter_us = int(float(config.get("amplification_jitter_sec") or 0) * 1_000_000)
+    username_template = config.get("amplification_username") or "{username}"
+    schema_templates = config.get("amplification_schema_map") or {}
+    rng = random.Random(config.get("amplification_seed"))
+
+    amplified = []
+    for connection in connection_logs:
+        amplified.append(connection)
+        for clone_idx in range(1, factor):
+            time_offset_us = rng.randint(0, jitter_us)
+            username = username_template.format(username=connection.username, clone=clone_idx)
+            schema_map = {
+                schema: template.format(schema=schema, clone=clone_idx)
+                for schema, template in schema_templates.items()
+            }
+            amplified.append(
+                ConnectionClone(connection, clone_idx, time_offset_us, username, schema_map)
+            )
+    # the job queue and partitioner expect connections in start order
+    amplified.sort(key=lambda c: (c.session_initiation_us is not None, c.session_initiation_us))
+    logger.info(
+        f"Amplified {len(connection_logs)} connections {factor}x to {len(amplified)} connections "
+        f"(jitter up to {jitter_us / 1_000_000:g} sec)"
+    )
+    return amplified
@@ -0,0 +1,103 @@
+import asyncio
+import functools
+import sys
+
+from core.replay.connection_pool import pool_key
+from core.replay.connection_thread import ReplayConnection
+
+
+class AsyncConnection(ReplayConnection):
+    """Replays a single connection as a coroutine on the worker's event loop.
+
+    This is the asyncio engine counterpart of ConnectionThread. It shares the connection,
+    execution and stats logic of ReplayConnection, but waits for connections and queries
+    on the event loop and pushes every blocking driver call (connect, execute, commit,
+    close) to the bounded executor it is given."""
+
+    def __init__(self, *args, executor=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = executor
+
+    async def run_blocking(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def run_async(self):
+        try:
+            if self.connection_pool is not None:
+                await self.connection_pool.reserve_async(
+                    pool_key(self.connection_log, self.config), self.thread_stats
+                )
+            # equivalent of "with self.initiate_connection(...)" with the blocking enter and
+            # exit of the context manager running in the executor
+            context = self.initiate_connection(self.connection_log.username)
+            connection = await self.run_blocking(context.__enter__)
+            try:
+                if connection:
+                    await self.wait_for_session_start_async()
+                    await self.execute_transactions_async(connection)
+                    disconnect_deadline_ns = self.disconnect_deadline_ns()
+                    if disconnect_deadline_ns is not None:
+                        self.logger.debug(
+                            f"Waiting {self.clock.remaining_sec(disconnect_deadline_ns):.3f} sec "
+                            f"to disconnect (pid {self.connection_log.pid})"
+                        )
+                        await self.clock.wait_until_async(disconnect_deadline_ns)
+                else:
+                    self.logger.warning("Failed to connect")
+            except BaseException:
+                if not await self.run_blocking(context.__exit__, *sys.exc_info()):
+                    raise
+            else:
+                await self.run_blocking(context.__exit__, None, None, None)
+        except Exception as e:
+            # unlike a connection thread we can't exit here, that would stop the whole loop
+            self.logger.error(
+                f"Exception thrown for pid {self.connection_log.pid}: {e}",
+                exc_info=True,
+            )
+
+    async def wait_for_session_start_async(self):
+        """Same as wait_for_session_start, on the event loop"""
+        if self.preconnect_lead_ns:
+            await self.clock.wait_until_async(self.session_deadline_ns())
+            self.record_connection_diff()
+
+    async def execute_transactions_async(self, connection):
+        if self.connection_log.time_interval_between_transactions is True:
+            not_before_ns = self.clock.elapsed_ns()
+            for idx, transaction in enumerate(self.connection_log.transactions):
+                deadline_ns = self.transaction_deadline_ns(idx, not_before_ns)
+
+                # wait for the transaction to start
+                time_until_start_sec = self.clock.remaining_sec(deadline_ns)
+                if time_until_start_sec > self.clock.slack_sec:
+                    self.logger.warning(
+                        f"Waiting {time_until_start_sec:.1f} sec for transaction to start"
+                    )
+                    await self.clock.wait_until_async(deadline_ns)
+                await self.execute_transaction_async(transaction, connection)
+                not_before_ns = self.clock.elapsed_ns()
+        else:
+            for transaction in self.connection_log.transactions:
+                await self.execute_transaction_async(transaction, connection)
+
+    async def execute_transaction_async(self, transaction, connection):
+        errors = []
+        cursor = await self.run_blocking(connection.cursor)
+
+        not_before_ns = None
+        for idx, query in enumerate(transaction.queries):
+            deadline_ns = self.query_deadline_ns(query, not_before_ns)
+            self.record_query_lateness(await self.clock.wait_until_async(deadline_ns))
+
+            await self.run_blocking(
+                self.execute_query, transaction, idx, query, cursor, errors, deadline_ns
+            )
+
+            not_before_ns = None
+            if query.time_interval > 0.0:
+                self.logger.debug(f"Waiting {query.time_interval} sec between queries")
+                not_before_ns = self.clock.after_ns(query.time_interval)
+
+        await self.run_blocking(self.finish_transaction, transaction, cursor, connection, errors)
@@ -0,0 +1,128 @@
+import asyncio
+import random
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from core.replay.async_connection import AsyncConnection
+from core.replay.stats import collect_stats, init_stats
+from core.replay.worker import ReplayWorker
+
+# default number of threads available to each worker for blocking driver calls
+DEFAULT_ASYNC_EXECUTOR_THREADS = 64
+
+
+class AsyncReplayWorker(ReplayWorker):
+    """Replay worker for replay_engine: asyncio. Instead of one thread per connection,
+    the worker process runs a single event loop with one AsyncConnection coroutine per
+    connection. Blocking driver calls run in a bounded thread pool, so the number of OS
+    threads is capped regardless of how many connections are open."""
+
+    def replay(self):
+        self.init_worker_logging()
+        asyncio.run(self.replay_async())
+
+    async def replay_async(self):
+        loop = asyncio.get_running_loop()
+        executor_threads = (
+            self.config.get("async_executor_threads") or DEFAULT_ASYNC_EXECUTOR_THREADS
+        )
+        executor = ThreadPoolExecutor(
+            max_workers=int(executor_threads),
+            thread_name_prefix=f"replay-{self.process_idx}",
+        )
+        # reading the queue blocks on IPC, so keep it off the driver executor where it
+        # could be starved by long running queries
+        job_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs")
+        self.init_worker_resources()
+
+        # map task to stats dict
+        connection_tasks = {}
+        connections_processed = 0
+
+        try:
+            # stagger worker startup to not hammer the get_cluster_credentials api
+            await asyncio.sleep(random.randrange(1, 3))
+            self.logger.debug(
+                f"Worker {self.process_idx} ready for jobs ({executor_threads} executor threads)"
+            )
+
+            while True:
+                job = await loop.run_in_executor(job_executor, self.next_job)
+                if not job:
+                    break
+
+                thread_stats = init_stats({})
+
+                dispatch_lag_sec = await self.clock.wait_until_async(self.job_deadline_ns(job))
+
+                self.logger.debug(
+                    f"Starting job {job['job_id'] + 1} (extracted connection time: "
+                    f"{job['connection'].session_initiation_time}). "
+                    f"{len(connection_tasks)} connections active."
+                )
+
+                connection = AsyncConnection(
+                    self.process_idx,
+                    job["job_id"],
+                    # amplified clones are only built now, when they are due
+                    job["connection"].materialize(),
+                    self.default_interface,
+                    self.odbc_driver,
+                    self.replay_start_time,
+                    self.first_event_time,
+                    self.error_logger,
+                    thread_stats,
+                    self.num_connections,
+                    self.peak_connections,
+                    self.connection_semaphore,
+                    None,
+                    self.config,
+                    self.total_connections,
+                    self.credential_broker,
+                    self.clock,
+                    self.connection_pool,
+                    self.statement_trace,
+                    self.live_stats,
+                    executor=executor,
+                )
+                task = asyncio.create_task(connection.run_async(), name=f"{job['job_id']}")
+                connection_tasks[task] = thread_stats
+
+                self.collect_finished_tasks(connection_tasks)
+
+                connections_processed += 1
+                # read by the parent for the number of jobs still queued for this worker,
+                # and how far behind it is
+                self.worker_stats["jobs_started"] = connections_processed
+                self.worker_stats["dispatch_lag_sec"] = max(dispatch_lag_sec, 0)
+
+            self.logger.debug(f"Waiting for {len(connection_tasks)} connections to finish...")
+            await asyncio.gather(*connection_tasks, return_exceptions=True)
+            self.collect_finished_tasks(connection_tasks)
+        except Exception as e:
+            self.logger.error(f"Process {self.process_idx} threw exception: {e}")
+            self.logger.debug("".join(traceback.format_exception(*sys.exc_info())))
+        finally:
+            job_executor.shutdown(wait=False)
+            executor.shutdown(wait=True)
+            self.close_worker_resources()
+
+        if connections_processed:
+            self.logger.debug(
+                f"Max connection offset for this process: "
+                f"{self.worker_stats['connection_diff_sec']:.3f} sec"
+            )
+
+        self.logger.debug(f"Process {self.process_idx} finished")
+
+    def collect_finished_tasks(self, connection_tasks):
+        """Fold the stats of completed connection tasks into the worker stats"""
+        finished_tasks = [task for task in connection_tasks if task.done()]
+        for task in finished_tasks:
+            collect_stats(self.worker_stats, connection_tasks.pop(task), self.live_exclude())
+
+        self.logger.debug(
+            f"Collected {len(finished_tasks)} connections, {len(connection_tasks)} still active."
+        )
+        return len(finished_tasks)
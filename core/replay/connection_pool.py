@@ -0,0 +1,150 @@
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+from core.replay.credential_broker import replay_username
+
+logger = logging.getLogger("WorkloadReplicatorLogger")
+
+DEFAULT_RESET_STATEMENT = "RESET ALL"
+
+
+def pool_key(connection_log, config):
+    """Connections are pooled per user and database they are opened as"""
+    return replay_username(connection_log.username, config), connection_log.database_name
+
+
+def wake_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class ConnectionPool:
+    """Open connections of one worker for connection_pool mode, keyed by (username,
+    database).
+
+    Instead of opening a new connection for every session, a session borrows an idle
+    connection of its user and database, or opens one if there is none, and returns it when
+    it is done. The session state is reset before the connection is handed to the next
+    session. This trades the fidelity of replaying every connect for throughput, and is
+    meant for benchmarking how many queries a cluster sustains.
+
+    With a max_size, at most that many sessions of a user and database hold a connection at
+    the same time. A connection reserves its slot once it is due, so a session waiting for
+    its user and database doesn't hold up the sessions of others."""
+
+    def __init__(
+        self, max_size=None, reset_statement=DEFAULT_RESET_STATEMENT, num_connections=None
+    ):
+        self.max_size = max_size
+        self.reset_statement = reset_statement
+        # counts the connections that are open on the target cluster, see ConnectionCounter
+        self.num_connections = num_connections
+        self.condition = threading.Condition()
+        self.idle = collections.defaultdict(list)
+        self.reserved = collections.Counter()  # key -> sessions holding a slot
+        self.waiters = collections.defaultdict(list)  # key -> (loop, future) of reserve_async
+        self.num_open = 0
+
+    @classmethod
+    def from_config(cls, config, num_connections=None):
+        """The pool of a worker, or None if connection_pool isn't enabled"""
+        if not config.get("connection_pool"):
+            return None
+        max_size = config.get("connection_pool_size")
+        reset_statement = config.get("connection_pool_reset", DEFAULT_RESET_STATEMENT)
+        return cls(int(max_size) if max_size else None, reset_statement, num_connections)
+
+    def reserve(self, key, thread_stats):
+        """Wait until a session of the key can hold a connection, and claim that slot. Every
+        reserve is followed by a release."""
+        wait_start = time.perf_counter()
+        with self.condition:
+            while self.max_size and self.reserved[key] >= self.max_size:
+                self.condition.wait()
+            self.reserved[key] += 1
+        thread_stats["pool_wait_sec"] += time.perf_counter() - wait_start
+
+    async def reserve_async(self, key, thread_stats):
+        """Same as reserve, waiting on the event loop instead of blocking its thread"""
+        loop = asyncio.get_running_loop()
+        wait_start = time.perf_counter()
+        while True:
+            with self.condition:
+                if not self.max_size or self.reserved[key] < self.max_size:
+                    self.reserved[key] += 1
+                    break
+                waiter = loop.create_future()
+                self.waiters[key].append((loop, waiter))
+            await waiter
+        thread_stats["pool_wait_sec"] += time.perf_counter() - wait_start
+
+    def acquire(self, key, connect, thread_stats):
+        """An idle connection of the key, or a new one opened with connect()"""
+        with self.condition:
+            if self.idle[key]:
+                thread_stats["pool_reuses"] += 1
+                return self.idle[key].pop()
+        conn = connect()
+        with self.condition:
+            self.num_open += 1
+            if self.num_open > thread_stats["max_pool_connections"]:
+                thread_stats["max_pool_connections"] = self.num_open
+        return conn
+
+    def release(self, key, conn, reusable=True):
+        """Free the slot of a session and return its connection, if any, to the pool.
+        Connections that can't be reset are closed instead."""
+        if conn is not None and reusable:
+            try:
+                self.reset(conn)
+            except Exception as e:
+                logger.debug(
+                    f"Closing pooled connection of {key[0]} ({key[1]}), reset failed: {e}"
+                )
+                reusable = False
+        if conn is not None and not reusable:
+            self.close_connection(conn)
+        with self.condition:
+            if conn is not None:
+                if reusable:
+                    self.idle[key].append(conn)
+                else:
+                    self.num_open -= 1
+            self.reserved[key] -= 1
+            self.condition.notify_all()
+            # released from an executor thread, so wake the coroutines on their own loop
+            for loop, waiter in self.waiters.pop(key, []):
+                loop.call_soon_threadsafe(wake_waiter, waiter)
+
+    def reset(self, conn):
+        """Undo the session state a session left behind on its connection"""
+        conn.rollback()
+        if self.reset_statement:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(self.reset_statement)
+            finally:
+                cursor.close()
+            conn.commit()
+
+    def close_connection(self, conn):
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug(f"Error closing pooled connection: {e}")
+        if self.num_connections is not None:
+            self.num_connections.decrement()
+
+    def close(self):
+        """Close all idle connections, when the worker is done"""
+        with self.condition:
+            idle = [conn for conns in self.idle.values() for conn in conns]
+            self.idle.clear()
+            self.num_open -= len(idle)
+        for conn in idle:
+            self.close_connection(conn)
+        if idle:
+            logger.debug(f"Closed {len(idle)} pooled connections")
@@ -10,16 +10,27 @@ import traceback
 from contextlib import contextmanager
 from pathlib import Path
 
-import sqlparse
-
+from core.replay.connection_pool import pool_key
+from core.replay.credential_broker import replay_username
 from core.replay.prep import ReplayPrep
-from common.util import (
-    db_connect,
-    current_offset_ms,
+from core.replay.scheduler import ReplayClock, preconnect_lead_ns
+from core.replay.statement_trace import error_code, numeric_xid
+from core.replay.stats import (
+    CONNECTION_LATENESS_HISTOGRAM,
+    LIVE_STATS,
+    QUERY_LATENESS_HISTOGRAM,
+    lateness_slot,
 )
+from core.replay.transactions_parser import compile_query, should_execute_statement
+from common.util import db_connect
+
 
+class ReplayConnection:
+    """Replays a single connection of the workload: opens it, executes its queries and
+    records the outcome in the stats of the connection. This holds what the replay engines
+    share; ConnectionThread waits for connections and queries in a thread of its own and
+    AsyncConnection on the event loop of its worker."""
 
-class ConnectionThread(threading.Thread):
     logger = logging.getLogger("WorkloadReplicatorWorkerLogger")
 
     def __init__(
@@ -39,8 +50,12 @@ class ConnectionThread(threading.Thread):
         perf_lock,
         config,
         total_connections,
+        credential_broker=None,
+        clock=None,
+        connection_pool=None,
+        statement_trace=None,
+        live_stats=None,
     ):
-        threading.Thread.__init__(self)
         self.process_idx = process_idx
         self.job_id = job_id
         self.connection_log = connection_log
@@ -56,22 +71,33 @@ class ConnectionThread(threading.Thread):
         self.perf_lock = perf_lock
         self.config = config
         self.total_connections = total_connections
-
-    @contextmanager
-    def initiate_connection(self, username):
-        conn = None
-
-        # check if this connection is happening at the right time
-        expected_elapsed_sec = (
-            self.connection_log.session_initiation_time - self.first_event_time
-        ).total_seconds()
-        elapsed_sec = (
-            datetime.datetime.now(tz=datetime.timezone.utc) - self.replay_start
-        ).total_seconds()
-        connection_diff_sec = elapsed_sec - expected_elapsed_sec
+        self.credential_broker = credential_broker
+        self.clock = clock or ReplayClock.from_config(replay_start, first_event_time, config)
+        # connections are opened this long before their session starts, see
+        # wait_for_session_start
+        self.preconnect_lead_ns = preconnect_lead_ns(config)
+        # with connection_pool, the session reserves a slot in the worker's pool once due
+        self.connection_pool = connection_pool
+        # with statement_trace, every executed statement is recorded in the worker's trace
+        self.statement_trace = statement_trace
+        # SharedStats row of the worker that LIVE_STATS are added to as they change
+        self.live_stats = live_stats
+        # the replay start as it appears in the tag comment of every statement
+        self.replay_start_tag = json.dumps(replay_start.isoformat())
+
+    def session_deadline_ns(self):
+        return self.clock.deadline_ns(self.connection_log.session_initiation_us)
+
+    def record_connection_diff(self):
+        """Check whether the session is starting at the right time"""
+        expected_elapsed_ns = self.session_deadline_ns()
+        elapsed_ns = self.clock.elapsed_ns()
+        expected_elapsed_sec = expected_elapsed_ns / 1e9
+        elapsed_sec = elapsed_ns / 1e9
+        connection_diff_sec = (elapsed_ns - expected_elapsed_ns) / 1e9
         connection_duration_sec = (
-            self.connection_log.disconnection_time - self.connection_log.session_initiation_time
-        ).total_seconds()
+            self.connection_log.disconnection_us - self.connection_log.session_initiation_us
+        ) / 1e6
 
         self.logger.debug(
             f"Establishing connection {self.job_id + 1} of {self.total_connections} at {elapsed_sec:.3f} "
@@ -82,6 +108,13 @@ class ConnectionThread(threading.Thread):
 
         # save the connection difference
         self.thread_stats["connection_diff_sec"] = connection_diff_sec
+        self.add_stat(lateness_slot(CONNECTION_LATENESS_HISTOGRAM, connection_diff_sec))
+        if connection_diff_sec > 0:
+            self.add_stat("connection_lateness_sec", connection_diff_sec)
+        if connection_diff_sec > self.thread_stats["max_connection_lateness_sec"]:
+            self.thread_stats["max_connection_lateness_sec"] = connection_diff_sec
+        if self.clock.is_late(connection_diff_sec):
+            self.add_stat("late_connections")
 
         # and emit a warning if we're behind
         if abs(connection_diff_sec) > self.config.get("connection_tolerance_sec", 300):
@@ -91,6 +124,45 @@ class ConnectionThread(threading.Thread):
                 )
             )
 
+    def record_connect_time(self, connect_sec):
+        """Record the time to open a connection, which isn't part of any query"""
+        self.thread_stats["connects"] += 1
+        self.thread_stats["connect_sec"] += connect_sec
+        if connect_sec > self.thread_stats["max_connect_sec"]:
+            self.thread_stats["max_connect_sec"] = connect_sec
+
+    def connect(self, interface, credentials):
+        connect_start = time.perf_counter()
+        conn = db_connect(
+            interface,
+            host=credentials["host"],
+            port=int(credentials["port"]),
+            username=credentials["username"],
+            password=credentials["password"],
+            database=credentials["database"],
+            odbc_driver=credentials["odbc_driver"],
+            drop_return=self.config.get("drop_return"),
+        )
+        self.record_connect_time(time.perf_counter() - connect_start)
+        self.logger.debug(f"Connected using {interface} for PID: {self.connection_log.pid}")
+        self.num_connections.increment()
+        return conn
+
+    def reserve_pooled_connection(self):
+        """With connection_pool_size, wait until the user and database of the connection
+        have a free connection in the pool. initiate_connection releases it when done."""
+        if self.connection_pool is not None:
+            self.connection_pool.reserve(
+                pool_key(self.connection_log, self.config), self.thread_stats
+            )
+
+    @contextmanager
+    def initiate_connection(self, username):
+        conn = None
+
+        if not self.preconnect_lead_ns:
+            self.record_connection_diff()
+
         if self.connection_log.application_name == "psql":
             interface = "psql"
         elif self.connection_log.application_name == "odbc" and self.odbc_driver is not None:
@@ -103,29 +175,36 @@ class ConnectionThread(threading.Thread):
             interface = "psql"
         else:
             interface = "psql"
-        r = ReplayPrep(self.config)
         ##Fix IAM user bug. G.Bai - mar 2025
-        if username[:4] == "IAM:" or username[:5] == "IAMR:" or username.count(":") == 2:
-            self.logger.debug("Replace user - " + username + " to " + self.config["master_username"])
-            username = self.config["master_username"]
-        credentials = r.get_connection_credentials(username, database=self.connection_log.database_name)
-
+        replay_user = replay_username(username, self.config)
+        if replay_user != username:
+            self.logger.debug(f"Replace user - {username} to {replay_user}")
+            username = replay_user
+        key = (username, self.connection_log.database_name)
         try:
-            try:
-                conn = db_connect(
-                    interface,
-                    host=credentials["host"],
-                    port=int(credentials["port"]),
-                    username=credentials["username"],
-                    password=credentials["password"],
-                    database=credentials["database"],
-                    odbc_driver=credentials["odbc_driver"],
-                    drop_return=self.config.get("drop_return"),
+            if self.credential_broker is not None:
+                credentials = self.credential_broker.get_credentials(
+                    username, self.connection_log.database_name, self.thread_stats
                 )
-                self.logger.debug(
-                    f"Connected using {interface} for PID: {self.connection_log.pid}"
+            else:
+                r = ReplayPrep(self.config)
+                credentials = r.get_connection_credentials(
+                    username, database=self.connection_log.database_name
                 )
-                self.num_connections.value += 1
+        except BaseException:
+            if self.connection_pool is not None:
+                self.connection_pool.release(key, None)
+            raise
+
+        reusable = True
+        try:
+            try:
+                if self.connection_pool is not None:
+                    conn = self.connection_pool.acquire(
+                        key, lambda: self.connect(interface, credentials), self.thread_stats
+                    )
+                else:
+                    conn = self.connect(interface, credentials)
             except Exception as err:
                 hashed_cluster_url = copy.deepcopy(credentials)
                 hashed_cluster_url["password"] = "***"
@@ -139,15 +218,19 @@ class ConnectionThread(threading.Thread):
                 ] = f"{self.connection_log}\n\n{err}"
             yield conn
         except Exception as e:
+            reusable = False
             self.logger.error(f"Exception in connect: {e}", exc_info=True)
             self.logger.debug("".join(traceback.format_exception(*sys.exc_info())))
 
         finally:
             self.logger.debug(f"Context closing for pid: {self.connection_log.pid}")
-            if conn is not None:
+            if self.connection_pool is not None:
+                # the connection stays open for the next session of the user and database
+                self.connection_pool.release(key, conn, reusable)
+            elif conn is not None:
                 conn.close()
                 self.logger.debug(f"Disconnected for PID: {self.connection_log.pid}")
-            self.num_connections.value -= 1
+                self.num_connections.decrement()
             if self.connection_semaphore is not None:
                 self.logger.debug(
                     f"Releasing semaphore ({self.num_connections.value} / "
@@ -155,21 +238,182 @@ class ConnectionThread(threading.Thread):
                 )
                 self.connection_semaphore.release()
 
+    def transaction_deadline_ns(self, idx, not_before_ns):
+        """Deadline of the idx-th transaction of this connection when the time between
+        transactions is preserved: when it started in the workload, but no earlier than
+        the recorded gap to the end of the previous transaction (or to the start of the
+        session) after not_before_ns, the time the previous transaction finished."""
+        transaction = self.connection_log.transactions[idx]
+        if idx == 0:
+            prev_end_us = self.connection_log.session_initiation_us
+        else:
+            prev_end_us = self.connection_log.transactions[idx - 1].end_us()
+        gap_ns = (transaction.start_us() - prev_end_us) * 1000
+        return max(
+            self.clock.deadline_ns(transaction.start_us()),
+            not_before_ns + self.clock.gap_ns(gap_ns),
+        )
+
+    def query_deadline_ns(self, query, not_before_ns=None):
+        """Deadline of a query: when it started in the workload, or not_before_ns if that
+        is later, to preserve the time since the previous query"""
+        deadline_ns = self.clock.deadline_ns(query.start_us)
+        if not_before_ns is not None:
+            deadline_ns = max(deadline_ns, not_before_ns)
+        return deadline_ns
+
+    def disconnect_deadline_ns(self):
+        """Deadline of the disconnect if the session duration is preserved, else None"""
+        if self.connection_log.time_interval_between_transactions is not True:
+            return None
+        return self.clock.deadline_ns(self.connection_log.disconnection_us)
+
+    def add_stat(self, stat, amount=1):
+        """Add to a counter of the connection. LIVE_STATS are also added to the SharedStats
+        row of the worker right away, which only this worker writes."""
+        self.thread_stats[stat] += amount
+        if self.live_stats is not None and stat in LIVE_STATS:
+            self.live_stats.increment(stat, amount)
+
+    def record_query_lateness(self, lateness_sec):
+        """Record how long after its deadline a query was dispatched"""
+        self.add_stat(lateness_slot(QUERY_LATENESS_HISTOGRAM, lateness_sec))
+        if lateness_sec <= 0:
+            return
+        self.add_stat("query_lateness_sec", lateness_sec)
+        if lateness_sec > self.thread_stats["max_query_lateness_sec"]:
+            self.thread_stats["max_query_lateness_sec"] = lateness_sec
+        if self.clock.is_late(lateness_sec):
+            self.add_stat("late_queries")
+
+    def execute_query(self, transaction, idx, query, cursor, errors, deadline_ns=None):
+        """Execute a single query of a transaction following its QueryPlan and record the
+        outcome in the thread stats, and in the statement trace for a query that was due at
+        deadline_ns. This performs no waiting, so it can be shared by the threaded and
+        asyncio replay engines."""
+        plan = query.plan
+        if plan is None:
+            # queries that weren't loaded by the TransactionsParser
+            plan = compile_query(
+                query.text, transaction.xid, idx, self.config, self.should_execute_sql
+            )
+        statements = plan.statements
+
+        if plan.split:
+            self.add_stat("multi_statements")
+        if len(statements) > 1:
+            self.add_stat("multi_statements")
+        self.add_stat("executed_queries", len(statements))
+
+        success = True
+        for s_idx, (statement, execute) in enumerate(statements):
+            sql_text = plan.tagged(statement, self.replay_start_tag)
+
+            substatement_txt = ""
+            if len(statements) > 1:
+                substatement_txt = f", Multistatement: {s_idx + 1}/{len(statements)}"
+
+            exec_start = time.perf_counter()
+            start_ns = self.clock.elapsed_ns()
+            code = ""
+            try:
+                status = ""
+                if execute:
+                    cursor.execute(sql_text)
+                else:
+                    status = "Not a valid query"
+                exec_sec = time.perf_counter() - exec_start
+
+                self.logger.debug(
+                    f"{status}Replayed DB={transaction.database_name}, "
+                    f"USER={transaction.username}, PID={transaction.pid}, XID:{transaction.xid}, "
+                    f"Query: {idx + 1}/{len(transaction.queries)}{substatement_txt} "
+                    f"({exec_sec} sec)"
+                )
+            except Exception as err:
+                success = False
+                code = error_code(err)
+                errors.append([sql_text, str(err)])
+                self.logger.debug(
+                    f"Failed DB={transaction.database_name}, USER={transaction.username}, "
+                    f"PID={transaction.pid}, XID:{transaction.xid}, "
+                    f"Query: {idx + 1}/{len(transaction.queries)}{substatement_txt}: {err}",
+                    exc_info=True,
+                )
+                self.error_logger.append(
+                    parse_error(
+                        err,
+                        transaction.username,
+                        self.config["target_cluster_endpoint"].split("/")[-1],
+                        query.text,
+                    )
+                )
+            if self.statement_trace is not None and execute:
+                self.trace_statement(transaction, idx, s_idx, deadline_ns, start_ns, cursor, code)
+
+        if success:
+            self.add_stat("query_success")
+        else:
+            self.add_stat("query_error")
+
+    def trace_statement(self, transaction, idx, s_idx, deadline_ns, start_ns, cursor, code):
+        end_ns = self.clock.elapsed_ns()
+        rows = getattr(cursor, "rowcount", -1)
+        self.statement_trace.record(
+            self.job_id,
+            numeric_xid(transaction.xid),
+            idx,
+            s_idx,
+            start_ns if deadline_ns is None else deadline_ns,
+            start_ns,
+            end_ns,
+            rows if isinstance(rows, int) and not code else -1,
+            code,
+        )
+
+    def finish_transaction(self, transaction, cursor, connection, errors):
+        cursor.close()
+        connection.commit()
+
+        if self.thread_stats["query_error"] == 0:
+            self.thread_stats["transaction_success"] += 1
+        else:
+            self.thread_stats["transaction_error"] += 1
+            self.thread_stats["transaction_error_log"][transaction.get_base_filename()] = errors
+
+    def should_execute_sql(self, sql_text):
+        return should_execute_statement(sql_text, self.config)
+
+
+class ConnectionThread(ReplayConnection, threading.Thread):
+    """Replays a single connection in a thread of its own, the "thread" replay engine"""
+
+    def __init__(self, *args, **kwargs):
+        threading.Thread.__init__(self)
+        ReplayConnection.__init__(self, *args, **kwargs)
+
+    def wait_for_session_start(self):
+        """With preconnect_lead_ms, the connection is opened ahead of its session, so the
+        time to connect isn't added to the first query. Wait for the session to start
+        before anything is sent over it."""
+        if self.preconnect_lead_ns:
+            self.clock.wait_until(self.session_deadline_ns())
+            self.record_connection_diff()
+
     def run(self):
         try:
+            self.reserve_pooled_connection()
             with self.initiate_connection(self.connection_log.username) as connection:
                 if connection:
+                    self.wait_for_session_start()
                     self.execute_transactions(connection)
-                    if self.connection_log.time_interval_between_transactions is True:
-                        disconnect_offset_sec = (
-                            self.connection_log.disconnection_time - self.first_event_time
-                        ).total_seconds()
-                        if disconnect_offset_sec > current_offset_ms(self.replay_start):
-                            self.logger.debug(
-                                f"Waiting to disconnect {disconnect_offset_sec} sec (pid "
-                                f"{self.connection_log.pid})"
-                            )
-                            time.sleep(disconnect_offset_sec)
+                    disconnect_deadline_ns = self.disconnect_deadline_ns()
+                    if disconnect_deadline_ns is not None:
+                        self.logger.debug(
+                            f"Waiting {self.clock.remaining_sec(disconnect_deadline_ns):.3f} sec "
+                            f"to disconnect (pid {self.connection_log.pid})"
+                        )
+                        self.clock.wait_until(disconnect_deadline_ns)
                 else:
                     self.logger.warning("Failed to connect")
         except Exception as e:
@@ -181,29 +425,19 @@ class ConnectionThread(threading.Thread):
 
     def execute_transactions(self, connection):
         if self.connection_log.time_interval_between_transactions is True:
+            not_before_ns = self.clock.elapsed_ns()
             for idx, transaction in enumerate(self.connection_log.transactions):
-                # we can use this if we want to run transactions based on their offset from the start of the replay
-                # time_until_start_ms = transaction.offset_ms(self.first_event_time) -
-                # current_offset_ms(self.replay_start)
-
-                # or use this to preserve the time between transactions
-                if idx == 0:
-                    time_until_start_ms = (
-                        transaction.start_time() - self.connection_log.session_initiation_time
-                    ).total_seconds() * 1000.0
-                else:
-                    prev_transaction = self.connection_log.transactions[idx - 1]
-                    time_until_start_ms = (
-                        transaction.start_time() - prev_transaction.end_time()
-                    ).total_seconds() * 1000.0
+                deadline_ns = self.transaction_deadline_ns(idx, not_before_ns)
 
                 # wait for the transaction to start
-                if time_until_start_ms > 10:
+                time_until_start_sec = self.clock.remaining_sec(deadline_ns)
+                if time_until_start_sec > self.clock.slack_sec:
                     self.logger.warning(
-                        f"Waiting {time_until_start_ms / 1000:.1f} sec for transaction to start"
+                        f"Waiting {time_until_start_sec:.1f} sec for transaction to start"
                     )
-                    time.sleep(time_until_start_ms / 1000.0)
+                    self.clock.wait_until(deadline_ns)
                 self.execute_transaction(transaction, connection)
+                not_before_ns = self.clock.elapsed_ns()
         else:
             for transaction in self.connection_log.transactions:
                 self.execute_transaction(transaction, connection)
@@ -212,118 +446,25 @@ class ConnectionThread(threading.Thread):
         errors = []
         cursor = connection.cursor()
 
-        transaction_query_idx = 0
+        not_before_ns = None
         for idx, query in enumerate(transaction.queries):
-            time_until_start_ms = query.offset_ms(self.first_event_time) - current_offset_ms(
-                self.replay_start
-            )
+            deadline_ns = self.query_deadline_ns(query, not_before_ns)
             truncated_query = (
                 query.text[:60] + "..." if len(query.text) > 60 else query.text
             ).replace("\n", " ")
             self.logger.debug(
-                f"Executing [{truncated_query}] in {time_until_start_ms / 1000.0:.1f} sec"
+                f"Executing [{truncated_query}] in {self.clock.remaining_sec(deadline_ns):.1f} sec"
             )
-            if time_until_start_ms > 10:
-                time.sleep(time_until_start_ms / 1000.0)
-            if self.config.get("split_multi", True) and query.text is not None:
-                formatted_query = query.text.lower()
-                if not formatted_query.startswith(("begin", "start")):
-                    formatted_query = "begin;" + formatted_query
-                if not formatted_query.endswith(("commit", "end")):
-                    if not formatted_query.endswith(";"):
-                        formatted_query = formatted_query + ";"
-                    formatted_query = formatted_query + "commit;"
-                split_statements = sqlparse.split(query.text)
-                split_statements = [
-                    statement for statement in split_statements if statement != ";"
-                ]
-                self.thread_stats["multi_statements"] += 1
-            else:
-                split_statements = [query.text]
-
-            if len(split_statements) > 1:
-                self.thread_stats["multi_statements"] += 1
-            self.thread_stats["executed_queries"] += len(split_statements)
-
-            success = True
-            for s_idx, sql_text in enumerate(split_statements):
-                json_tags = {
-                    "xid": transaction.xid,
-                    "query_idx": idx,
-                    "replay_start": self.replay_start.isoformat(),
-                    "source": "Test-Drive",
-                }
-                sql_text = "/* {} */ {}".format(json.dumps(json_tags), sql_text)
-                transaction_query_idx += 1
-
-                substatement_txt = ""
-                if len(split_statements) > 1:
-                    substatement_txt = f", Multistatement: {s_idx + 1}/{len(split_statements)}"
-
-                exec_start = datetime.datetime.now(tz=datetime.timezone.utc)
-                exec_end = None
-                try:
-                    status = ""
-                    if self.should_execute_sql(sql_text):
-                        cursor.execute(sql_text)
-                    else:
-                        status = "Not a valid query"
-                    exec_end = datetime.datetime.now(tz=datetime.timezone.utc)
-                    exec_sec = (exec_end - exec_start).total_seconds()
-
-                    self.logger.debug(
-                        f"{status}Replayed DB={transaction.database_name}, USER={transaction.username}, PID={transaction.pid}, XID:{transaction.xid}, Query: {idx + 1}/{len(transaction.queries)}{substatement_txt} ({exec_sec} sec)"
-                    )
-                    success = success & True
-                except Exception as err:
-                    success = False
-                    errors.append([sql_text, str(err)])
-                    self.logger.debug(
-                        f"Failed DB={transaction.database_name}, USER={transaction.username}, PID={transaction.pid}, "
-                        f"XID:{transaction.xid}, Query: {idx + 1}/{len(transaction.queries)}{substatement_txt}: {err}",
-                        exc_info=True,
-                    )
-                    self.error_logger.append(
-                        parse_error(
-                            err,
-                            transaction.username,
-                            self.config["target_cluster_endpoint"].split("/")[-1],
-                            query.text,
-                        )
-                    )
+            self.record_query_lateness(self.clock.wait_until(deadline_ns))
 
-            if success:
-                self.thread_stats["query_success"] += 1
-            else:
-                self.thread_stats["query_error"] += 1
+            self.execute_query(transaction, idx, query, cursor, errors, deadline_ns)
 
+            not_before_ns = None
             if query.time_interval > 0.0:
                 self.logger.debug(f"Waiting {query.time_interval} sec between queries")
-                time.sleep(query.time_interval)
-
-        cursor.close()
-        connection.commit()
+                not_before_ns = self.clock.after_ns(query.time_interval)
 
-        if self.thread_stats["query_error"] == 0:
-            self.thread_stats["transaction_success"] += 1
-        else:
-            self.thread_stats["transaction_error"] += 1
-            self.thread_stats["transaction_error_log"][transaction.get_base_filename()] = errors
-
-    def should_execute_sql(self, sql_text):
-        return sql_text is not None and (
-            (
-                self.config.get("execute_copy_statements", "") == "true"
-                and "from 's3:" in sql_text.lower()
-            )
-            or (
-                self.config.get("execute_unload_statements", "") == "true"
-                and "to 's3:" in sql_text.lower()
-                and self.config["replay_output"] is not None
-            )
-            or ("from 's3:" not in sql_text.lower())
-            and ("to 's3:" not in sql_text.lower())
-        )
+        self.finish_transaction(transaction, cursor, connection, errors)
 
 
 def categorize_error(err_code):
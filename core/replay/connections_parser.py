@@ -1,13 +1,19 @@
-import datetime
 import json
 import logging
 import sys
 import traceback
 
-import dateutil.parser
 from boto3 import client
 
-from common.util import matches_filters
+from common.util import (
+    compile_filters,
+    datetime_to_us,
+    filter_time_window,
+    in_time_window,
+    intern_str,
+    parse_timestamp_us,
+    us_to_datetime,
+)
 
 logger = logging.getLogger("WorkloadReplicatorLogger")
 
@@ -17,13 +23,17 @@ def parse_connections(
     time_interval_between_transactions,
     time_interval_between_queries,
     filters,
+    store=None,
 ):
     connections = []
 
     # total number of connections before filters are applied
     total_connections = 0
 
-    if workload_directory.startswith("s3://"):
+    if store is not None:
+        # only read the connections that can match the filters
+        connections_json = store.connections(filters)
+    elif workload_directory.startswith("s3://"):
         workload_s3_location = workload_directory[5:].partition("/")
         bucket_name = workload_s3_location[0]
         prefix = workload_s3_location[2]
@@ -36,7 +46,18 @@ def parse_connections(
             connections_json = json.loads(connections_file.read())
             connections_file.close()
 
+    matches_filters = compile_filters(filters)
+    window_start_us, window_end_us = filter_time_window(filters)
     for connection_json in connections_json:
+        # checked before anything is parsed, as most connections may be filtered out
+        try:
+            if not matches_filters(connection_json):
+                total_connections += 1
+                continue
+        except KeyError as err:
+            logger.error(f"Could not parse connection: \n{str(connection_json)}\n{err}")
+            continue
+
         is_time_interval_between_transactions = {
             "": connection_json["time_interval_between_transactions"],
             "all on": True,
@@ -49,49 +70,60 @@ def parse_connections(
         }[time_interval_between_queries]
 
         try:
-            if connection_json["session_initiation_time"]:
-                session_initiation_time = dateutil.parser.isoparse(
-                    connection_json["session_initiation_time"]
-                ).replace(tzinfo=datetime.timezone.utc)
-            else:
-                session_initiation_time = None
-
-            if connection_json["disconnection_time"]:
-                disconnection_time = dateutil.parser.isoparse(
-                    connection_json["disconnection_time"]
-                ).replace(tzinfo=datetime.timezone.utc)
-            else:
-                disconnection_time = None
-            connection_key = (
-                f'{connection_json["database_name"]}_{connection_json["username"]}_'
-                f'{connection_json["pid"]}'
+            # connection times are UTC, whatever offset older workloads saved with them
+            session_initiation_time = parse_timestamp_us(
+                connection_json["session_initiation_time"], ignore_offset=True
             )
+            disconnection_time = parse_timestamp_us(
+                connection_json["disconnection_time"], ignore_offset=True
+            )
+            if not in_time_window(
+                session_initiation_time, disconnection_time, window_start_us, window_end_us
+            ):
+                total_connections += 1
+                continue
+            # the same few users and databases repeat across all connections and
+            # transactions, so share one copy of each
+            database_name = intern_str(connection_json["database_name"])
+            username = intern_str(connection_json["username"])
+            pid = intern_str(connection_json["pid"])
+            connection_key = intern_str(f"{database_name}_{username}_{pid}")
             connection = ConnectionLog(
                 session_initiation_time,
                 disconnection_time,
-                connection_json["database_name"],
-                connection_json["username"],
-                connection_json["pid"],
-                connection_json["application_name"],
+                database_name,
+                username,
+                pid,
+                intern_str(connection_json["application_name"]),
                 is_time_interval_between_transactions,
                 is_time_interval_between_queries,
                 connection_key,
             )
-            if matches_filters(connection, filters):
-                connections.append(connection)
+            connections.append(connection)
             total_connections += 1
         except Exception as err:
             logger.error(f"Could not parse connection: \n{str(connection_json)}\n{err}")
             logger.debug("".join(traceback.format_exception(*sys.exc_info())))
 
-    connections.sort(
-        key=lambda conxn: conxn.session_initiation_time
-        or datetime.datetime.utcfromtimestamp(0).replace(tzinfo=datetime.timezone.utc)
-    )
+    if store is not None:
+        total_connections = store.count_connections()
+
+    connections.sort(key=lambda conxn: conxn.session_initiation_us or 0)
     return connections, total_connections
 
 
 class Log:
+    __slots__ = (
+        "record_time",
+        "start_time",
+        "end_time",
+        "username",
+        "database_name",
+        "pid",
+        "xid",
+        "text",
+    )
+
     def __init__(self):
         self.record_time = ""
         self.start_time = ""
@@ -150,6 +182,24 @@ class Log:
 
 
 class ConnectionLog:
+    """A connection of the workload. Like Query, its times are held as integer
+    microseconds since the epoch, in session_initiation_us and disconnection_us, and
+    session_initiation_time and disconnection_time are the same times as UTC datetimes."""
+
+    __slots__ = (
+        "session_initiation_us",
+        "disconnection_us",
+        "application_name",
+        "database_name",
+        "username",
+        "pid",
+        "query_index",
+        "time_interval_between_transactions",
+        "time_interval_between_queries",
+        "connection_key",
+        "transactions",
+    )
+
     def __init__(
         self,
         session_initiation_time,
@@ -174,11 +224,27 @@ class ConnectionLog:
         self.connection_key = connection_key
         self.transactions = []
 
+    @property
+    def session_initiation_time(self):
+        return us_to_datetime(self.session_initiation_us)
+
+    @session_initiation_time.setter
+    def session_initiation_time(self, value):
+        self.session_initiation_us = value if isinstance(value, int) else datetime_to_us(value)
+
+    @property
+    def disconnection_time(self):
+        return us_to_datetime(self.disconnection_us)
+
+    @disconnection_time.setter
+    def disconnection_time(self, value):
+        self.disconnection_us = value if isinstance(value, int) else datetime_to_us(value)
+
     def __eq__(self, other):
         return (
             isinstance(other, self.__class__)
-            and self.session_initiation_time == other.session_initiation_time
-            and self.disconnection_time == other.disconnection_time
+            and self.session_initiation_us == other.session_initiation_us
+            and self.disconnection_us == other.disconnection_us
             and self.application_name == other.application_name
             and self.database_name == other.database_name
             and self.username == other.username
@@ -191,7 +257,7 @@ class ConnectionLog:
         return hash((self.database_name, self.username, self.pid))
 
     def get_pk(self):
-        return hash((self.session_initiation_time, self.database_name, self.username, self.pid))
+        return hash((self.session_initiation_us, self.database_name, self.username, self.pid))
 
     def __str__(self):
         return (
@@ -212,7 +278,26 @@ class ConnectionLog:
         )
 
     def offset_ms(self, ref_time):
-        return (self.session_initiation_time - ref_time).total_seconds() * 1000.0
+        return (self.session_initiation_us - datetime_to_us(ref_time)) / 1000.0
+
+    def to_json(self):
+        """The connection as saved in connections.json, with times in microseconds since
+        the epoch"""
+        connection_json = {field: getattr(self, field) for field in self.__slots__}
+        connection_json["session_initiation_time"] = connection_json.pop("session_initiation_us")
+        connection_json["disconnection_time"] = connection_json.pop("disconnection_us")
+        return connection_json
+
+    def materialize(self):
+        """The connection to replay. Clones made by amplification build their own copy."""
+        return self
+
+    def query_times_us(self):
+        """Start and end of every query of the connection, in microseconds since the epoch.
+        Clones made by amplification return their shifted times."""
+        for transaction in self.transactions:
+            for query in transaction.queries:
+                yield query.start_us, query.end_us
 
     @staticmethod
     def supported_filters():
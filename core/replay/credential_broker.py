@@ -0,0 +1,164 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from core.replay.prep import ReplayPrep
+
+logger = logging.getLogger("WorkloadReplicatorLogger")
+
+
+def replay_username(username, config):
+    """The user a connection is replayed as. IAM users can't get cluster credentials and
+    are replayed as the master user."""
+    if username[:4] == "IAM:" or username[:5] == "IAMR:" or username.count(":") == 2:
+        return config["master_username"]
+    return username
+
+
+class CredentialBroker:
+    """Cache of target cluster credentials per (username, database), shared by all workers.
+
+    The parent prefetches credentials for every user and database in the workload before
+    the workers start, so each worker begins with a warm local copy of the cache instead
+    of calling GetClusterCredentials for every connection. Within a worker a background
+    thread refreshes the entries that worker has handed out before they expire, and a miss
+    is fetched once per key no matter how many connections are waiting for it."""
+
+    def __init__(self, config):
+        self.config = config
+        # age at which credentials are renewed in the background
+        self.refresh_after_sec = config.get("credentials_refresh_sec") or 1500
+        # age after which credentials are no longer handed out, see ReplayPrep
+        self.max_age_sec = max(1800, self.refresh_after_sec)
+        self.credentials = {}  # (username, database) -> (fetch time, credentials)
+        self.init_process_state()
+
+    def init_process_state(self):
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.refresher = None
+        # keys handed out in this process, the only ones its refresher renews
+        self.used = set()
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ("lock", "key_locks", "refresher", "used"):
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_process_state()
+
+    def fetch(self, username, database):
+        """Fetch new credentials, returns the credentials and the time it took"""
+        start = time.monotonic()
+        credentials = ReplayPrep(self.config).get_connection_credentials(
+            username, database=database, skip_cache=True
+        )
+        return credentials, time.monotonic() - start
+
+    def prefetch(self, connection_logs):
+        """Fetch credentials of all distinct users and databases in parallel"""
+        keys = {
+            (replay_username(c.username, self.config), c.database_name) for c in connection_logs
+        }
+        if not keys:
+            return
+        threads = min(len(keys), self.config.get("credentials_prefetch_threads") or 16)
+        logger.info(f"Prefetching credentials for {len(keys)} users using {threads} threads")
+
+        def prefetch_key(key):
+            try:
+                credentials, elapsed = self.fetch(*key)
+                self.credentials[key] = (time.time(), credentials)
+                return elapsed
+            except Exception as e:
+                # the workers will retry on first use
+                logger.warning(f"Failed to prefetch credentials for {key[0]} ({key[1]}): {e}")
+                return None
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = [t for t in executor.map(prefetch_key, sorted(keys)) if t is not None]
+        if latencies:
+            logger.info(
+                f"Prefetched {len(latencies)} of {len(keys)} credentials in "
+                f"{time.monotonic() - start:.3f} sec (max fetch {max(latencies):.3f} sec)"
+            )
+
+    def get_credentials(self, username, database, stats=None):
+        """Return cached credentials, fetching them on a miss. Hits, misses and fetch
+        latency are counted in stats if given."""
+        self.ensure_refresher()
+        key = (username, database)
+        self.used.add(key)
+        credentials = self.cached(key)
+        if credentials is not None:
+            if stats is not None:
+                stats["credential_cache_hits"] += 1
+            return credentials
+
+        if stats is not None:
+            stats["credential_cache_misses"] += 1
+        with self.key_lock(key):
+            # another connection may have fetched it while we were waiting for the lock
+            credentials = self.cached(key)
+            if credentials is None:
+                credentials, elapsed = self.fetch(username, database)
+                self.credentials[key] = (time.time(), credentials)
+                if stats is not None:
+                    stats["credential_fetches"] += 1
+                    stats["credential_fetch_sec"] += elapsed
+        return credentials
+
+    def cached(self, key):
+        record = self.credentials.get(key)
+        if record is not None and time.time() - record[0] < self.max_age_sec:
+            return record[1]
+        return None
+
+    def key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def refresh_stale(self):
+        """Renew the entries handed out by this process that are older than
+        refresh_after_sec. Keys only the parent prefetched are left to the workers that use
+        them, so every worker doesn't renew the whole workload's credentials."""
+        now = time.time()
+        for key in list(self.used):
+            fetch_time = self.credentials.get(key, (0, None))[0]
+            if now - fetch_time < self.refresh_after_sec:
+                continue
+            try:
+                with self.key_lock(key):
+                    credentials, _ = self.fetch(*key)
+                    self.credentials[key] = (time.time(), credentials)
+                logger.debug(f"Refreshed credentials for {key[0]} ({key[1]})")
+            except Exception as e:
+                logger.warning(f"Failed to refresh credentials for {key[0]} ({key[1]}): {e}")
+
+    def ensure_refresher(self, interval_sec=60):
+        """Start the background refresh thread of this process, if not running yet"""
+        if self.refresher is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked with the parent's state, the parent's thread doesn't exist here
+                self.init_process_state()
+            if self.refresher is not None:
+                return
+
+            def refresh_loop():
+                while True:
+                    time.sleep(interval_sec)
+                    self.refresh_stale()
+
+            self.refresher = threading.Thread(
+                target=refresh_loop, name="credential-refresh", daemon=True
+            )
+            self.refresher.start()
@@ -0,0 +1,262 @@
+"""
+metrics_server.py
+====================================
+Live metrics of a running replay, served by the parent process at
+http://<metrics_host>:<metrics_port>/metrics in the Prometheus text format, so a replay
+can be watched from Prometheus or Grafana while it runs.
+
+Every scrape reads the SharedStats rows of the workers, the same shared memory the parent
+reads for its progress log line, so the workers do no extra work for it.
+"""
+
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from core.replay.stats import (
+    CONNECTION_LATENESS_HISTOGRAM,
+    LATENESS_BUCKETS_SEC,
+    QUERY_LATENESS_HISTOGRAM,
+)
+
+logger = logging.getLogger("WorkloadReplicatorLogger")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# metric name, type, help text and stat of each per worker metric
+WORKER_METRICS = (
+    (
+        "replay_queries_succeeded_total",
+        "counter",
+        "Queries replayed successfully",
+        "query_success",
+    ),
+    (
+        "replay_queries_failed_total",
+        "counter",
+        "Queries that failed",
+        "query_error",
+    ),
+    (
+        "replay_statements_executed_total",
+        "counter",
+        "Statements executed",
+        "executed_queries",
+    ),
+    (
+        "replay_transactions_succeeded_total",
+        "counter",
+        "Transactions committed",
+        "transaction_success",
+    ),
+    (
+        "replay_transactions_failed_total",
+        "counter",
+        "Transactions with a failed query",
+        "transaction_error",
+    ),
+    (
+        "replay_connections_started_total",
+        "counter",
+        "Connections dispatched",
+        "jobs_started",
+    ),
+    (
+        "replay_active_connections",
+        "gauge",
+        "Connections open on the target",
+        "active_connections",
+    ),
+    (
+        "replay_connects_total",
+        "counter",
+        "Connections opened on the target",
+        "connects",
+    ),
+    (
+        "replay_connect_seconds_total",
+        "counter",
+        "Time spent opening connections",
+        "connect_sec",
+    ),
+    (
+        "replay_late_connections_total",
+        "counter",
+        "Connections started late",
+        "late_connections",
+    ),
+    (
+        "replay_late_queries_total",
+        "counter",
+        "Queries started late",
+        "late_queries",
+    ),
+    (
+        "replay_max_query_lateness_seconds",
+        "gauge",
+        "Latest start of a query",
+        "max_query_lateness_sec",
+    ),
+    (
+        "replay_credential_cache_hits_total",
+        "counter",
+        "Credential cache hits",
+        "credential_cache_hits",
+    ),
+    (
+        "replay_credential_cache_misses_total",
+        "counter",
+        "Credential cache misses",
+        "credential_cache_misses",
+    ),
+    (
+        "replay_credential_fetches_total",
+        "counter",
+        "Credential fetches during the replay",
+        "credential_fetches",
+    ),
+    (
+        "replay_credential_fetch_seconds_total",
+        "counter",
+        "Time spent fetching credentials",
+        "credential_fetch_sec",
+    ),
+)
+
+# metric name, help text, histogram and total lateness stat of each lateness histogram
+LATENESS_METRICS = (
+    (
+        "replay_query_lateness_seconds",
+        "Time queries started after they were due",
+        QUERY_LATENESS_HISTOGRAM,
+        "query_lateness_sec",
+    ),
+    (
+        "replay_connection_lateness_seconds",
+        "Time connections started after they were due",
+        CONNECTION_LATENESS_HISTOGRAM,
+        "connection_lateness_sec",
+    ),
+)
+
+
+def render_metrics(snapshot, peak_connections=0, queued_connections=None):
+    """Metrics of a SharedStats snapshot in the Prometheus text format. queued_connections
+    maps a worker label, or "shared" for the job queue, to the connections still queued."""
+    lines = []
+
+    def add(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}")
+
+    for name, metric_type, help_text, stat in WORKER_METRICS:
+        add(
+            name,
+            metric_type,
+            help_text,
+            [({"worker": idx}, stats.get(stat, 0)) for idx, stats in snapshot.items()],
+        )
+    add(
+        "replay_peak_connections",
+        "gauge",
+        "Most connections open at the same time",
+        [({}, peak_connections)],
+    )
+    if queued_connections is not None:
+        add(
+            "replay_queued_connections",
+            "gauge",
+            "Connections not yet dispatched",
+            [({"worker": label}, depth) for label, depth in queued_connections.items()],
+        )
+
+    for name, help_text, histogram, sum_stat in LATENESS_METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for idx, stats in snapshot.items():
+            cumulative = 0
+            for bound, slot in zip(LATENESS_BUCKETS_SEC, histogram):
+                cumulative += stats.get(slot, 0)
+                lines.append(f'{name}_bucket{{worker="{idx}",le="{bound:g}"}} {cumulative}')
+            cumulative += stats.get(histogram[-1], 0)
+            lines.append(f'{name}_bucket{{worker="{idx}",le="+Inf"}} {cumulative}')
+            lines.append(f'{name}_sum{{worker="{idx}"}} {stats.get(sum_stat, 0)}')
+            lines.append(f'{name}_count{{worker="{idx}"}} {cumulative}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """HTTP server in a daemon thread of the parent serving the metrics of a replay"""
+
+    def __init__(self, shared_stats, port, host="127.0.0.1", queued_connections=None):
+        self.shared_stats = shared_stats
+        self.queued_connections = queued_connections
+        # updated by the parent, which samples the active connections every second
+        self.peak_connections = 0
+        self.server = ThreadingHTTPServer((host, int(port)), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics", daemon=True
+        )
+
+    @classmethod
+    def from_config(cls, config, shared_stats, queued_connections=None):
+        """The metrics server of the replay, or None if metrics_port isn't set"""
+        if not config.get("metrics_port"):
+            return None
+        try:
+            return cls(
+                shared_stats,
+                config["metrics_port"],
+                config.get("metrics_host") or "127.0.0.1",
+                queued_connections,
+            )
+        except OSError as e:
+            # the replay itself doesn't depend on the metrics
+            logger.warning(f"Unable to serve metrics on port {config['metrics_port']}: {e}")
+            return None
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def render(self):
+        queued = None
+        if self.queued_connections is not None:
+            try:
+                queued = self.queued_connections()
+            except Exception as e:
+                logger.debug(f"Unable to read the queued connections: {e}")
+        return render_metrics(self.shared_stats.snapshot(), self.peak_connections, queued)
+
+    def handler(self):
+        metrics_server = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics_server.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Metrics request: {format % args}")
+
+        return MetricsHandler
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"Serving replay metrics at {self.address}")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
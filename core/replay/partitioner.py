@@ -0,0 +1,196 @@
+import heapq
+import logging
+import os
+import pickle
+
+logger = logging.getLogger("WorkloadReplicatorLogger")
+
+PARTITION_STRATEGIES = ("round_robin", "bin_pack", "load_balance")
+
+
+def partition_connections(connection_logs, num_workers, strategy="round_robin"):
+    """Split the connections into one schedule per worker. Each schedule is a list of
+    jobs in the same format as the ones put on the job queue, ordered by session start
+    time. connection_logs is expected to be sorted by session initiation time.
+
+    round_robin deals connections out in session start order. bin_pack assigns each
+    connection to the worker with the fewest sessions still open at the time the
+    connection starts, breaking ties by the number of transactions and then connections
+    already assigned. load_balance assigns each connection to the worker with the lowest
+    load at the time the connection starts, see load_balance."""
+    if strategy not in PARTITION_STRATEGIES:
+        raise ValueError(f"Unknown partition strategy {strategy}")
+
+    shards = [[] for _ in range(num_workers)]
+    if strategy == "round_robin":
+        for idx, connection in enumerate(connection_logs):
+            shards[idx % num_workers].append({"job_id": idx, "connection": connection})
+        return shards
+    if strategy == "load_balance":
+        return load_balance(connection_logs, num_workers)
+
+    # per worker min-heap of disconnection times of the sessions assigned to it
+    open_sessions = [[] for _ in range(num_workers)]
+    assigned_transactions = [0] * num_workers
+    for idx, connection in enumerate(connection_logs):
+        start = connection.session_initiation_us
+        for sessions in open_sessions:
+            while sessions and start is not None and sessions[0] <= start:
+                heapq.heappop(sessions)
+
+        worker = min(
+            range(num_workers),
+            key=lambda w: (len(open_sessions[w]), assigned_transactions[w], len(shards[w]), w),
+        )
+        shards[worker].append({"job_id": idx, "connection": connection})
+        assigned_transactions[worker] += len(connection.transactions)
+        end = connection.disconnection_us or start
+        if end is not None:
+            heapq.heappush(open_sessions[worker], end)
+    return shards
+
+
+def session_bounds(connection):
+    """Start and end of a session in microseconds since the epoch. Sessions without a
+    disconnection time end at their start."""
+    start = connection.session_initiation_us
+    end = connection.disconnection_us or start
+    return start, end
+
+
+def statement_rate(connection):
+    """Average number of queries per second over the session, treating sessions
+    shorter than a second as lasting one second. Only the session bounds and the number of
+    queries are read, so the shifted bounds of amplified clones are used as they are."""
+    start, end = session_bounds(connection)
+    duration_sec = 1.0
+    if start is not None and end is not None:
+        duration_sec = max((end - start) / 1e6, 1.0)
+    return sum(len(t.queries) for t in connection.transactions) / duration_sec
+
+
+def load_balance(connection_logs, num_workers):
+    """Assign each connection to the worker with the lowest load when it starts. The
+    load of a worker is the number of sessions it has open plus their statement rate,
+    scaled so that a session running the average statement rate counts as much as the
+    session itself. Long lived sessions and sessions running many queries are spread
+    across workers, rather than only the number of sessions."""
+    rates = [statement_rate(connection) for connection in connection_logs]
+    mean_rate = sum(rates) / len(rates) if rates else 0
+    rate_weight = 1 / mean_rate if mean_rate else 0
+
+    shards = [[] for _ in range(num_workers)]
+    # per worker min-heap of the end and load of the sessions assigned to it
+    open_sessions = [[] for _ in range(num_workers)]
+    open_load = [0.0] * num_workers
+    for idx, connection in enumerate(connection_logs):
+        start, end = session_bounds(connection)
+        for worker, sessions in enumerate(open_sessions):
+            while sessions and start is not None and sessions[0][0] <= start:
+                open_load[worker] -= heapq.heappop(sessions)[1]
+
+        worker = min(range(num_workers), key=lambda w: (open_load[w], len(shards[w]), w))
+        shards[worker].append({"job_id": idx, "connection": connection})
+        if end is not None:
+            load = 1 + rates[idx] * rate_weight
+            heapq.heappush(open_sessions[worker], (end, load))
+            open_load[worker] += load
+    return shards
+
+
+def preview_load(shards):
+    """Expected load of each worker: its connections, transactions and queries, and the
+    peak number of concurrent sessions and statement rate over the replay"""
+    preview = []
+    for shard in shards:
+        events = []
+        transactions = 0
+        queries = 0
+        for job in shard:
+            connection = job["connection"]
+            transactions += len(connection.transactions)
+            queries += sum(len(t.queries) for t in connection.transactions)
+            start, end = session_bounds(connection)
+            if start is None:
+                continue
+            rate = statement_rate(connection)
+            # sessions ending when another starts aren't counted as concurrent
+            events.append((start, 1, 1, rate))
+            events.append((end, 0, -1, -rate))
+        events.sort()
+
+        sessions = peak_sessions = 0
+        rate = peak_rate = 0.0
+        for _, _, session_delta, rate_delta in events:
+            sessions += session_delta
+            rate += rate_delta
+            peak_sessions = max(peak_sessions, sessions)
+            peak_rate = max(peak_rate, rate)
+        preview.append(
+            {
+                "connections": len(shard),
+                "transactions": transactions,
+                "queries": queries,
+                "peak_sessions": peak_sessions,
+                "peak_queries_per_sec": peak_rate,
+            }
+        )
+    return preview
+
+
+def log_load_preview(shards):
+    logger.info("Expected load per worker:")
+    logger.info(
+        f"{'worker':>6} {'connections':>11} {'transactions':>12} {'queries':>9} "
+        f"{'peak sessions':>13} {'peak queries/sec':>16}"
+    )
+    for idx, load in enumerate(preview_load(shards)):
+        logger.info(
+            f"{idx:>6} {load['connections']:>11} {load['transactions']:>12} {load['queries']:>9} "
+            f"{load['peak_sessions']:>13} {load['peak_queries_per_sec']:>16.1f}"
+        )
+
+
+def write_shards(shards, directory):
+    """Serialize each worker schedule to its own file, returning the file paths"""
+    paths = []
+    for idx, shard in enumerate(shards):
+        path = os.path.join(directory, f"shard-{idx}.pkl")
+        with open(path, "wb") as fp:
+            pickle.dump(shard, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        logger.debug(f"Wrote {len(shard)} connections for worker {idx} to {path}")
+        paths.append(path)
+    return paths
+
+
+class ShardQueue:
+    """Read-only, queue-like view of a worker schedule written by write_shards.
+
+    The shard is only loaded on the first get(), i.e. in the worker process, so the jobs
+    never pass through the manager. Until then its size is the number of jobs it was
+    written with. Once all jobs have been handed out get() returns False, the same
+    termination signal the job queue uses."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.jobs = None
+        self.position = 0
+
+    def get(self, block=True, timeout=None):
+        if self.jobs is None:
+            with open(self.path, "rb") as fp:
+                self.jobs = pickle.load(fp)
+        if self.position >= len(self.jobs):
+            return False
+        job = self.jobs[self.position]
+        # drop the reference so finished connections can be garbage collected
+        self.jobs[self.position] = None
+        self.position += 1
+        return job
+
+    def qsize(self):
+        return (self.size if self.jobs is None else len(self.jobs)) - self.position
+
+    def empty(self):
+        return self.qsize() <= 0
@@ -1,3 +1,4 @@
+import bisect
 import copy
 import datetime
 import logging
@@ -6,10 +7,17 @@ import re
 
 import boto3
 
+from core.replay.amplifier import amplify_connections
+from core.replay.prep_cache import PrepCache
 from core.replay.transactions_parser import TransactionsParser
 from core.replay.connections_parser import parse_connections
+from core.replay.workload_store import STORE_FILENAME, WorkloadStore
 from common.util import (
+    FilterValues,
+    datetime_to_us,
+    filter_time_window,
     get_connection_key,
+    us_to_datetime,
     is_serverless,
     CredentialsException,
 )
@@ -29,11 +37,35 @@ class ReplayPrep:
         self.credentials_cache = {}
 
     def correlate_transactions_with_connections(self, replay_id):
+        cache = PrepCache.from_config(self.config, replay_id)
+        prepared = cache.load() if cache is not None else None
+        if prepared is None:
+            prepared = self.load_workload(replay_id)
+            if cache is not None:
+                cache.save(prepared)
+        return self.amplify_workload(*prepared)
+
+    def load_workload(self, replay_id):
+        store = None
+        if self.config.get("use_workload_store", True):
+            store = WorkloadStore.open(self.config["workload_location"])
+        if store is not None:
+            logger.info(
+                f"Loading the workload from {STORE_FILENAME} in {self.config['workload_location']}"
+            )
+        try:
+            return self.correlate_workload(replay_id, store)
+        finally:
+            if store is not None:
+                store.close()
+
+    def correlate_workload(self, replay_id, store=None):
         (connection_logs, total_connections) = parse_connections(
             self.config["workload_location"],
             self.config["time_interval_between_transactions"],
             self.config["time_interval_between_queries"],
             self.config["filters"],
+            store,
         )
         logger.info(
             f"Found {total_connections} total connections, {total_connections - len(connection_logs)} "
@@ -44,55 +76,91 @@ class ReplayPrep:
         logger.info(
             f"Loading transactions from {self.config['workload_location']}, this might take some time."
         )
-        # group all connections by connection key
+        # group all connections by connection key, with their session start times in
+        # the same order. This relies on connections being sorted. Session start times are
+        # truncated to seconds, since query/transaction time is truncated to seconds.
         connection_idx_by_key = {}
+        connection_starts_by_key = {}
         for idx, c in enumerate(connection_logs):
             connection_key = get_connection_key(c.database_name, c.username, c.pid)
+            session_start_us = c.session_initiation_us or 0
             connection_idx_by_key.setdefault(connection_key, []).append(idx)
+            connection_starts_by_key.setdefault(connection_key, []).append(
+                session_start_us - session_start_us % 1_000_000
+            )
 
-        tp = TransactionsParser(self.config, replay_id)
+        tp = TransactionsParser(self.config, replay_id, store)
         all_transactions = tp.parse_transactions()
         transaction_count = len(all_transactions)
         query_count = 0
-        # assign the correct connection to each transaction by looking at the most
-        # recent connection prior to the transaction start. This relies on connections
-        # being sorted.
-        first_event_time = datetime.datetime.now(tz=datetime.timezone.utc)
-        last_event_time = datetime.datetime.utcfromtimestamp(0).replace(
-            tzinfo=datetime.timezone.utc
-        )
-        for idx, t in enumerate(all_transactions):
+        # assign the correct connection to each transaction by looking up the most recent
+        # connection of its key that started before the transaction, and work out the time
+        # between its queries in the same pass
+        first_event_us = datetime_to_us(datetime.datetime.now(tz=datetime.timezone.utc))
+        last_event_us = 0
+        for t in all_transactions:
             connection_key = get_connection_key(t.database_name, t.username, t.pid)
-            possible_connections = connection_idx_by_key[connection_key]
-            best_match_idx = None
-            for c_idx in possible_connections:
-                # truncate session start time, since query/transaction time is truncated to seconds
-                if (
-                    connection_logs[c_idx].session_initiation_time.replace(microsecond=0)
-                    > t.start_time()
-                ):
-                    break
-                best_match_idx = c_idx
-            if best_match_idx is None:
+            possible_connections = connection_idx_by_key.get(connection_key, ())
+            match = bisect.bisect_right(
+                connection_starts_by_key.get(connection_key, ()), t.start_us()
+            )
+            if match == 0:
                 logger.warning(
                     f"Couldn't find matching connection in {len(possible_connections)} connections for transaction {t}, skipping"
                 )
                 continue
-            connection = connection_logs[best_match_idx]
+            connection = connection_logs[possible_connections[match - 1]]
             connection.transactions.append(t)
             if (
-                connection.session_initiation_time
-                and connection.session_initiation_time < first_event_time
+                connection.session_initiation_us is not None
+                and connection.session_initiation_us < first_event_us
             ):
-                first_event_time = connection.session_initiation_time
-            if connection.disconnection_time and connection.disconnection_time > last_event_time:
-                last_event_time = connection.disconnection_time
+                first_event_us = connection.session_initiation_us
+            if connection.disconnection_us and connection.disconnection_us > last_event_us:
+                last_event_us = connection.disconnection_us
+            queries = t.queries
             if connection.time_interval_between_queries or t.time_interval:
-                for index, sql in enumerate(t.queries[1:]):
-                    prev_sql = t.queries[index]
-                    prev_sql.time_interval = (sql.start_time - prev_sql.end_time).total_seconds()
-            query_count += len(t.queries)
+                for index in range(1, len(queries)):
+                    prev_sql = queries[index - 1]
+                    prev_sql.time_interval = (queries[index].start_us - prev_sql.end_us) / 1e6
+            query_count += len(queries)
         logger.info(f"Found {transaction_count} transactions, {query_count} queries")
+        return (
+            connection_logs,
+            query_count,
+            transaction_count,
+            us_to_datetime(first_event_us),
+            us_to_datetime(last_event_us),
+            total_connections,
+        )
+
+    def amplify_workload(
+        self,
+        connection_logs,
+        query_count,
+        transaction_count,
+        first_event_time,
+        last_event_time,
+        total_connections,
+    ):
+        """Apply amplification_factor to the correlated workload. Done after the prep
+        cache is loaded, so that the cache doesn't depend on the amplification settings."""
+        amplification_factor = int(self.config.get("amplification_factor") or 1)
+        if amplification_factor > 1:
+            # clones are only materialized by the workers, see ConnectionClone
+            connection_logs = amplify_connections(connection_logs, self.config)
+            transaction_count *= amplification_factor
+            query_count *= amplification_factor
+            last_event_us = datetime_to_us(last_event_time) or 0
+            for connection in connection_logs:
+                if connection.disconnection_us and connection.disconnection_us > last_event_us:
+                    last_event_us = connection.disconnection_us
+            last_event_time = us_to_datetime(last_event_us)
+            logger.info(
+                f"Replaying {transaction_count} transactions, {query_count} queries after "
+                f"amplification"
+            )
+
         logger.info(
             f"{len(connection_logs)} connections contain transactions and will be replayed "
         )
@@ -274,6 +342,21 @@ class ReplayPrep:
                     raise InvalidFilterException(
                         "'*' can not be used with other filter values filter"
                     )
+                try:
+                    FilterValues(x)
+                except re.error as e:
+                    raise InvalidFilterException(f"Invalid regular expression in filter {f}: {e}")
+
+        try:
+            window_start_us, window_end_us = filter_time_window(normalized_filters)
+        except (TypeError, ValueError) as e:
+            raise InvalidFilterException(f"Invalid start_time or end_time filter: {e}")
+        if (
+            window_start_us is not None
+            and window_end_us is not None
+            and window_start_us >= window_end_us
+        ):
+            raise InvalidFilterException("The start_time filter must be before end_time")
 
         return normalized_filters
 
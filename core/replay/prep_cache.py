@@ -0,0 +1,191 @@
+"""
+prep_cache.py
+====================================
+Cache of the correlated workload built by ReplayPrep, so that replaying the same extract
+several times, e.g. against different cluster configurations, only parses and correlates
+it once. The cached connections, with their transactions and precompiled query plans, are
+pickled to prep_cache_location, a local directory or an s3 location.
+
+A cache entry is keyed by a hash of the contents of the workload files and of every
+setting that changes the result of the correlation, so a changed workload or setting
+never loads a stale entry. Amplification is applied after the cache is loaded, so the
+amplification settings can change between replays of the same entry.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import time
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+from common.aws_service import s3_upload
+
+logger = logging.getLogger("WorkloadReplicatorLogger")
+
+CACHE_VERSION = "1"
+
+# workload files the correlation is built from
+WORKLOAD_FILES = ("SQLs.json.gz", "connections.json", "copy_replacements.csv")
+
+# settings that change the parsed transactions or how they are correlated
+KEY_SETTINGS = (
+    "filters",
+    "time_interval_between_transactions",
+    "time_interval_between_queries",
+    "execute_copy_statements",
+    "execute_unload_statements",
+    "unload_iam_role",
+    "replay_output",
+    "split_multi",
+)
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(location):
+    """Digest of the contents of a local or s3 file, or None if it doesn't exist. Files on
+    s3 aren't downloaded, their ETag and size are used instead."""
+    if location.startswith("s3://"):
+        url = urlparse(location, allow_fragments=False)
+        try:
+            head = boto3.client("s3").head_object(Bucket=url.netloc, Key=url.path.lstrip("/"))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise e
+        return f"{head['ETag'].strip(chr(34))}:{head['ContentLength']}"
+
+    if not os.path.exists(location):
+        return None
+    digest = hashlib.sha256()
+    with open(location, "rb") as data:
+        for chunk in iter(lambda: data.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(config, replay_id):
+    """Hash of the workload contents and the settings the correlation depends on"""
+    workload_location = config["workload_location"].rstrip("/")
+    key = {
+        "version": CACHE_VERSION,
+        "files": {
+            filename: file_digest(f"{workload_location}/{filename}") for filename in WORKLOAD_FILES
+        },
+        "settings": {setting: config.get(setting) for setting in KEY_SETTINGS},
+    }
+    if str(config.get("execute_unload_statements", "")).lower() == "true":
+        # rewritten UNLOAD statements write to a location named after the replay
+        key["replay_id"] = replay_id
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class PrepCache:
+    """One entry of the prep cache"""
+
+    def __init__(self, cache_location, key):
+        self.key = key
+        self.location = f"{cache_location.rstrip('/')}/prep-{key}.pkl.gz"
+
+    @classmethod
+    def from_config(cls, config, replay_id):
+        """Cache entry of the workload and settings of the config, or None if
+        prep_cache_location isn't set"""
+        cache_location = config.get("prep_cache_location")
+        if not cache_location:
+            return None
+        start = time.monotonic()
+        try:
+            cache = cls(cache_location, cache_key(config, replay_id))
+        except ClientError as e:
+            logger.warning(f"Not using the prep cache, unable to read the workload files: {e}")
+            return None
+        logger.debug(f"Hashed the workload in {time.monotonic() - start:.1f} sec")
+        return cache
+
+    def load(self):
+        """The cached result of ReplayPrep.correlate_workload, or None if there is no valid
+        entry"""
+        start = time.monotonic()
+        path = self.location
+        if self.location.startswith("s3://"):
+            path = self._download()
+            if path is None:
+                logger.info(f"No prepared workload in cache at {self.location}")
+                return None
+        elif not os.path.exists(path):
+            logger.info(f"No prepared workload in cache at {self.location}")
+            return None
+
+        try:
+            with gzip.open(path, "rb") as data:
+                entry = pickle.load(data)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable prepared workload {self.location}: {e}")
+            return None
+        finally:
+            if path != self.location:
+                os.remove(path)
+
+        if entry.get("version") != CACHE_VERSION or entry.get("key") != self.key:
+            logger.warning(
+                f"Ignoring prepared workload {self.location}, it doesn't match the workload"
+            )
+            return None
+        logger.info(
+            f"Loaded the prepared workload from {self.location} in "
+            f"{time.monotonic() - start:.1f} sec"
+        )
+        return entry["prepared"]
+
+    def save(self, prepared):
+        """Save the result of ReplayPrep.correlate_workload"""
+        start = time.monotonic()
+        entry = {"version": CACHE_VERSION, "key": self.key, "prepared": prepared}
+        if self.location.startswith("s3://"):
+            handle, path = tempfile.mkstemp(suffix=".pkl.gz")
+            os.close(handle)
+        else:
+            os.makedirs(os.path.dirname(self.location), exist_ok=True)
+            # written next to the entry and renamed, so a partial entry is never loaded
+            path = f"{self.location}.tmp"
+
+        try:
+            # the entry is read and written once per replay, so favour speed over size
+            with gzip.open(path, "wb", compresslevel=1) as data:
+                pickle.dump(entry, data, protocol=pickle.HIGHEST_PROTOCOL)
+            if self.location.startswith("s3://"):
+                url = urlparse(self.location, allow_fragments=False)
+                s3_upload(path, url.netloc, url.path.lstrip("/"))
+            else:
+                os.replace(path, self.location)
+                path = None
+            logger.info(
+                f"Saved the prepared workload to {self.location} in "
+                f"{time.monotonic() - start:.1f} sec"
+            )
+        except Exception as e:
+            logger.warning(f"Unable to save the prepared workload to {self.location}: {e}")
+        finally:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def _download(self):
+        url = urlparse(self.location, allow_fragments=False)
+        handle, path = tempfile.mkstemp(suffix=".pkl.gz")
+        os.close(handle)
+        try:
+            boto3.client("s3").download_file(url.netloc, url.path.lstrip("/"), path)
+        except ClientError as e:
+            os.remove(path)
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                logger.warning(f"Unable to read the prepared workload {self.location}: {e}")
+            return None
+        return path
@@ -13,6 +13,7 @@ from connections_parser import ConnectionLog
 from core.replay.prep import ReplayPrep
 from summarizer import summarize
 from replayer import Replayer
+from stats import lateness_table
 from common.util import (
     cluster_dict,
     is_serverless,
@@ -191,6 +192,7 @@ def main():
                 nlb_nat_dns=config["nlb_nat_dns"],
                 complete=complete,
                 summary=replay_summary,
+                lateness=lateness_table(aggregated_stats),
             )
         except Exception as e:
             logger.error(f"Could not complete replay analysis. {e}")
@@ -1,17 +1,38 @@
+import functools
 import logging
 import multiprocessing
 import os
+import shutil
 import signal
+import tempfile
 import time
 from multiprocessing.managers import SyncManager
 from queue import Full, Empty
 
 from worker import ReplayWorker
-
-from stats import init_stats, collect_stats, display_stats, print_stats
+from async_worker import AsyncReplayWorker
+from partitioner import log_load_preview, partition_connections, write_shards, ShardQueue
+from credential_broker import CredentialBroker
+from metrics_server import MetricsServer
+from scheduler import JobFeeder, ReplayClock, ReplayTimeline
+from statement_trace import merge_traces
+from worker_scaler import WorkerScaler, process_cpu_sec
+
+from stats import (
+    init_stats,
+    collect_stats,
+    display_stats,
+    print_stats,
+    SharedStats,
+    ConnectionCounter,
+    ErrorSpool,
+)
 
 logger = logging.getLogger("WorkloadReplicatorLogger")
 
+# worker implementation used for each value of the replay_engine setting
+REPLAY_ENGINES = {"thread": ReplayWorker, "asyncio": AsyncReplayWorker}
+
 
 # Needs to be in global scope since multiprocessing cannot pickle objects
 def init_manager():
@@ -35,6 +56,7 @@ class Replayer:
                     f"Use the configuration parameter num_workers to change this."
                 )
         self.num_workers = num_workers
+        self.worker_class = REPLAY_ENGINES[self.config.get("replay_engine") or "thread"]
         self.workers = []
 
     def sigint_handler(self, signum, frame):
@@ -54,10 +76,37 @@ class Replayer:
     ):
         manager = SyncManager()
         manager.start(init_manager)
-        """ create a queue for passing jobs to the workers.  the limit will cause
-        put() to block if the queue is full """
-        queue = manager.Queue(maxsize=1000000)
-        logger.debug(f"Running with {self.num_workers} workers")
+        partitioned = self.config.get("job_distribution") == "partitioned"
+        shard_dir = None
+        if partitioned:
+            # hand every worker its own schedule up front instead of passing each job
+            # through the manager
+            strategy = self.config.get("partition_strategy") or "round_robin"
+            shards = partition_connections(connection_logs, self.num_workers, strategy)
+            shard_dir = tempfile.mkdtemp(prefix="replay-shards-")
+            worker_queues = [
+                ShardQueue(path, len(shard))
+                for path, shard in zip(write_shards(shards, shard_dir), shards)
+            ]
+            logger.info(
+                f"Partitioned {len(connection_logs)} connections across {self.num_workers} "
+                f"workers ({strategy}): {[len(shard) for shard in shards]}"
+            )
+            log_load_preview(shards)
+            shard_sizes = [len(shard) for shard in shards]
+            del shards
+            queue = None
+            jobs_pending = None
+        else:
+            # create a queue for passing jobs to the workers.  the limit will cause
+            # put() to block if the queue is full
+            queue = manager.Queue(maxsize=1000000)
+            worker_queues = [queue] * self.num_workers
+            shard_sizes = None
+            # set until the job feeder has queued all connections
+            jobs_pending = manager.Event()
+            jobs_pending.set()
+        logger.debug(f"Running with {self.num_workers} workers ({self.worker_class.__name__})")
 
         # find out how many processes we started with.  This is probably 1, due to the Manager
         initial_processes = len(multiprocessing.active_children())
@@ -66,54 +115,93 @@ class Replayer:
         signal.signal(signal.SIGINT, signal.SIG_IGN)
 
         connection_semaphore = None
-        num_connections = manager.Value(int, 0)
-        peak_connections = manager.Value(int, 0)
         if self.config.get("limit_concurrent_connections"):
             # create an IPC semaphore to limit the total concurrency
             connection_semaphore = manager.Semaphore(
                 self.config.get("limit_concurrent_connections")
             )
 
-        per_process_stats = {}
-        errors = manager.list()
-        for idx in range(self.num_workers):
-            per_process_stats[idx] = manager.dict()
-            init_stats(per_process_stats[idx])
-            replay_worker = ReplayWorker(
+        # warm the credentials of all users before the workers are started, each worker
+        # gets its own copy of the cache
+        credential_broker = CredentialBroker(self.config)
+        credential_broker.prefetch(connection_logs)
+
+        # compress the workload if a replay speed or idle gap limit is configured
+        timeline = ReplayTimeline.from_config(self.config, connection_logs, first_event_time)
+
+        # with adaptive_workers, workers can be added to the shared queue during the replay
+        worker_scaler = None
+        if not partitioned:
+            worker_scaler = WorkerScaler.from_config(self.config, self.num_workers)
+
+        # per worker stats live in shared memory, errors are spooled next to the worker logs
+        shared_stats = SharedStats(
+            self.num_workers,
+            f"core/logs/replay_log-{replay_id}/stats",
+            worker_scaler.max_workers if worker_scaler else None,
+        )
+
+        def start_worker(idx, worker_stats):
+            replay_worker = self.worker_class(
                 idx,
                 replay_start_timestamp,
                 first_event_time,
-                queue,
-                per_process_stats[idx],
+                worker_queues[idx] if partitioned else queue,
+                worker_stats,
                 connection_semaphore,
-                num_connections,
-                peak_connections,
+                ConnectionCounter(worker_stats),
+                None,
                 self.config,
                 len(connection_logs),
-                errors,
+                ErrorSpool(shared_stats.spool_path(idx, "query_errors")),
                 replay_id,
+                credential_broker,
+                timeline,
+                jobs_pending,
             )
             self.workers.append(multiprocessing.Process(target=replay_worker.replay))
             self.workers[-1].start()
 
+        for idx in range(self.num_workers):
+            start_worker(idx, shared_stats.worker(idx))
+
         signal.signal(signal.SIGINT, self.sigint_handler)
 
+        metrics_server = MetricsServer.from_config(
+            self.config,
+            shared_stats,
+            lambda: self.queued_connections(shared_stats, queue, shard_sizes),
+        )
+        if metrics_server is not None:
+            metrics_server.start()
+
         logger.debug(f"Total connections in the connection log: {len(connection_logs)}")
 
-        # add all the jobs to the work queue
-        for idx, connection in enumerate(connection_logs):
-            if not self.put_and_retry(
-                {"job_id": idx, "connection": connection},
-                queue,
-                non_workers=initial_processes,
-            ):
-                break
+        job_feeder = None
+        if not partitioned:
+            # add the jobs to the work queue as they become due, while the stats are
+            # observed below
+            job_feeder = JobFeeder.from_config(
+                connection_logs,
+                lambda job: self.put_and_retry(job, queue, non_workers=initial_processes),
+                ReplayClock.from_config(
+                    replay_start_timestamp, first_event_time, self.config, timeline
+                ),
+                self.config,
+                self.num_workers,
+                jobs_pending,
+            )
+            job_feeder.start()
 
-        # and add one termination "job"/signal for each worker so signal them to exit when
-        # there is no more work
-        for idx in range(self.num_workers):
-            if not self.put_and_retry(False, queue, non_workers=initial_processes):
-                break
+        scale_workers = None
+        if worker_scaler is not None:
+            logger.info(
+                f"Adaptive workers enabled, up to {worker_scaler.max_workers} workers, checked "
+                f"every {worker_scaler.interval_sec:g} sec"
+            )
+            scale_workers = functools.partial(
+                self.scale_workers, worker_scaler, shared_stats, job_feeder, start_worker
+            )
 
         active_processes = len(multiprocessing.active_children()) - initial_processes
         logger.debug("Active processes: {}".format(active_processes))
@@ -126,19 +214,28 @@ class Replayer:
             active_processes,
             cnt,
             initial_processes,
-            num_connections,
-            peak_connections,
-            per_process_stats,
+            shared_stats,
             queue,
             total_queries,
+            metrics_server,
+            scale_workers,
         )
 
+        if job_feeder is not None:
+            job_feeder.stop()
+            job_feeder.join()
+            if job_feeder.jobs_queued < len(connection_logs):
+                logger.error(
+                    f"Only {job_feeder.jobs_queued} of {len(connection_logs)} connections were "
+                    f"queued before the workers exited"
+                )
+
         # cleanup in case of error
         remaining_events = 0
         try:
             # clear out the queue in case of error to prevent broken pipe
             # exceptions from internal Queue thread
-            while not queue.empty():
+            while queue is not None and not queue.empty():
                 remaining_events += 1
                 job = queue.get_nowait()
                 logger.error(f"Could not process connection log - {job.get('connection', '')}")
@@ -147,15 +244,22 @@ class Replayer:
 
         if remaining_events > 0:
             logger.error("Not all jobs processed, replay unsuccessful")
+        for worker in self.workers:
+            worker.join()
         logger.debug("Aggregating stats")
+        per_process_stats = shared_stats.collect()
         aggregated_stats = init_stats({})
         for idx, stat in per_process_stats.items():
             collect_stats(aggregated_stats, stat)
 
         print_stats(per_process_stats)
-        for worker in self.workers:
-            worker.join()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if self.config.get("statement_trace"):
+            merge_traces(replay_id, self.num_workers)
         manager.shutdown()
+        if shard_dir:
+            shutil.rmtree(shard_dir, ignore_errors=True)
         return aggregated_stats
 
     def observe_active_processes(
@@ -163,38 +267,94 @@ class Replayer:
         active_processes,
         cnt,
         initial_processes,
-        num_connections,
-        peak_connections,
-        per_process_stats,
+        shared_stats,
         queue,
         total_queries,
+        metrics_server=None,
+        scale_workers=None,
     ):
+        peak_connections = 0
         while active_processes:
             cnt += 1
             active_processes = len(multiprocessing.active_children()) - initial_processes
             if cnt % 60 == 0:
                 logger.debug(f"Waiting for {active_processes} processes to finish")
-                try:
-                    queue_length = queue.qsize()
-                    logger.debug(f"Queue length: {queue.qsize()}")
-                    logger.debug(f"Remaining connections: {queue_length - len(self.workers)}")
-                except NotImplementedError:
-                    # support for qsize is platform-dependent
-                    logger.debug("Queue length not supported.")
-
-            # aggregate stats across all threads so far
-            try:
-                aggregated_stats = init_stats({})
-                for idx, stat in per_process_stats.items():
-                    collect_stats(aggregated_stats, stat)
-                if cnt % 5 == 0:
-                    display_stats(aggregated_stats, total_queries, peak_connections)
-                    peak_connections.value = num_connections.value
-            except KeyError:
-                logger.debug("No stats to display yet.")
+                if queue is not None:
+                    try:
+                        queue_length = queue.qsize()
+                        logger.debug(f"Queue length: {queue_length}")
+                        logger.debug(f"Remaining connections: {queue_length - len(self.workers)}")
+                    except NotImplementedError:
+                        # support for qsize is platform-dependent
+                        logger.debug("Queue length not supported.")
+
+            # aggregate stats across all workers so far, reading all of them in one pass
+            per_process_stats = shared_stats.snapshot()
+            aggregated_stats = init_stats({})
+            active_connections = 0
+            for idx, stat in per_process_stats.items():
+                collect_stats(aggregated_stats, stat)
+                active_connections += stat["active_connections"]
+            peak_connections = max(peak_connections, active_connections)
+            if metrics_server is not None:
+                metrics_server.peak_connections = max(
+                    metrics_server.peak_connections, active_connections
+                )
+            if cnt % 5 == 0:
+                display_stats(aggregated_stats, total_queries, peak_connections)
+                peak_connections = active_connections
+            if scale_workers is not None:
+                scale_workers()
 
             time.sleep(1)
 
+    def scale_workers(self, worker_scaler, shared_stats, job_feeder, start_worker):
+        """Steer connections away from workers that fall behind and add workers when all of
+        them are busy, see WorkerScaler"""
+        now = time.monotonic()
+        if not worker_scaler.due(now):
+            return
+        snapshot = shared_stats.snapshot()
+        jobs_started = sum(stats["jobs_started"] for stats in snapshot.values())
+        if not job_feeder.is_alive() and jobs_started >= job_feeder.jobs_queued:
+            # every connection is dispatched, the termination signals must reach all workers
+            worker_scaler.release()
+            throttled, spawn = set(), 0
+        else:
+            # workers that already exited have no load to compare
+            alive = {idx for idx, worker in enumerate(self.workers) if worker.is_alive()}
+            cpu_sec = {idx: process_cpu_sec(self.workers[idx].pid) for idx in alive}
+            throttled, spawn = worker_scaler.evaluate(
+                {idx: stats for idx, stats in snapshot.items() if idx in alive}, cpu_sec, now
+            )
+        for idx in range(shared_stats.num_workers):
+            shared_stats.worker(idx)["throttled"] = int(idx in throttled)
+
+        for _ in range(spawn):
+            if shared_stats.num_workers == shared_stats.capacity or not job_feeder.add_worker():
+                break
+            worker_stats = shared_stats.add_worker()
+            idx = shared_stats.num_workers - 1
+            # like the workers started with the replay, leave SIGINT to the parent
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            try:
+                start_worker(idx, worker_stats)
+            finally:
+                signal.signal(signal.SIGINT, self.sigint_handler)
+            self.num_workers = shared_stats.num_workers
+            logger.info(f"Started worker {idx}, {self.num_workers} workers running")
+
+    @staticmethod
+    def queued_connections(shared_stats, queue, shard_sizes):
+        """Connections not yet dispatched, per worker with partitioned job distribution and
+        on the shared job queue otherwise"""
+        if shard_sizes is not None:
+            snapshot = shared_stats.snapshot()
+            return {
+                idx: size - snapshot[idx]["jobs_started"] for idx, size in enumerate(shard_sizes)
+            }
+        return {"shared": queue.qsize()}
+
     @staticmethod
     def put_and_retry(job, queue, timeout=10, non_workers=0):
         """Retry adding to the queue indefinitely until it succeeds. This
@@ -47,12 +47,13 @@ g_stylesheet = styles()
 g_columns = g_stylesheet.get("columns")
 
 
-def pdf_gen(report, summary=None):
+def pdf_gen(report, summary=None, lateness=None):
     """This function formats the summary report using the content from report_content.yaml to populate the paragraphs,
        titles, and headers. The tables are populated via the Report param which has all the dataframes.
 
     @param report: Report object
     @param summary: list, replay summary
+    @param lateness: list, rows of the connection and query lateness table
 
     """
     with open("core/replay/report_content.yaml", "r") as stream:
@@ -91,6 +92,12 @@ def pdf_gen(report, summary=None):
             )
             elems.append(Spacer(0, 5))
 
+        # how late connections and queries started compared to the workload
+        if lateness is not None:
+            elems.append(Paragraph("Replay Scheduling Lateness", style["Heading4"]))
+            elems.append(Table(lateness, hAlign="LEFT", style=g_stylesheet.get("table_style")))
+            elems.append(Spacer(0, 5))
+
         elems.append(Paragraph(docs["report_paragraph"], style["Normal"]))
 
         # glossary section
@@ -181,6 +188,7 @@ def replay_pdf_generator(
     complete=True,
     stats=None,
     summary=None,
+    lateness=None,
 ):
     """End to end data collection, parsing, analysis and pdf generation
 
@@ -198,6 +206,7 @@ def replay_pdf_generator(
     @param complete: bool, complete/incomplete replay run
     @param stats: dict, run details
     @param summary: str list, replay output summary from replay.py
+    @param lateness: list, rows of the connection and query lateness table from replay.py
     """
 
     logger = logging.getLogger("WorkloadReplicatorLogger")
@@ -239,7 +248,7 @@ def replay_pdf_generator(
 
     # generate replay_id_report.pdf and info.json
     logger.info(f"Generating report.")
-    pdf = pdf_gen(report, summary)
+    pdf = pdf_gen(report, summary, lateness)
 
     # upload to s3 and output presigned urls
     try:
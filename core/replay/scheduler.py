@@ -0,0 +1,265 @@
+import asyncio
+import bisect
+import datetime
+import logging
+import threading
+import time
+
+from common.util import datetime_to_us
+
+logger = logging.getLogger("WorkloadReplicatorLogger")
+
+# events due within this many milliseconds are dispatched right away instead of sleeping
+DEFAULT_SCHEDULE_SLACK_MS = 10
+
+# connections are put on the job queue this many seconds before they start, see JobFeeder
+DEFAULT_JOB_LOOKAHEAD_SEC = 30
+
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def preconnect_lead_ns(config):
+    """How long before the start of its session a connection is opened, from the
+    preconnect_lead_ms setting"""
+    return int(float(config.get("preconnect_lead_ms") or 0) * 1_000_000)
+
+
+def timedelta_ns(delta):
+    """Integer nanoseconds of a timedelta, exact to the microsecond"""
+    return (delta // _ONE_MICROSECOND) * 1000
+
+
+class ReplayTimeline:
+    """Maps the time of the workload onto the time of the replay.
+
+    The workload is replayed replay_speed times faster than it was recorded, and every
+    period longer than max_idle_gap_sec in which no connection starts and no query runs
+    is shortened to max_idle_gap_sec before the speed is applied. Gaps between two events
+    that are preserved relative to each other are scaled the same way."""
+
+    def __init__(self, speed=1.0, max_idle_gap_ns=None, idle_gaps=()):
+        self.speed = float(speed)
+        self.max_idle_gap_ns = max_idle_gap_ns
+        # start offset of each collapsed gap and the total time removed before it
+        self.gap_starts = []
+        self.gap_removed_ns = []
+        self.removed_before_ns = [0]
+        for start_ns, end_ns in idle_gaps:
+            self.gap_starts.append(start_ns)
+            self.gap_removed_ns.append(end_ns - start_ns - max_idle_gap_ns)
+            self.removed_before_ns.append(self.removed_before_ns[-1] + self.gap_removed_ns[-1])
+
+    @classmethod
+    def from_config(cls, config, connection_logs, first_event_time):
+        """Timeline for the replay_speed and max_idle_gap_sec settings, or None if the
+        workload is replayed as recorded"""
+        speed = float(config.get("replay_speed") or 1)
+        max_idle_gap_sec = config.get("max_idle_gap_sec")
+        if max_idle_gap_sec == "":
+            max_idle_gap_sec = None
+        if speed == 1 and max_idle_gap_sec is None:
+            return None
+
+        idle_gaps = []
+        max_idle_gap_ns = None
+        if max_idle_gap_sec is not None:
+            max_idle_gap_ns = int(float(max_idle_gap_sec) * 1e9)
+            idle_gaps = find_idle_gaps(connection_logs, first_event_time, max_idle_gap_ns)
+        timeline = cls(speed, max_idle_gap_ns, idle_gaps)
+        logger.info(f"Replaying the workload at {speed:g}x speed")
+        if max_idle_gap_ns is not None:
+            logger.info(
+                f"Collapsing {len(idle_gaps)} idle periods longer than {max_idle_gap_sec} sec, "
+                f"removing {timeline.removed_before_ns[-1] / 1e9:.1f} sec from the workload"
+            )
+        return timeline
+
+    def replay_ns(self, workload_ns):
+        """Offset in the replay of an event workload_ns after the first event"""
+        idx = bisect.bisect_right(self.gap_starts, workload_ns) - 1
+        removed_ns = 0
+        if idx >= 0:
+            into_gap_ns = workload_ns - self.gap_starts[idx] - self.max_idle_gap_ns
+            removed_ns = self.removed_before_ns[idx] + min(
+                self.gap_removed_ns[idx], max(0, into_gap_ns)
+            )
+        return int((workload_ns - removed_ns) / self.speed)
+
+    def gap_ns(self, gap_ns):
+        """Length in the replay of a gap of gap_ns between two events"""
+        if self.max_idle_gap_ns is not None:
+            gap_ns = min(gap_ns, self.max_idle_gap_ns)
+        return int(gap_ns / self.speed)
+
+
+def find_idle_gaps(connection_logs, first_event_time, max_idle_gap_ns):
+    """Periods longer than max_idle_gap_ns without a connection start or a running query,
+    as (start, end) offsets in nanoseconds from the first event"""
+    first_event_us = datetime_to_us(first_event_time)
+    activity = []
+    for connection in connection_logs:
+        if connection.session_initiation_us is not None:
+            start_ns = (connection.session_initiation_us - first_event_us) * 1000
+            activity.append((start_ns, start_ns))
+        # the times of amplified clones are only shifted by query_times_us
+        for start_us, end_us in connection.query_times_us():
+            activity.append(((start_us - first_event_us) * 1000, (end_us - first_event_us) * 1000))
+    activity.sort()
+
+    idle_gaps = []
+    busy_until_ns = None
+    for start_ns, end_ns in activity:
+        if busy_until_ns is not None and start_ns - busy_until_ns > max_idle_gap_ns:
+            idle_gaps.append((busy_until_ns, start_ns))
+        if busy_until_ns is None or end_ns > busy_until_ns:
+            busy_until_ns = end_ns
+    return idle_gaps
+
+
+class ReplayClock:
+    """Replay timeline on the monotonic clock.
+
+    Workload event times, in integer microseconds since the epoch, are converted to integer
+    deadlines in nanoseconds since the start of the replay, and the replay progress is read
+    from time.monotonic_ns(), so waits are neither affected by wall clock adjustments nor
+    accumulate float rounding errors. Every wait targets an absolute deadline, so a late
+    event doesn't shift the events after it.
+    The clock is anchored to replay_start once, when it is created."""
+
+    def __init__(self, replay_start, first_event_time, slack_ms=None, timeline=None):
+        self.first_event_us = datetime_to_us(first_event_time)
+        self.timeline = timeline
+        if slack_ms is None:
+            slack_ms = DEFAULT_SCHEDULE_SLACK_MS
+        self.slack_ns = int(float(slack_ms) * 1_000_000)
+        elapsed = datetime.datetime.now(tz=replay_start.tzinfo) - replay_start
+        self.start_ns = time.monotonic_ns() - timedelta_ns(elapsed)
+
+    @classmethod
+    def from_config(cls, replay_start, first_event_time, config, timeline=None):
+        return cls(replay_start, first_event_time, config.get("schedule_slack_ms"), timeline)
+
+    @property
+    def slack_sec(self):
+        return self.slack_ns / 1e9
+
+    def elapsed_ns(self):
+        """Nanoseconds since the start of the replay"""
+        return time.monotonic_ns() - self.start_ns
+
+    def deadline_ns(self, event_us):
+        """Deadline of a workload event at event_us microseconds since the epoch, in
+        nanoseconds since the start of the replay"""
+        workload_ns = (event_us - self.first_event_us) * 1000
+        if self.timeline is None:
+            return workload_ns
+        return self.timeline.replay_ns(workload_ns)
+
+    def gap_ns(self, gap_ns):
+        """Length in the replay of a recorded gap between two events"""
+        if self.timeline is None:
+            return gap_ns
+        return self.timeline.gap_ns(gap_ns)
+
+    def after_ns(self, delay_sec):
+        """Deadline delay_sec from now, to preserve a recorded gap between two events"""
+        return self.elapsed_ns() + self.gap_ns(int(delay_sec * 1e9))
+
+    def remaining_sec(self, deadline_ns):
+        """Seconds until the deadline, negative if it has passed"""
+        return (deadline_ns - self.elapsed_ns()) / 1e9
+
+    def is_late(self, lateness_sec):
+        return lateness_sec > self.slack_sec
+
+    def wait_until(self, deadline_ns):
+        """Sleep until the deadline unless it is due within the slack. Returns the
+        lateness in seconds, i.e. how long after the deadline the caller woke up."""
+        remaining_ns = deadline_ns - self.elapsed_ns()
+        if remaining_ns > self.slack_ns:
+            time.sleep(remaining_ns / 1e9)
+        return (self.elapsed_ns() - deadline_ns) / 1e9
+
+    async def wait_until_async(self, deadline_ns):
+        """Same as wait_until, on the running event loop"""
+        remaining_ns = deadline_ns - self.elapsed_ns()
+        if remaining_ns > self.slack_ns:
+            await asyncio.sleep(remaining_ns / 1e9)
+        return (self.elapsed_ns() - deadline_ns) / 1e9
+
+
+class JobFeeder(threading.Thread):
+    """Feeds the shared job queue in the parent process.
+
+    Jobs are put on the queue in start order, each only once its connection starts within
+    lookahead_sec, followed by one termination signal per worker. Workers only ever hold
+    connections that are about to start, and whichever worker is free picks up the next
+    one, instead of every job being queued, and held by a sleeping worker, from the start
+    of the replay. put(job) adds a job to the queue and returns False if the replay is
+    over, which stops the feeder. pending, if given, is an event that is cleared once the
+    feeder is done, so that workers don't give up on an empty queue before that."""
+
+    def __init__(self, connection_logs, put, clock, lookahead_sec, num_workers, pending=None):
+        super().__init__(name="job-feeder", daemon=True)
+        self.connection_logs = connection_logs
+        self.put = put
+        self.clock = clock
+        self.lookahead_ns = None if lookahead_sec is None else int(float(lookahead_sec) * 1e9)
+        self.num_workers = num_workers
+        self.pending = pending
+        self.jobs_queued = 0
+        self.stopped = threading.Event()
+        # guards num_workers, which grows when workers are added during the replay
+        self.lock = threading.Lock()
+        self.signaled = False
+
+    @classmethod
+    def from_config(cls, connection_logs, put, clock, config, num_workers, pending=None):
+        lookahead_sec = config.get("job_lookahead_sec", DEFAULT_JOB_LOOKAHEAD_SEC)
+        if lookahead_sec == "":
+            lookahead_sec = None
+        if lookahead_sec is not None:
+            # workers dispatch connections that are opened early ahead of their session
+            lookahead_sec = float(lookahead_sec) + preconnect_lead_ns(config) / 1e9
+        return cls(connection_logs, put, clock, lookahead_sec, num_workers, pending)
+
+    def run(self):
+        try:
+            self.feed()
+        finally:
+            if self.pending is not None:
+                self.pending.clear()
+
+    def feed(self):
+        for idx, connection in enumerate(self.connection_logs):
+            if self.lookahead_ns is not None and connection.session_initiation_us is not None:
+                release_ns = self.clock.deadline_ns(connection.session_initiation_us)
+                remaining_sec = self.clock.remaining_sec(release_ns - self.lookahead_ns)
+                if remaining_sec > 0 and self.stopped.wait(remaining_sec):
+                    return
+            if self.stopped.is_set() or not self.put({"job_id": idx, "connection": connection}):
+                return
+            self.jobs_queued += 1
+
+        # one termination signal for each worker, once there is no more work
+        with self.lock:
+            self.signaled = True
+            num_workers = self.num_workers
+        for _ in range(num_workers):
+            if self.stopped.is_set() or not self.put(False):
+                return
+
+    def add_worker(self):
+        """Count a worker started during the replay, so that it gets a termination signal
+        as well, or queue one for it if the feeder already sent them. Returns False if the
+        replay is over."""
+        with self.lock:
+            if self.stopped.is_set():
+                return False
+            if self.signaled:
+                return self.put(False)
+            self.num_workers += 1
+            return True
+
+    def stop(self):
+        self.stopped.set()
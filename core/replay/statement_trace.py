@@ -0,0 +1,169 @@
+"""
+statement_trace.py
+====================================
+Client side trace of every statement the replay executes, enabled with statement_trace.
+Each worker records one row per statement into a preallocated buffer, which is appended to
+a trace file of the worker whenever it fills up and when the worker finishes. The files
+are columnar: every flush writes a chunk holding the row count followed by the values of
+each column in turn. Once the workers are done the parent merges them into a single
+statement_trace.npz with one array per column, in scheduled order, e.g.
+
+    trace = numpy.load("core/logs/replay_log-<replay_id>/statement_trace.npz")
+    latency_ns = trace["end_ns"] - trace["start_ns"]
+
+All times are nanoseconds since the start of the replay, on the replay clock.
+"""
+
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger("WorkloadReplicatorLogger")
+
+TRACE_DTYPE = np.dtype(
+    [
+        ("job_id", "i8"),
+        ("xid", "i8"),  # -1 if the xid isn't numeric
+        ("query_idx", "i4"),
+        ("statement_idx", "i4"),  # index of the statement in a split multi-statement query
+        ("scheduled_ns", "i8"),  # when the query was due
+        ("start_ns", "i8"),
+        ("end_ns", "i8"),
+        ("lateness_ns", "i8"),  # start_ns - scheduled_ns
+        ("rows", "i8"),  # rows reported by the driver, -1 if unknown
+        ("error_code", "S5"),  # SQLSTATE of a failed statement, "ERROR" if it has none
+    ]
+)
+# the merged trace also records the worker of each statement
+MERGED_DTYPE = np.dtype([("worker", "i4")] + TRACE_DTYPE.descr)
+
+DEFAULT_BUFFER_ROWS = 65536
+CHUNK_HEADER = np.dtype("<i8")
+TRACE_FILENAME = "statement_trace.npz"
+
+
+def trace_dir(replay_id):
+    return f"core/logs/replay_log-{replay_id}/trace"
+
+
+def worker_trace_path(replay_id, process_idx):
+    return os.path.join(trace_dir(replay_id), f"worker-{process_idx}-statements.trace")
+
+
+def error_code(err):
+    """SQLSTATE of a driver error, e.g. {'S': 'ERROR', 'C': '42601', ...} raised by
+    redshift_connector"""
+    if err.args and isinstance(err.args[0], dict):
+        return str(err.args[0].get("C", "ERROR"))[:5]
+    return "ERROR"
+
+
+def numeric_xid(xid):
+    try:
+        return int(xid)
+    except (TypeError, ValueError):
+        return -1
+
+
+class StatementTrace:
+    """Trace buffer of one worker, shared by its connection threads"""
+
+    def __init__(self, path, buffer_rows=DEFAULT_BUFFER_ROWS):
+        self.path = path
+        self.buffer = np.zeros(buffer_rows, dtype=TRACE_DTYPE)
+        self.size = 0
+        self.rows_written = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, replay_id, process_idx):
+        """The trace of a worker, or None if statement_trace isn't enabled. Any trace left
+        by an earlier worker with the same path is removed."""
+        if not config.get("statement_trace"):
+            return None
+        path = worker_trace_path(replay_id, process_idx)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        buffer_rows = int(config.get("statement_trace_buffer_rows") or DEFAULT_BUFFER_ROWS)
+        return cls(path, buffer_rows)
+
+    def record(
+        self, job_id, xid, query_idx, statement_idx, scheduled_ns, start_ns, end_ns, rows, code
+    ):
+        with self.lock:
+            if self.size == len(self.buffer):
+                self._flush()
+            self.buffer[self.size] = (
+                job_id,
+                xid,
+                query_idx,
+                statement_idx,
+                scheduled_ns,
+                start_ns,
+                end_ns,
+                start_ns - scheduled_ns,
+                rows,
+                code,
+            )
+            self.size += 1
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.size:
+            return
+        rows = self.buffer[: self.size]
+        with open(self.path, "ab") as f:
+            f.write(np.array(self.size, dtype=CHUNK_HEADER).tobytes())
+            for column in TRACE_DTYPE.names:
+                f.write(np.ascontiguousarray(rows[column]).tobytes())
+        self.rows_written += self.size
+        self.size = 0
+
+
+def read_trace(path):
+    """Rows of a worker trace file, as a structured array of TRACE_DTYPE"""
+    chunks = []
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(CHUNK_HEADER.itemsize)
+            if len(header) < CHUNK_HEADER.itemsize:
+                break
+            size = int(np.frombuffer(header, dtype=CHUNK_HEADER)[0])
+            chunk = np.empty(size, dtype=TRACE_DTYPE)
+            for column in TRACE_DTYPE.names:
+                dtype = TRACE_DTYPE.fields[column][0]
+                chunk[column] = np.frombuffer(f.read(size * dtype.itemsize), dtype=dtype)
+            chunks.append(chunk)
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=TRACE_DTYPE)
+
+
+def merge_traces(replay_id, num_workers):
+    """Merge the trace files of the workers into statement_trace.npz, ordered by scheduled
+    time, and remove them. Returns the merged rows."""
+    parts = []
+    for process_idx in range(num_workers):
+        path = worker_trace_path(replay_id, process_idx)
+        if not os.path.exists(path):
+            continue
+        rows = read_trace(path)
+        part = np.empty(len(rows), dtype=MERGED_DTYPE)
+        part["worker"] = process_idx
+        for column in TRACE_DTYPE.names:
+            part[column] = rows[column]
+        parts.append(part)
+        os.remove(path)
+    if os.path.isdir(trace_dir(replay_id)) and not os.listdir(trace_dir(replay_id)):
+        os.rmdir(trace_dir(replay_id))
+    merged = np.concatenate(parts) if parts else np.empty(0, dtype=MERGED_DTYPE)
+    merged = merged[np.argsort(merged, order=["scheduled_ns", "start_ns"], kind="stable")]
+
+    location = os.path.join(os.path.dirname(trace_dir(replay_id)), TRACE_FILENAME)
+    np.savez(location, **{column: merged[column] for column in MERGED_DTYPE.names})
+    logger.info(f"Saved the trace of {len(merged)} statements to {location}")
+    return merged
@@ -1,7 +1,190 @@
+import bisect
+import json
 import logging
+import multiprocessing
+import os
+import threading
 
 logger = logging.getLogger("WorkloadReplicatorLogger")
 
+# upper bounds in seconds of the buckets of the lateness histograms, on a 1-2-5 log scale.
+# The first bucket counts events that started on time, the last one everything later than
+# the last bound.
+LATENESS_BUCKETS_SEC = (
+    0,
+    0.001,
+    0.002,
+    0.005,
+    0.01,
+    0.02,
+    0.05,
+    0.1,
+    0.2,
+    0.5,
+    1,
+    2,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+def histogram_slots(name):
+    """Stats holding the bucket counts of a lateness histogram"""
+    return tuple(f"{name}_bucket_{idx}" for idx in range(len(LATENESS_BUCKETS_SEC) + 1))
+
+
+QUERY_LATENESS_HISTOGRAM = histogram_slots("query_lateness")
+CONNECTION_LATENESS_HISTOGRAM = histogram_slots("connection_lateness")
+
+# scalar stats kept per worker in shared memory, in slot order
+STAT_SLOTS = (
+    "connection_diff_sec",
+    "transaction_success",
+    "transaction_error",
+    "query_success",
+    "query_error",
+    "multi_statements",
+    "executed_queries",
+    "active_connections",
+    "credential_cache_hits",
+    "credential_cache_misses",
+    "credential_fetches",
+    "credential_fetch_sec",
+    "late_connections",
+    "late_queries",
+    "query_lateness_sec",
+    "max_query_lateness_sec",
+    "connects",
+    "connect_sec",
+    "max_connect_sec",
+    "pool_reuses",
+    "pool_wait_sec",
+    "max_pool_connections",
+    "jobs_started",
+    "connection_lateness_sec",
+    "max_connection_lateness_sec",
+    "dispatch_lag_sec",  # lateness of the connection a worker dispatched last
+    "throttled",  # set by the parent while the worker is steered around, see worker_scaler
+    *QUERY_LATENESS_HISTOGRAM,
+    *CONNECTION_LATENESS_HISTOGRAM,
+)
+# slot of each stat in the row of a worker
+STAT_OFFSETS = {stat: slot for slot, stat in enumerate(STAT_SLOTS)}
+FLOAT_STATS = {
+    "connection_diff_sec",
+    "credential_fetch_sec",
+    "query_lateness_sec",
+    "max_query_lateness_sec",
+    "connect_sec",
+    "max_connect_sec",
+    "pool_wait_sec",
+    "connection_lateness_sec",
+    "max_connection_lateness_sec",
+    "dispatch_lag_sec",
+}
+# counters a connection adds to the SharedStats row of its worker as they change, so the
+# live metrics don't wait for the connection to finish, see ReplayConnection.add_stat
+LIVE_STATS = {
+    "query_success",
+    "query_error",
+    "multi_statements",
+    "executed_queries",
+    "late_queries",
+    "query_lateness_sec",
+    "late_connections",
+    "connection_lateness_sec",
+    *QUERY_LATENESS_HISTOGRAM,
+    *CONNECTION_LATENESS_HISTOGRAM,
+}
+# stats that map a filename to the text of an error, spooled to a file per worker
+ERROR_LOG_STATS = ("connection_error_log", "transaction_error_log")
+
+# guards read-modify-write updates of the shared counters by threads of the same worker
+_counter_lock = threading.Lock()
+# serializes writes to the error spool files by threads of the same worker
+_spool_lock = threading.Lock()
+
+
+def lateness_slot(histogram, lateness_sec):
+    """Slot of the histogram bucket of an event that started lateness_sec late"""
+    return histogram[bisect.bisect_left(LATENESS_BUCKETS_SEC, lateness_sec)]
+
+
+def record_lateness(stats, histogram, lateness_sec):
+    """Count an event that started lateness_sec after its deadline in a histogram"""
+    stats[lateness_slot(histogram, lateness_sec)] += 1
+
+
+def histogram_percentile(stats, histogram, percentile):
+    """Upper bound in seconds of the bucket holding the percentile of a histogram, None
+    for the last bucket, which has no bound, or if the histogram is empty"""
+    counts = [stats.get(slot, 0) for slot in histogram]
+    total = sum(counts)
+    if not total:
+        return None
+    rank = percentile / 100 * total
+    for bound, count in zip(LATENESS_BUCKETS_SEC, counts):
+        rank -= count
+        if rank <= 0:
+            return bound
+    return None
+
+
+def lateness_percentiles(stats, histogram, max_stat):
+    """Number of events, p50, p90 and p99 of a lateness histogram and the maximum lateness,
+    formatted for the replay summary"""
+    events = sum(stats.get(slot, 0) for slot in histogram)
+    max_sec = max(stats.get(max_stat, 0), 0)
+
+    def bound_text(bound):
+        if bound == 0:
+            return "on time"
+        # the maximum is a tighter bound for the percentiles in the last buckets
+        if bound is None or bound > max_sec > 0:
+            bound = max_sec
+        if bound is None or bound == 0:
+            return f"> {LATENESS_BUCKETS_SEC[-1]} sec"
+        return f"<= {bound:.3g} sec"
+
+    return {
+        "events": events,
+        **{
+            f"p{percentile}": bound_text(histogram_percentile(stats, histogram, percentile))
+            for percentile in (50, 90, 99)
+        },
+        "max": f"{max_sec:.3f} sec",
+    }
+
+
+def lateness_table(stats):
+    """Rows of the table of connection and query lateness in the replay report"""
+    rows = [["", "Count", "Late", "p50", "p90", "p99", "Max"]]
+    for label, histogram, max_stat, late_stat in (
+        (
+            "Connections",
+            CONNECTION_LATENESS_HISTOGRAM,
+            "max_connection_lateness_sec",
+            "late_connections",
+        ),
+        ("Queries", QUERY_LATENESS_HISTOGRAM, "max_query_lateness_sec", "late_queries"),
+    ):
+        lateness = lateness_percentiles(stats, histogram, max_stat)
+        if lateness["events"]:
+            rows.append(
+                [
+                    label,
+                    lateness["events"],
+                    stats.get(late_stat, 0),
+                    lateness["p50"],
+                    lateness["p90"],
+                    lateness["p99"],
+                    lateness["max"],
+                ]
+            )
+    return rows if len(rows) > 1 else None
+
 
 def percent(num, den):
     if den == 0:
@@ -22,6 +205,15 @@ def print_stats(stats):
             f"[{process_idx}] Max connection offset: {stats[process_idx].get('connection_diff_sec', 0):+.3f} sec"
         )
     logger.debug(f"Max connection offset: {max_connection_diff:+.3f} sec")
+    for process_idx in stats.keys():
+        lateness = lateness_percentiles(
+            stats[process_idx], QUERY_LATENESS_HISTOGRAM, "max_query_lateness_sec"
+        )
+        if lateness["events"]:
+            logger.debug(
+                f"[{process_idx}] Query lateness p50 {lateness['p50']}, p90 {lateness['p90']}, "
+                f"p99 {lateness['p99']}, max {lateness['max']}"
+            )
 
 
 def display_stats(stats, total_queries, peak_connections):
@@ -33,7 +225,7 @@ def display_stats(stats, total_queries, peak_connections):
     stats_str += "  ["
     stats_str += f"Success: {stats['query_success']} ({percent(stats['query_success'], stats['query_success'] + stats['query_error']):.1f}%), "
     stats_str += f"Failed: {stats['query_error']} ({percent(stats['query_error'], stats['query_success'] + stats['query_error']):.1f}%), "
-    stats_str += f"Peak connections: {peak_connections.value}"
+    stats_str += f"Peak connections: {peak_connections}"
     stats_str += "]"
 
     logger.info(f"{stats_str}")
@@ -50,11 +242,31 @@ def init_stats(stats_dict):
     stats_dict["transaction_error_log"] = {}  # map filename to array of transaction errors
     stats_dict["multi_statements"] = 0
     stats_dict["executed_queries"] = 0  # includes multi-statement queries
+    stats_dict["credential_cache_hits"] = 0
+    stats_dict["credential_cache_misses"] = 0
+    stats_dict["credential_fetches"] = 0
+    stats_dict["credential_fetch_sec"] = 0
+    stats_dict["late_connections"] = 0  # connections started later than the schedule slack
+    stats_dict["late_queries"] = 0  # queries started later than the schedule slack
+    stats_dict["query_lateness_sec"] = 0  # total time queries started after their deadline
+    stats_dict["max_query_lateness_sec"] = 0
+    stats_dict["connects"] = 0  # connections opened to the target cluster
+    stats_dict["connect_sec"] = 0  # total time spent opening them, not part of any query
+    stats_dict["max_connect_sec"] = 0
+    stats_dict["pool_reuses"] = 0  # sessions that borrowed an open connection, see connection_pool
+    stats_dict["pool_wait_sec"] = 0  # total time sessions waited for a pooled connection
+    stats_dict["max_pool_connections"] = 0  # most connections open in the pool of a worker
+    stats_dict["connection_lateness_sec"] = 0  # total time connections started late
+    stats_dict["max_connection_lateness_sec"] = 0
+    # how late connections and queries started, see LATENESS_BUCKETS_SEC
+    for slot in QUERY_LATENESS_HISTOGRAM + CONNECTION_LATENESS_HISTOGRAM:
+        stats_dict[slot] = 0
     return stats_dict
 
 
-def collect_stats(aggregated_stats, stats):
-    """Aggregate the per-thread stats into the overall stats for this aggregated process"""
+def collect_stats(aggregated_stats, stats, exclude=()):
+    """Aggregate the per-thread stats into the overall stats for this aggregated process.
+    Counters in exclude are left out, e.g. the LIVE_STATS a connection already added."""
 
     if not stats:
         return
@@ -70,7 +282,37 @@ def collect_stats(aggregated_stats, stats):
         "query_success",
         "query_error",
     ):
-        aggregated_stats[stat] += stats[stat]
+        if stat not in exclude:
+            aggregated_stats[stat] += stats[stat]
+
+    # credential and lateness stats are absent from stats gathered before they were introduced
+    for stat in (
+        "credential_cache_hits",
+        "credential_cache_misses",
+        "credential_fetches",
+        "credential_fetch_sec",
+        "late_connections",
+        "late_queries",
+        "query_lateness_sec",
+        "connects",
+        "connect_sec",
+        "pool_reuses",
+        "pool_wait_sec",
+        "connection_lateness_sec",
+        *QUERY_LATENESS_HISTOGRAM,
+        *CONNECTION_LATENESS_HISTOGRAM,
+    ):
+        if stat not in exclude:
+            aggregated_stats[stat] = aggregated_stats.get(stat, 0) + stats.get(stat, 0)
+
+    for stat in (
+        "max_query_lateness_sec",
+        "max_connection_lateness_sec",
+        "max_connect_sec",
+        "max_pool_connections",
+    ):
+        if stats.get(stat, 0) > aggregated_stats.get(stat, 0):
+            aggregated_stats[stat] = stats[stat]
 
     # same for arrays.
     for stat in ("transaction_error_log", "connection_error_log"):
@@ -79,3 +321,164 @@ def collect_stats(aggregated_stats, stats):
         new_stats = aggregated_stats[stat]
         new_stats.update(stats[stat])
         aggregated_stats[stat] = new_stats
+
+
+class SharedStats:
+    """Replay stats of all workers, kept in one shared memory array with a row of
+    STAT_SLOTS per worker. It is created by the parent before the workers are started.
+    Each worker only writes its own row, which needs no IPC, and the parent reads all rows
+    in a single pass. Error logs are appended to a spool file per worker instead.
+
+    Rows for up to capacity workers are allocated, so that workers started later in the
+    replay get a row as well. num_workers is the number of rows in use."""
+
+    def __init__(self, num_workers, spool_dir, capacity=None):
+        self.num_workers = num_workers
+        self.capacity = max(capacity or num_workers, num_workers)
+        self.spool_dir = spool_dir
+        self.values = multiprocessing.Array("d", self.capacity * len(STAT_SLOTS), lock=False)
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def spool_path(self, process_idx, name):
+        return os.path.join(self.spool_dir, f"worker-{process_idx}-{name}.jsonl")
+
+    def worker(self, process_idx):
+        return WorkerStats(self, process_idx)
+
+    def add_worker(self):
+        """Row of a worker started during the replay, or None if all rows are in use"""
+        if self.num_workers == self.capacity:
+            return None
+        self.num_workers += 1
+        return self.worker(self.num_workers - 1)
+
+    def active_connections(self):
+        slot = STAT_OFFSETS["active_connections"]
+        return int(sum(self.values[slot :: len(STAT_SLOTS)]))
+
+    def snapshot(self):
+        """Scalar stats of every worker, read in one pass. Error logs are left empty."""
+        values = self.values[:]
+        snapshot = {}
+        for process_idx in range(self.num_workers):
+            row = values[process_idx * len(STAT_SLOTS) : (process_idx + 1) * len(STAT_SLOTS)]
+            snapshot[process_idx] = {
+                stat: value if stat in FLOAT_STATS else int(value)
+                for stat, value in zip(STAT_SLOTS, row)
+            }
+            for stat in ERROR_LOG_STATS:
+                snapshot[process_idx][stat] = {}
+        return snapshot
+
+    def collect(self):
+        """Stats of every worker including the spooled error logs, once workers are done"""
+        stats = self.snapshot()
+        for process_idx, worker_stats in stats.items():
+            path = self.spool_path(process_idx, "errors")
+            if not os.path.exists(path):
+                continue
+            with open(path, "r") as fp:
+                for line in fp:
+                    entry = json.loads(line)
+                    worker_stats[entry["stat"]][entry["key"]] = entry["value"]
+        return stats
+
+
+class WorkerStats:
+    """Dict-like view of one worker's row in SharedStats, so the worker can keep using
+    collect_stats to fold the stats of finished connections into its own stats."""
+
+    def __init__(self, shared_stats, process_idx):
+        self.shared_stats = shared_stats
+        self.process_idx = process_idx
+        self.offset = process_idx * len(STAT_SLOTS)
+        self.error_file = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["error_file"] = None
+        return state
+
+    def __getitem__(self, stat):
+        if stat in ERROR_LOG_STATS:
+            # errors are only appended to the spool file, never read back by the worker
+            return {}
+        value = self.shared_stats.values[self.offset + STAT_OFFSETS[stat]]
+        return value if stat in FLOAT_STATS else int(value)
+
+    def __setitem__(self, stat, value):
+        if stat in ERROR_LOG_STATS:
+            self.spool_errors(stat, value)
+            return
+        self.shared_stats.values[self.offset + STAT_OFFSETS[stat]] = value
+
+    def get(self, stat, default=None):
+        try:
+            return self[stat]
+        except KeyError:
+            return default
+
+    def increment(self, stat, amount=1):
+        with _counter_lock:
+            self.shared_stats.values[self.offset + STAT_OFFSETS[stat]] += amount
+
+    def spool_errors(self, stat, errors):
+        if not errors:
+            return
+        lines = "".join(
+            json.dumps({"stat": stat, "key": key, "value": value}) + "\n"
+            for key, value in errors.items()
+        )
+        with _spool_lock:
+            if self.error_file is None:
+                self.error_file = open(
+                    self.shared_stats.spool_path(self.process_idx, "errors"), "a"
+                )
+            self.error_file.write(lines)
+            self.error_file.flush()
+
+
+class ConnectionCounter:
+    """Counts the open connections of a worker in its SharedStats row. value is the number
+    of connections open across all workers."""
+
+    def __init__(self, worker_stats):
+        self.worker_stats = worker_stats
+
+    @property
+    def value(self):
+        return self.worker_stats.shared_stats.active_connections()
+
+    def increment(self):
+        self.worker_stats.increment("active_connections")
+
+    def decrement(self):
+        self.worker_stats.increment("active_connections", -1)
+
+
+class ErrorSpool:
+    """Append-only spool of the parsed query errors of one worker, one JSON object per
+    line. Takes the place of a Manager list shared by all workers."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["file"] = None
+        return state
+
+    def append(self, error):
+        line = json.dumps(error) + "\n"
+        with _spool_lock:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write(line)
+            self.file.flush()
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r") as fp:
+            return [json.loads(line) for line in fp]
@@ -6,6 +6,11 @@ from tqdm import tqdm
 from boto3 import client
 
 import common.aws_service as aws_service_helper
+from core.replay.stats import (
+    CONNECTION_LATENESS_HISTOGRAM,
+    QUERY_LATENESS_HISTOGRAM,
+    lateness_percentiles,
+)
 
 logger = logging.getLogger("WorkloadReplicatorLogger")
 
@@ -49,6 +54,52 @@ def summarize(
         error_location,
         replay_id,
     )
+    credential_requests = aggregated_stats.get("credential_cache_hits", 0) + aggregated_stats.get(
+        "credential_cache_misses", 0
+    )
+    if credential_requests:
+        fetches = aggregated_stats.get("credential_fetches", 0)
+        avg_fetch_sec = aggregated_stats.get("credential_fetch_sec", 0) / max(fetches, 1)
+        replay_summary.append(
+            f"Credential cache: {aggregated_stats.get('credential_cache_hits', 0)} hits, "
+            f"{aggregated_stats.get('credential_cache_misses', 0)} misses, {fetches} fetches "
+            f"during replay (avg {avg_fetch_sec:.3f} sec)."
+        )
+    replayed_queries = aggregated_stats.get("query_success", 0) + aggregated_stats.get(
+        "query_error", 0
+    )
+    if replayed_queries and "late_queries" in aggregated_stats:
+        avg_lateness_sec = aggregated_stats.get("query_lateness_sec", 0) / replayed_queries
+        replay_summary.append(
+            f"{aggregated_stats['late_queries']} of {replayed_queries} queries and "
+            f"{aggregated_stats.get('late_connections', 0)} connections started late (avg query "
+            f"lateness {avg_lateness_sec:.3f} sec, "
+            f"max {aggregated_stats.get('max_query_lateness_sec', 0):.3f} sec)."
+        )
+    for label, histogram, max_stat in (
+        ("Connection", CONNECTION_LATENESS_HISTOGRAM, "max_connection_lateness_sec"),
+        ("Query", QUERY_LATENESS_HISTOGRAM, "max_query_lateness_sec"),
+    ):
+        lateness = lateness_percentiles(aggregated_stats, histogram, max_stat)
+        if lateness["events"]:
+            replay_summary.append(
+                f"{label} lateness: p50 {lateness['p50']}, p90 {lateness['p90']}, "
+                f"p99 {lateness['p99']}, max {lateness['max']}."
+            )
+    connects = aggregated_stats.get("connects", 0)
+    if connects:
+        replay_summary.append(
+            f"Opened {connects} connections (avg connect time "
+            f"{aggregated_stats.get('connect_sec', 0) / connects:.3f} sec, "
+            f"max {aggregated_stats.get('max_connect_sec', 0):.3f} sec)."
+        )
+    if config.get("connection_pool"):
+        replay_summary.append(
+            f"Connection pool: {aggregated_stats.get('pool_reuses', 0)} sessions reused an open "
+            f"connection, {aggregated_stats.get('pool_wait_sec', 0):.3f} sec waiting for a free "
+            f"connection, up to {aggregated_stats.get('max_pool_connections', 0)} connections "
+            f"open per worker."
+        )
     replay_summary.append(f"Replay finished in {replay_end_time - replay_start_timestamp}.")
     for line in replay_summary:
         logger.info(line)
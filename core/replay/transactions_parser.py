@@ -1,59 +1,158 @@
+import collections
+import contextlib
 import gzip
+import heapq
 import io
+import itertools
 import json
 import logging
+import multiprocessing
 import random
 import string
 import sys
 from urllib.parse import urlparse
 
 import boto3
-import dateutil.parser
 import re
+import sqlparse
 
 from core.replay.copy_replacements_parser import parse_copy_replacements
-from common.util import matches_filters, get_connection_key, logger
+from common.util import (
+    compile_filters,
+    filter_time_window,
+    in_time_window,
+    get_connection_key,
+    intern_str,
+    logger,
+    datetime_to_us,
+    parse_timestamp_us,
+    us_to_datetime,
+)
 
 logger = logging.getLogger("WorkloadReplicatorLogger")
 
+# transactions parsed at a time by each process of TransactionsParser.parse_in_processes
+PARSE_CHUNK_SIZE = 5000
+
 
 class TransactionsParser:
-    def __init__(self, config, replay_id):
+    def __init__(self, config, replay_id, store=None):
         self.config = config
+        self.store = store  # WorkloadStore, if the workload has one
         self.workload_directory = config["workload_location"]
         self.filters = config["filters"]
         self.execute_copy_statements = config.get("execute_copy_statements", "")
         self.execute_unload_statements = config.get("execute_unload_statements", "")
         self.replay_id = replay_id
+        # the filters are applied to the transactions in SQLs.json.gz before they are parsed
+        self.matches_filters = compile_filters(
+            self.filters, {"database_name": "db", "username": "user"}
+        )
+        self.window_start_us, self.window_end_us = filter_time_window(self.filters)
+        # distinct query texts and their statements, shared by all queries with the same
+        # text, see compile_query
+        self.texts = {}
+        self.statements = {}
 
     def parse_transactions(self):
-        transactions = []
         gz_path = self.workload_directory.rstrip("/") + "/SQLs.json.gz"
 
         replacements = []
         if self.execute_copy_statements.lower() == "true":
             replacements = parse_copy_replacements(self.workload_directory)
 
-        sql_json = retrieve_compressed_json(gz_path)
-        for xid, transaction_dict in sql_json["transactions"].items():
+        # transactions are read one at a time rather than loading the whole json tree
+        if self.store is not None:
+            transaction_dicts = self.store.transactions(self.filters)
+        else:
+            transaction_dicts = iter_compressed_transactions(gz_path)
+
+        processes = get_parse_processes(self.config)
+        if processes > 1:
+            transactions = self.parse_in_processes(transaction_dicts, replacements, processes)
+        else:
+            transactions = self.parse_chunk(transaction_dicts, replacements)
+        self.texts = {}
+        self.statements = {}
+
+        return transactions
+
+    def parse_chunk(self, transaction_dicts, replacements):
+        """Parse the transactions that match the filters, sorted by start time and xid"""
+        transactions = []
+        has_time_window = self.window_start_us is not None or self.window_end_us is not None
+        for transaction_dict in transaction_dicts:
+            if not self.matches_filters(transaction_dict):
+                continue
+            if has_time_window:
+                start_us = transaction_dict_start_us(transaction_dict)
+                if not in_time_window(
+                    start_us, start_us, self.window_start_us, self.window_end_us
+                ):
+                    continue
             transaction = self.parse_transaction(transaction_dict, replacements)
-            if transaction.start_time() and matches_filters(transaction, self.filters):
+            if transaction.start_us() is not None:
                 transactions.append(transaction)
+        transactions.sort(key=transaction_order)
+        return transactions
 
-        transactions.sort(key=lambda txn: (txn.start_time(), txn.xid))
+    def parse_in_processes(self, transaction_dicts, replacements, processes):
+        """Parse chunks of PARSE_CHUNK_SIZE transactions in a pool of processes. Each chunk
+        is sorted by the process that parses it, and the sorted chunks are merged in the
+        order they were read, which gives the same order as parsing them in one process."""
+        chunks = iter_chunks(transaction_dicts, PARSE_CHUNK_SIZE)
+        first_chunk = next(chunks, [])
+        second_chunk = next(chunks, None)
+        if second_chunk is None:
+            # not worth starting the processes for a single chunk
+            return self.parse_chunk(first_chunk, replacements)
+
+        logger.info(f"Parsing transactions in {processes} processes")
+        parsed_chunks = []
+        pending = collections.deque()
+        with multiprocessing.Pool(
+            processes,
+            initializer=init_parse_process,
+            initargs=(self.config, self.replay_id, replacements),
+        ) as pool:
+            try:
+                for chunk in itertools.chain((first_chunk, second_chunk), chunks):
+                    pending.append(pool.apply_async(parse_chunk, (chunk,)))
+                    # bound the number of transactions read ahead of the processes
+                    if len(pending) > 2 * processes:
+                        parsed_chunks.append(pending.popleft().get())
+                while pending:
+                    parsed_chunks.append(pending.popleft().get())
+            except ParseProcessExit as e:
+                sys.exit(e.code)
 
+        transactions = []
+        for transaction in heapq.merge(*parsed_chunks, key=transaction_order):
+            self.share_texts(transaction)
+            transactions.append(transaction)
         return transactions
 
+    def share_texts(self, transaction):
+        """Share the texts and statements of queries parsed in other processes with the
+        queries parsed before them that have the same text"""
+        for query in transaction.queries:
+            query.text = self.texts.setdefault(query.text, query.text)
+            if query.plan is not None:
+                query.plan.statements = self.statements.setdefault(
+                    query.text, query.plan.statements
+                )
+
     def parse_transaction(self, transaction_dict, replacements):
         queries = []
 
         for q in transaction_dict["queries"]:
-            start_time = dateutil.parser.isoparse(q["record_time"])
+            record_us = parse_timestamp_us(q["record_time"])
+            start_us = record_us
             if q["start_time"] is not None:
-                start_time = dateutil.parser.isoparse(q["start_time"])
-            end_time = dateutil.parser.isoparse(q["record_time"])
+                start_us = parse_timestamp_us(q["start_time"])
+            end_us = record_us
             if q["end_time"] is not None:
-                end_time = dateutil.parser.isoparse(q["end_time"])
+                end_us = parse_timestamp_us(q["end_time"])
             if (
                 self.execute_copy_statements.lower() == "true"
                 and "copy " in q["text"].lower()
@@ -86,20 +185,29 @@ class TransactionsParser:
                     flags=re.IGNORECASE,
                 )
 
-            queries.append(Query(start_time, end_time, q["text"]))
-
-        queries.sort(key=lambda query: query.start_time)
-        transaction_key = get_connection_key(
-            transaction_dict["db"], transaction_dict["user"], transaction_dict["pid"]
-        )
+            text = self.texts.setdefault(q["text"], q["text"])
+            queries.append(Query(start_us, end_us, text))
+
+        queries.sort(key=lambda query: query.start_us)
+        for idx, query in enumerate(queries):
+            query.plan = compile_query(
+                query.text,
+                transaction_dict["xid"],
+                idx,
+                self.config,
+                statement_cache=self.statements,
+            )
+        database_name = intern_str(transaction_dict["db"])
+        username = intern_str(transaction_dict["user"])
+        pid = intern_str(transaction_dict["pid"])
         return Transaction(
             transaction_dict["time_interval"],
-            transaction_dict["db"],
-            transaction_dict["user"],
-            transaction_dict["pid"],
+            database_name,
+            username,
+            pid,
             transaction_dict["xid"],
             queries,
-            transaction_key,
+            intern_str(get_connection_key(database_name, username, pid)),
         )
 
     @staticmethod
@@ -209,7 +317,76 @@ class TransactionsParser:
         return query_text
 
 
+def transaction_dict_start_us(transaction_dict):
+    """Start of a transaction of SQLs.json.gz, without parsing it, or None if it has no
+    queries"""
+    return min(
+        (
+            parse_timestamp_us(q["start_time"] or q["record_time"])
+            for q in transaction_dict["queries"]
+        ),
+        default=None,
+    )
+
+
+def transaction_order(transaction):
+    return transaction.start_us(), transaction.xid
+
+
+def get_parse_processes(config):
+    """Number of processes the workload is parsed in, one if parse_processes isn't set"""
+    return int(config.get("parse_processes") or 1)
+
+
+def iter_chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# parser of each process of TransactionsParser.parse_in_processes
+_process_parser = None
+_process_replacements = None
+
+
+def init_parse_process(config, replay_id, replacements):
+    global _process_parser, _process_replacements
+    _process_parser = TransactionsParser(config, replay_id)
+    _process_replacements = replacements
+    # forked processes inherit the random state, so they would generate the same passwords
+    random.seed()
+
+
+class ParseProcessExit(Exception):
+    """A parse process exited, e.g. for a missing COPY replacement"""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+def parse_chunk(transaction_dicts):
+    try:
+        return _process_parser.parse_chunk(transaction_dicts, _process_replacements)
+    except SystemExit as e:
+        # the pool would replace the process and wait for its result forever
+        raise ParseProcessExit(e.code)
+
+
 class Transaction:
+    __slots__ = (
+        "time_interval",
+        "database_name",
+        "username",
+        "pid",
+        "xid",
+        "queries",
+        "transaction_key",
+    )
+
     def __init__(
         self, time_interval, database_name, username, pid, xid, queries, transaction_key
     ):
@@ -245,6 +422,12 @@ class Transaction:
     def end_time(self):
         return self.queries[-1].end_time
 
+    def start_us(self):
+        return self.queries[0].start_us
+
+    def end_us(self):
+        return self.queries[-1].end_us
+
     def offset_ms(self, replay_start_time):
         return self.queries[0].offset_ms(replay_start_time)
 
@@ -254,11 +437,34 @@ class Transaction:
 
 
 class Query:
+    """A query of the workload. Times are held as integer microseconds since the epoch in
+    start_us and end_us; start_time and end_time are the same times as UTC datetimes."""
+
+    # there is one Query per statement of the workload, so keep them small
+    __slots__ = ("start_us", "end_us", "time_interval", "text", "plan")
+
     def __init__(self, start_time, end_time, text):
         self.start_time = start_time
         self.end_time = end_time
         self.time_interval = 0
         self.text = text
+        self.plan = None  # QueryPlan, see compile_query
+
+    @property
+    def start_time(self):
+        return us_to_datetime(self.start_us)
+
+    @start_time.setter
+    def start_time(self, value):
+        self.start_us = value if isinstance(value, int) else datetime_to_us(value)
+
+    @property
+    def end_time(self):
+        return us_to_datetime(self.end_us)
+
+    @end_time.setter
+    def end_time(self, value):
+        self.end_us = value if isinstance(value, int) else datetime_to_us(value)
 
     def __str__(self):
         return "Start time: %s, End time: %s, Time interval: %s, Text: %s" % (
@@ -269,7 +475,86 @@ class Query:
         )
 
     def offset_ms(self, ref_time):
-        return (self.start_time - ref_time).total_seconds() * 1000.0
+        return (self.start_us - datetime_to_us(ref_time)) / 1000.0
+
+
+# end of the tag comment prefixed to every replayed statement, see QueryPlan
+TAG_SUFFIX = ', "source": "Test-Drive"} */ '
+
+
+class QueryPlan:
+    """How a query is replayed, worked out once when the workload is loaded: the
+    statements it is split into, whether each of them is executed, and the start of the
+    tag comment prefixed to each statement. Only the replay start is added to the comment
+    at execution time."""
+
+    __slots__ = ("statements", "split", "tag_prefix")
+
+    def __init__(self, statements, split, tag_prefix):
+        self.statements = statements  # list of (statement text, execute) tuples
+        self.split = split  # whether split_multi was applied
+        self.tag_prefix = tag_prefix
+
+    def tagged(self, statement, replay_start_tag):
+        """The statement as it is sent to the cluster. replay_start_tag is the JSON
+        encoded replay start time."""
+        return f"{self.tag_prefix}{replay_start_tag}{TAG_SUFFIX}{statement}"
+
+    def map_statements(self, func):
+        """Plan with func applied to the text of every statement"""
+        return QueryPlan(
+            [(func(text), execute) for text, execute in self.statements],
+            self.split,
+            self.tag_prefix,
+        )
+
+
+def should_execute_statement(sql_text, config):
+    """Whether a statement is replayed. COPY and UNLOAD statements are skipped unless
+    enabled in the config."""
+    if sql_text is None:
+        return False
+    lowered = sql_text.lower()
+    copy_from_s3 = "from 's3:" in lowered
+    unload_to_s3 = "to 's3:" in lowered
+    return (
+        (config.get("execute_copy_statements", "") == "true" and copy_from_s3)
+        or (
+            config.get("execute_unload_statements", "") == "true"
+            and unload_to_s3
+            and config["replay_output"] is not None
+        )
+        or (not copy_from_s3 and not unload_to_s3)
+    )
+
+
+def compile_query(text, xid, query_idx, config, should_execute=None, statement_cache=None):
+    """Build the QueryPlan of the query_idx-th query of transaction xid. should_execute
+    defaults to should_execute_statement with the given config. Plans of queries with the
+    same text share their statements through statement_cache, if given, which must only
+    be used with one config."""
+    split = bool(config.get("split_multi", True)) and isinstance(text, str)
+    statements = None
+    if statement_cache is not None:
+        statements = statement_cache.get(text)
+    if statements is None:
+        if should_execute is None:
+            should_execute = lambda sql_text: should_execute_statement(sql_text, config)
+        if split:
+            split_statements = [s for s in sqlparse.split(text) if s != ";"]
+        else:
+            split_statements = [text]
+        statements = [(statement, should_execute(statement)) for statement in split_statements]
+        if statement_cache is not None:
+            statement_cache[text] = statements
+
+    return QueryPlan(statements, split, query_tag_prefix(xid, query_idx))
+
+
+def query_tag_prefix(xid, query_idx):
+    """Start of the tag comment of the query_idx-th query of transaction xid"""
+    # same layout as json.dumps of the tags, up to the replay start
+    return f'/* {{"xid": {json.dumps(xid)}, "query_idx": {query_idx}, "replay_start": '
 
 
 def retrieve_compressed_json(location):
@@ -281,6 +566,119 @@ def retrieve_compressed_json(location):
     return json.loads(json_content)
 
 
+# characters of compressed workload text decoded at a time by iter_compressed_transactions
+STREAM_CHUNK_SIZE = 1 << 20
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+@contextlib.contextmanager
+def open_compressed_stream(location):
+    """Open a gzipped file from the specified location, either local or s3, as a text
+    stream that is decompressed as it is read"""
+    try:
+        if location.startswith("s3://"):
+            url = urlparse(location, allow_fragments=False)
+            s3 = boto3.resource("s3")
+            raw = s3.Object(url.netloc, url.path.lstrip("/")).get()["Body"]
+        else:
+            raw = open(location, "rb")
+    except Exception as e:
+        logger.error(
+            f"Unable to load file from {location}. Does the file exist and do you have correct "
+            f"permissions? {str(e)}"
+        )
+        raise e
+    try:
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode="rb"), encoding="utf-8") as stream:
+            yield stream
+    finally:
+        raw.close()
+
+
+class JsonStreamReader:
+    """Reads json values one at a time from a text stream, holding only the value being
+    decoded and at most chunk_size characters of the stream in memory"""
+
+    def __init__(self, stream, chunk_size=STREAM_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Drop the consumed part of the buffer and read the next chunk"""
+        chunk = self.stream.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+
+    def skip_whitespace(self):
+        while True:
+            self.pos = _JSON_WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return
+            self.fill()
+
+    def expect(self, chars):
+        """Consume the next structural character, which must be one of chars"""
+        self.skip_whitespace()
+        if self.pos >= len(self.buffer):
+            raise ValueError(f"Unexpected end of json stream, expected one of {chars!r}")
+        char = self.buffer[self.pos]
+        if char not in chars:
+            raise ValueError(f"Unexpected {char!r} in json stream, expected one of {chars!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete json value"""
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def keys(self):
+        """Iterate over the keys of the json object at the current position. The value of
+        each key must be consumed, with value() or keys(), before the next key is read."""
+        self.expect("{")
+        self.skip_whitespace()
+        if self.buffer.startswith("}", self.pos):
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+
+def iter_compressed_transactions(location, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the transaction dicts of a gzipped SQLs.json from the specified location,
+    either local or s3, one at a time. Unlike retrieve_compressed_json, the file is never
+    held in memory as a whole."""
+    with open_compressed_stream(location) as stream:
+        reader = JsonStreamReader(stream, chunk_size)
+        for key in reader.keys():
+            if key != "transactions":
+                reader.value()
+                continue
+            for _ in reader.keys():
+                yield reader.value()
+
+
 def load_file(location, decode=False):
     """load a file from s3 or local. decode if the file should be interpreted as text rather than binary"""
     try:
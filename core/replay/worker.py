@@ -1,4 +1,3 @@
-import datetime
 import logging
 import random
 import sys
@@ -8,8 +7,14 @@ import traceback
 from queue import Empty
 
 from common.log import init_logging
+from core.replay.connection_pool import ConnectionPool
 from core.replay.connection_thread import ConnectionThread
-from core.replay.stats import collect_stats, init_stats
+from core.replay.scheduler import ReplayClock, preconnect_lead_ns
+from core.replay.statement_trace import StatementTrace
+from core.replay.stats import LIVE_STATS, WorkerStats, collect_stats, init_stats
+
+# how often a throttled worker checks whether it may take connections again
+THROTTLE_POLL_SEC = 0.1
 
 
 class ReplayWorker:
@@ -29,11 +34,17 @@ class ReplayWorker:
         total_connections,
         error_logger,
         replay_id,
+        credential_broker=None,
+        timeline=None,
+        jobs_pending=None,
     ):
         self.peak_connections = peak_connections
         self.num_connections = num_connections
         self.connection_semaphore = connection_semaphore
         self.worker_stats = worker_stats
+        # connections add LIVE_STATS to a shared worker row as they go, and only the other
+        # stats when they finish
+        self.live_stats = worker_stats if isinstance(worker_stats, WorkerStats) else None
         self.queue = queue
         self.first_event_time = first_event_time
         self.replay_start_time = replay_start_time
@@ -44,21 +55,21 @@ class ReplayWorker:
         self.total_connections = total_connections
         self.error_logger = error_logger
         self.replay_id = replay_id
+        self.credential_broker = credential_broker
+        # set while the job feeder of the parent still has connections to queue
+        self.jobs_pending = jobs_pending
+        self.clock = ReplayClock.from_config(replay_start_time, first_event_time, config, timeline)
+        self.preconnect_lead_ns = preconnect_lead_ns(config)
+        # built in the worker process, see init_worker_resources
+        self.connection_pool = None
+        self.statement_trace = None
 
     def replay(self):
         """Worker process to distribute the work among several processes.  Each
         worker pulls a connection off the queue, waits until its time to start
         it, spawns a thread to execute the actual connection and associated
         transactions, and then repeats."""
-        # Logging needs to be separately initialized so that the worker can log to a separate log file
-        init_logging(
-            f"replay_worker-{self.process_idx}",
-            dir=f"core/logs/replay_log-{self.replay_id}",
-            logger_name="WorkloadReplicatorWorkerLogger",
-            level=self.config.get("log_level", "INFO"),
-            script_type=f"replay worker - {self.process_idx}",
-            log_id=self.replay_id
-        )
+        self.init_worker_logging()
 
         # map thread to stats dict
         connection_threads = {}
@@ -67,81 +78,26 @@ class ReplayWorker:
         threading.current_thread().name = "0"
 
         perf_lock = threading.Lock()
+        self.init_worker_resources()
 
         try:
             # stagger worker startup to not hammer the get_cluster_credentials api
             time.sleep(random.randrange(1, 3))
             self.logger.debug(f"Worker {self.process_idx} ready for jobs")
 
-            # time to block waiting for jobs on the queue
-            timeout_sec = 10
-
-            last_empty_queue_time = None
-
             # get the next job off the queue and wait until its due
             # loop terminates when a False is received over the queue
             while True:
-                try:
-                    if self.connection_semaphore is not None:
-                        self.logger.debug(
-                            f"Checking for connection throttling ({self.num_connections.value} / "
-                            f"{self.config['limit_concurrent_connections']} active connections)"
-                        )
-                        sem_start = time.time()
-                        self.connection_semaphore.acquire()
-                        sem_elapsed = time.time() - sem_start
-                        self.logger.debug(f"Waited {sem_elapsed} sec for semaphore")
-
-                    job = self.queue.get(timeout=timeout_sec)
-                except Empty:
-                    if self.connection_semaphore is not None:
-                        self.connection_semaphore.release()
-
-                    elapsed = (
-                        int(time.time() - last_empty_queue_time) if last_empty_queue_time else 0
-                    )
-                    # take into account the initial timeout
-                    elapsed += timeout_sec
-                    empty_queue_timeout_sec = self.config.get("empty_queue_timeout_sec", 120)
-                    self.logger.debug(
-                        f"No jobs for {elapsed} seconds (timeout {empty_queue_timeout_sec})"
-                    )
-                    # normally processes exit when they get a False on the queue,
-                    # but in case of some error we exit if the queue is empty for some time
-                    if elapsed > empty_queue_timeout_sec:
-                        self.logger.warning(f"Queue empty for {elapsed} sec, exiting")
-                        break
-                    if last_empty_queue_time is None:
-                        last_empty_queue_time = time.time()
-                    continue
-
-                last_empty_queue_time = None
-
-                if job is False:
-                    self.logger.debug("Got termination signal, finishing up.")
+                job = self.next_job()
+                if not job:
                     break
 
                 thread_stats = init_stats({})
 
-                # how much time has elapsed since the replay started
-                time_elapsed_ms = (
-                    datetime.datetime.now(tz=datetime.timezone.utc) - self.replay_start_time
-                ).total_seconds() * 1000.0
-
-                # what is the time offset of this connection job relative to the first event
-                connection_offset_ms = job["connection"].offset_ms(self.first_event_time)
-                delay_sec = (connection_offset_ms - time_elapsed_ms) / 1000.0
-
-                self.logger.debug(
-                    f"Got job {job['job_id'] + 1}, delay {delay_sec:+.3f} sec (extracted connection time: {job['connection'].session_initiation_time})"
-                )
-
-                # if connection time is more than a few ms in the future, sleep until its due.
-                # this is approximate and we use "a few ms" here due to the imprecision of
-                # sleep as well as the time for the remaining code to spawn a thread and actually
-                # make the db connection.
-                if connection_offset_ms - time_elapsed_ms > 10:
-                    time.sleep(delay_sec)
+                # if the connection is due later than the schedule slack, sleep until it's
+                # due. the slack covers the imprecision of sleep as well as the time for the
+                # remaining code to spawn a thread and actually make the db connection.
+                dispatch_lag_sec = self.clock.wait_until(self.job_deadline_ns(job))
 
                 self.logger.debug(
                     f"Starting job {job['job_id'] + 1} (extracted connection time: "
@@ -152,7 +108,8 @@ class ReplayWorker:
                 connection_thread = ConnectionThread(
                     self.process_idx,
                     job["job_id"],
-                    job["connection"],
+                    # amplified clones are only built now, when they are due
+                    job["connection"].materialize(),
                     self.default_interface,
                     self.odbc_driver,
                     self.replay_start_time,
@@ -165,6 +122,11 @@ class ReplayWorker:
                     perf_lock,
                     self.config,
                     self.total_connections,
+                    self.credential_broker,
+                    self.clock,
+                    self.connection_pool,
+                    self.statement_trace,
+                    self.live_stats,
                 )
                 connection_thread.name = f"{job['job_id']}"
                 connection_thread.start()
@@ -173,12 +135,18 @@ class ReplayWorker:
                 self.join_finished_threads(connection_threads, self.worker_stats, wait=False)
 
                 connections_processed += 1
+                # read by the parent for the number of jobs still queued for this worker,
+                # and how far behind it is
+                self.worker_stats["jobs_started"] = connections_processed
+                self.worker_stats["dispatch_lag_sec"] = max(dispatch_lag_sec, 0)
 
             self.logger.debug(f"Waiting for {len(connection_threads)} connections to finish...")
             self.join_finished_threads(connection_threads, self.worker_stats, wait=True)
         except Exception as e:
             self.logger.error(f"Process {self.process_idx} threw exception: {e}")
             self.logger.debug("".join(traceback.format_exception(*sys.exc_info())))
+        finally:
+            self.close_worker_resources()
 
         if connections_processed:
             self.logger.debug(
@@ -187,6 +155,107 @@ class ReplayWorker:
 
         self.logger.debug(f"Process {self.process_idx} finished")
 
+    def live_exclude(self):
+        """Stats the connections already added to the worker stats as they went"""
+        return LIVE_STATS if self.live_stats is not None else ()
+
+    def init_worker_resources(self):
+        """Connection pool and statement trace of the worker, which can't be shared with
+        other processes"""
+        self.connection_pool = ConnectionPool.from_config(self.config, self.num_connections)
+        self.statement_trace = StatementTrace.from_config(
+            self.config, self.replay_id, self.process_idx
+        )
+
+    def close_worker_resources(self):
+        if self.connection_pool is not None:
+            self.connection_pool.close()
+        if self.statement_trace is not None:
+            self.statement_trace.flush()
+            self.logger.debug(f"Traced {self.statement_trace.rows_written} statements")
+
+    def init_worker_logging(self):
+        # Logging needs to be separately initialized so that the worker can log to a separate
+        # log file
+        init_logging(
+            f"replay_worker-{self.process_idx}",
+            dir=f"core/logs/replay_log-{self.replay_id}",
+            logger_name="WorkloadReplicatorWorkerLogger",
+            level=self.config.get("log_level", "INFO"),
+            script_type=f"replay worker - {self.process_idx}",
+            log_id=self.replay_id
+        )
+
+    def next_job(self, timeout_sec=10):
+        """Block until the next job is available on the queue, honoring the connection
+        throttling semaphore. Returns the job, False if a termination signal was received,
+        or None if the queue stayed empty for longer than empty_queue_timeout_sec."""
+        last_empty_queue_time = None
+
+        while True:
+            # with adaptive_workers, the parent steers connections to other workers while
+            # this one is behind
+            if self.worker_stats.get("throttled"):
+                time.sleep(THROTTLE_POLL_SEC)
+                continue
+            try:
+                if self.connection_semaphore is not None:
+                    self.logger.debug(
+                        f"Checking for connection throttling ({self.num_connections.value} / "
+                        f"{self.config['limit_concurrent_connections']} active connections)"
+                    )
+                    sem_start = time.time()
+                    self.connection_semaphore.acquire()
+                    sem_elapsed = time.time() - sem_start
+                    self.logger.debug(f"Waited {sem_elapsed} sec for semaphore")
+
+                job = self.queue.get(timeout=timeout_sec)
+            except Empty:
+                if self.connection_semaphore is not None:
+                    self.connection_semaphore.release()
+
+                # connections are only queued shortly before they start, so the queue is
+                # expected to be empty in quiet periods of the workload
+                if self.jobs_pending is not None and self.jobs_pending.is_set():
+                    last_empty_queue_time = None
+                    continue
+
+                elapsed = int(time.time() - last_empty_queue_time) if last_empty_queue_time else 0
+                # take into account the initial timeout
+                elapsed += timeout_sec
+                empty_queue_timeout_sec = self.config.get("empty_queue_timeout_sec", 120)
+                self.logger.debug(
+                    f"No jobs for {elapsed} seconds (timeout {empty_queue_timeout_sec})"
+                )
+                # normally processes exit when they get a False on the queue,
+                # but in case of some error we exit if the queue is empty for some time
+                if elapsed > empty_queue_timeout_sec:
+                    self.logger.warning(f"Queue empty for {elapsed} sec, exiting")
+                    return None
+                if last_empty_queue_time is None:
+                    last_empty_queue_time = time.time()
+                continue
+
+            if job is False:
+                self.logger.debug("Got termination signal, finishing up.")
+            return job
+
+    def job_deadline_ns(self, job):
+        """Deadline of the connection of this job, in nanoseconds since the start of the
+        replay. With preconnect_lead_ms, that is when the connection is opened, ahead of
+        the start of its session."""
+        deadline_ns = (
+            self.clock.deadline_ns(job["connection"].session_initiation_us)
+            - self.preconnect_lead_ns
+        )
+        delay_sec = self.clock.remaining_sec(deadline_ns)
+
+        self.logger.debug(
+            f"Got job {job['job_id'] + 1}, delay {delay_sec:+.3f} sec (extracted connection "
+            f"time: {job['connection'].session_initiation_time})"
+        )
+        return deadline_ns
+
     def join_finished_threads(self, connection_threads, worker_stats, wait=False):
         # join any finished threads
         finished_threads = []
@@ -194,7 +263,7 @@ class ReplayWorker:
             if not t.is_alive() or wait:
                 self.logger.debug(f"Joining thread {t.connection_log.session_initiation_time}")
                 t.join()
-                collect_stats(worker_stats, connection_threads[t])
+                collect_stats(worker_stats, connection_threads[t], self.live_exclude())
                 finished_threads.append(t)
 
         # remove the joined threads from the list of active ones
@@ -0,0 +1,180 @@
+"""
+worker_scaler.py
+====================================
+Adaptive worker scaling, enabled with adaptive_workers. Every adaptive_interval_sec the
+parent compares the lag and CPU usage of the workers since the last check:
+
+- a worker is behind if it dispatched a connection, or started queries, later than
+  adaptive_lag_threshold_sec after they were due
+- a worker is saturated if it is behind while using at least adaptive_cpu_threshold of a
+  cpu, e.g. because its connection threads contend for the GIL
+- a worker has headroom if it is neither behind nor busy
+
+Saturated workers stop taking connections off the shared job queue while other workers
+have headroom, so the connections not yet dispatched go to the least loaded workers. If
+no worker has headroom, the parent starts another worker process, up to max_workers.
+The lag of a worker is read from its SharedStats row and its CPU time from /proc, so the
+workers do no extra work for it. Where /proc isn't available, lag alone decides.
+"""
+
+import logging
+import os
+
+from core.replay.stats import QUERY_LATENESS_HISTOGRAM, histogram_percentile
+
+logger = logging.getLogger("WorkloadReplicatorLogger")
+
+DEFAULT_LAG_THRESHOLD_SEC = 1
+DEFAULT_CPU_THRESHOLD = 0.8
+DEFAULT_INTERVAL_SEC = 10
+
+
+def process_cpu_sec(pid):
+    """User and system CPU time of a process in seconds, None if it can't be read"""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as fp:
+            # the command name in the second field may contain spaces
+            fields = fp.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class WorkerLoad:
+    """Lag and CPU usage of a worker over the last interval"""
+
+    def __init__(self, lag_sec, cpu, active_connections):
+        self.lag_sec = lag_sec
+        self.cpu = cpu  # cpus used on average, None if unknown
+        self.active_connections = active_connections
+
+    def __repr__(self):
+        cpu = "n/a" if self.cpu is None else f"{self.cpu:.2f}"
+        return f"lag {self.lag_sec:.3f} sec, cpu {cpu}, {self.active_connections} connections"
+
+
+class WorkerScaler:
+    def __init__(
+        self,
+        max_workers,
+        lag_threshold_sec=DEFAULT_LAG_THRESHOLD_SEC,
+        cpu_threshold=DEFAULT_CPU_THRESHOLD,
+        interval_sec=DEFAULT_INTERVAL_SEC,
+    ):
+        self.max_workers = max_workers
+        self.lag_threshold_sec = lag_threshold_sec
+        self.cpu_threshold = cpu_threshold
+        self.interval_sec = interval_sec
+        # snapshot and cpu times of the last check, the baseline of the next one
+        self.last_check = None
+        self.last_snapshot = {}
+        self.last_cpu_sec = {}
+        self.throttled = set()
+
+    @classmethod
+    def from_config(cls, config, num_workers):
+        """The scaler of the replay, or None if adaptive_workers isn't enabled. max_workers
+        defaults to twice the number of cpus."""
+        if not config.get("adaptive_workers"):
+            return None
+        max_workers = int(config.get("max_workers") or 2 * (os.cpu_count() or 2))
+        if max_workers <= num_workers:
+            logger.warning(
+                f"max_workers ({max_workers}) leaves no room to add workers to the "
+                f"{num_workers} started, workers are only steered"
+            )
+
+        def setting(name, default):
+            value = config.get(name)
+            return default if value in (None, "") else float(value)
+
+        return cls(
+            max_workers,
+            setting("adaptive_lag_threshold_sec", DEFAULT_LAG_THRESHOLD_SEC),
+            setting("adaptive_cpu_threshold", DEFAULT_CPU_THRESHOLD),
+            setting("adaptive_interval_sec", DEFAULT_INTERVAL_SEC),
+        )
+
+    def due(self, now):
+        return self.last_check is None or now - self.last_check >= self.interval_sec
+
+    def worker_loads(self, snapshot, cpu_sec, now):
+        """Load of each worker since the last check. Returns None on the first check, which
+        only records the baseline."""
+        elapsed = None if self.last_check is None else now - self.last_check
+        loads = {}
+        for idx, stats in snapshot.items():
+            last = self.last_snapshot.get(idx, {})
+            # the dispatch lag is only current if the worker dispatched since
+            dispatched = stats.get("jobs_started", 0) > last.get("jobs_started", 0)
+            lag_sec = stats.get("dispatch_lag_sec", 0) if dispatched else 0
+            # queries of the connections that finished since the last check
+            recent = {
+                slot: stats.get(slot, 0) - last.get(slot, 0) for slot in QUERY_LATENESS_HISTOGRAM
+            }
+            if sum(recent.values()):
+                p90 = histogram_percentile(recent, QUERY_LATENESS_HISTOGRAM, 90)
+                lag_sec = max(lag_sec, float("inf") if p90 is None else p90)
+
+            cpu = None
+            if elapsed and cpu_sec.get(idx) is not None and idx in self.last_cpu_sec:
+                cpu = (cpu_sec[idx] - self.last_cpu_sec[idx]) / elapsed
+            loads[idx] = WorkerLoad(lag_sec, cpu, stats.get("active_connections", 0))
+
+        first_check = self.last_check is None
+        self.last_check = now
+        self.last_snapshot = snapshot
+        self.last_cpu_sec = {idx: sec for idx, sec in cpu_sec.items() if sec is not None}
+        return None if first_check else loads
+
+    def is_behind(self, load):
+        return load.lag_sec > self.lag_threshold_sec
+
+    def is_busy(self, load):
+        return load.cpu is not None and load.cpu >= self.cpu_threshold
+
+    def is_saturated(self, load):
+        # without its cpu time, a worker that is behind is taken to be saturated
+        return self.is_behind(load) and (load.cpu is None or self.is_busy(load))
+
+    def evaluate(self, snapshot, cpu_sec, now):
+        """Decide which workers stop taking connections and how many workers to add.
+        Returns the set of throttled workers and the number of workers to start."""
+        loads = self.worker_loads(snapshot, cpu_sec, now)
+        if loads is None:
+            return self.throttled, 0
+
+        saturated = {idx for idx, load in loads.items() if self.is_saturated(load)}
+        headroom = {
+            idx
+            for idx, load in loads.items()
+            if not self.is_behind(load) and not self.is_busy(load)
+        }
+        throttled = saturated if headroom else set()
+        for idx in sorted(throttled - self.throttled):
+            logger.info(
+                f"Worker {idx} is behind ({loads[idx]}), steering connections to other workers"
+            )
+        # workers that exited since the last check have no load
+        for idx in sorted((self.throttled - throttled) & loads.keys()):
+            logger.info(f"Worker {idx} takes connections again ({loads[idx]})")
+        self.throttled = throttled
+
+        spawn = 0
+        if saturated and not headroom:
+            spawn = min(len(saturated), self.max_workers - len(loads))
+            if spawn > 0:
+                behind = ", ".join(f"{idx}: {loads[idx]}" for idx in sorted(saturated))
+                logger.info(f"All workers are busy, adding {spawn} worker(s). Behind: {behind}")
+            else:
+                spawn = 0
+                logger.debug(
+                    f"All workers are busy, already running max_workers ({self.max_workers})"
+                )
+        return throttled, spawn
+
+    def release(self):
+        """Let every worker take connections again, once no more are queued"""
+        if self.throttled:
+            logger.debug(f"Releasing throttled workers {sorted(self.throttled)}")
+        self.throttled = set()
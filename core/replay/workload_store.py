@@ -0,0 +1,390 @@
+"""
+workload_store.py
+====================================
+Indexed copy of an extracted workload in a single SQLite file, workload.db, saved next to
+SQLs.json.gz and connections.json. Connections and transactions are indexed by connection
+key, start time, user and database, so a replay reads only the rows that match its filters
+instead of decompressing and parsing the whole workload. The queries of each transaction
+are stored as one compressed blob and are only decoded when the transaction is read.
+
+The store records digests of the SQLs.json.gz and connections.json it was built from. If
+either file changed since, e.g. because the workload was extracted again to the same
+location without saving a store, the replay ignores the stale store and reads the files.
+The size and modification time of local files are recorded as well, so they are only
+hashed again when either changed.
+
+Existing JSON workloads can be converted with:
+
+    python -m core.replay.workload_store <workload_location>
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import zlib
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+from common.aws_service import s3_upload
+from common.util import (
+    FilterValues,
+    filter_time_window,
+    get_connection_key,
+    parse_timestamp_us,
+)
+from core.replay.prep_cache import file_digest
+from core.replay.transactions_parser import (
+    iter_compressed_transactions,
+    load_file,
+    transaction_dict_start_us,
+)
+
+logger = logging.getLogger("WorkloadReplicatorLogger")
+
+STORE_FILENAME = "workload.db"
+STORE_VERSION = "1"
+
+# workload files the store is built from
+SOURCE_FILES = ("SQLs.json.gz", "connections.json")
+
+# fields of the connection and transaction tables that filters can be applied to
+FILTER_FIELDS = ("database_name", "username", "pid")
+
+SCHEMA = """
+CREATE TABLE metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE connections (
+    id INTEGER PRIMARY KEY,
+    connection_key TEXT NOT NULL,
+    database_name TEXT,
+    username TEXT,
+    pid TEXT,
+    start_us INTEGER,
+    connection TEXT NOT NULL
+);
+CREATE TABLE transactions (
+    id INTEGER PRIMARY KEY,
+    xid TEXT NOT NULL,
+    connection_key TEXT NOT NULL,
+    database_name TEXT,
+    username TEXT,
+    pid TEXT,
+    time_interval INTEGER,
+    start_us INTEGER,
+    num_queries INTEGER,
+    queries BLOB NOT NULL
+);
+"""
+
+# created after the rows are inserted, which is much faster than maintaining them
+INDEXES = """
+CREATE INDEX connections_by_key ON connections (connection_key);
+CREATE INDEX connections_by_user ON connections (username, database_name);
+CREATE INDEX connections_by_start ON connections (start_us);
+CREATE INDEX transactions_by_key ON transactions (connection_key, start_us);
+CREATE INDEX transactions_by_user ON transactions (username, database_name);
+CREATE INDEX transactions_by_start ON transactions (start_us, xid);
+"""
+
+
+def filter_clause(filters, table="transactions"):
+    """SQL condition and parameters selecting the rows of the connections or transactions
+    table that can match the filters. Prefix and regular expression filters, and the end
+    of connections, are only checked by the parsers once the rows are read."""
+    if not filters:
+        return "1", []
+    conditions = []
+    params = []
+    for field in FILTER_FIELDS:
+        include = filters.get("include", {}).get(field, ["*"])
+        exclude = filters.get("exclude", {}).get(field, [])
+        if FilterValues(include).is_exact():
+            conditions.append(f"{field} IN ({', '.join('?' * len(include))})")
+            params.extend(str(value) for value in include)
+        exact_values = FilterValues(exclude, wildcard=False).exact
+        exact_exclude = [str(value) for value in exclude if value in exact_values]
+        if exact_exclude:
+            conditions.append(f"{field} NOT IN ({', '.join('?' * len(exact_exclude))})")
+            params.extend(exact_exclude)
+    window_start_us, window_end_us = filter_time_window(filters)
+    if window_end_us is not None:
+        conditions.append("start_us < ?")
+        params.append(window_end_us)
+    if window_start_us is not None and table == "transactions":
+        conditions.append("start_us >= ?")
+        params.append(window_start_us)
+    return " AND ".join(conditions) or "1", params
+
+
+def source_digests(workload_location):
+    """Digests of the workload files at the location, local or s3, see file_digest"""
+    return {
+        filename: file_digest(f"{workload_location.rstrip('/')}/{filename}")
+        for filename in SOURCE_FILES
+    }
+
+
+def source_stats(workload_location):
+    """Size and modification time of the local workload files, empty for s3 locations whose
+    digests don't need the files to be read"""
+    if workload_location.startswith("s3://"):
+        return {}
+    stats = {}
+    for filename in SOURCE_FILES:
+        try:
+            stat = os.stat(f"{workload_location.rstrip('/')}/{filename}")
+        except FileNotFoundError:
+            stats[filename] = None
+            continue
+        stats[filename] = f"{stat.st_size}:{stat.st_mtime_ns}"
+    return stats
+
+
+class WorkloadStoreWriter:
+    """Writes connections and transactions, in the format of connections.json and
+    SQLs.json.gz, to a new workload store"""
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # the file is written once and only used after close(), so skip the journal
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.executescript(SCHEMA)
+        self.num_connections = 0
+        self.num_transactions = 0
+
+    def add_connections(self, connections_json):
+        rows = (
+            (
+                get_connection_key(c.get("database_name"), c.get("username"), c.get("pid")),
+                c.get("database_name"),
+                c.get("username"),
+                c.get("pid"),
+                # malformed connections are kept, and reported when they are parsed
+                parse_timestamp_us(c.get("session_initiation_time"), ignore_offset=True),
+                json.dumps(c, default=str),
+            )
+            for c in connections_json
+        )
+        cursor = self.db.executemany(
+            "INSERT INTO connections (connection_key, database_name, username, pid, start_us, "
+            "connection) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        self.num_connections += cursor.rowcount
+
+    def add_transactions(self, transaction_dicts):
+        rows = (
+            (
+                t["xid"],
+                get_connection_key(t["db"], t["user"], t["pid"]),
+                t["db"],
+                t["user"],
+                t["pid"],
+                bool(t["time_interval"]),
+                transaction_dict_start_us(t),
+                len(t["queries"]),
+                zlib.compress(json.dumps(t["queries"]).encode("utf-8")),
+            )
+            for t in transaction_dicts
+        )
+        cursor = self.db.executemany(
+            "INSERT INTO transactions (xid, connection_key, database_name, username, pid, "
+            "time_interval, start_us, num_queries, queries) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        self.num_transactions += cursor.rowcount
+
+    def close(self, digests=None, stats=None):
+        """Index and save the store. digests and stats are those of the workload files the
+        store is built from, see source_digests and source_stats."""
+        self.db.executescript(INDEXES)
+        self.db.execute("INSERT INTO metadata VALUES ('version', ?)", (STORE_VERSION,))
+        self.db.executemany(
+            "INSERT INTO metadata VALUES (?, ?)",
+            [(f"digest:{filename}", digest) for filename, digest in (digests or {}).items()]
+            + [(f"stat:{filename}", stat) for filename, stat in (stats or {}).items()],
+        )
+        self.db.commit()
+        self.db.close()
+        logger.info(
+            f"Saved {self.num_connections} connections and {self.num_transactions} transactions "
+            f"to workload store {self.path}"
+        )
+
+
+class WorkloadStore:
+    """Read access to a workload store"""
+
+    def __init__(self, path, temporary=False):
+        self.path = path
+        self.temporary = temporary
+        self.db = sqlite3.connect(path)
+        version = self.db.execute("SELECT value FROM metadata WHERE key = 'version'").fetchone()
+        if version is None or version[0] != STORE_VERSION:
+            self.close()
+            raise ValueError(f"Unsupported workload store version {version} in {path}")
+
+    @classmethod
+    def open(cls, workload_location):
+        """Open the workload store of the workload at the specified location, either local
+        or s3. Returns None if the workload has no store, or if its workload files changed
+        since the store was built. Local workload files are only hashed if their size or
+        modification time changed. Stores on s3 are downloaded to a temporary file, which is
+        removed when the store is closed."""
+        location = workload_location.rstrip("/") + "/" + STORE_FILENAME
+        store = cls._open(location)
+        if store is None:
+            return None
+        stats = source_stats(workload_location)
+        if stats and store.stats() == stats:
+            return store
+        try:
+            digests = source_digests(workload_location)
+        except ClientError as e:
+            logger.warning(f"Ignoring {location}, unable to read the workload files: {e}")
+            store.close()
+            return None
+        if store.digests() != digests:
+            logger.warning(
+                f"Ignoring {location}, it doesn't match the SQLs.json.gz and connections.json "
+                f"of the workload. Rebuild it with: python -m core.replay.workload_store "
+                f"{workload_location}"
+            )
+            store.close()
+            return None
+        if stats:
+            # same contents with a new modification time, e.g. copied, don't hash them again
+            store.save_stats(stats)
+        return store
+
+    @classmethod
+    def _open(cls, location):
+        if not location.startswith("s3://"):
+            return cls(location) if os.path.exists(location) else None
+
+        url = urlparse(location, allow_fragments=False)
+        handle, path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        try:
+            boto3.client("s3").download_file(url.netloc, url.path.lstrip("/"), path)
+        except ClientError as e:
+            os.remove(path)
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise e
+        return cls(path, temporary=True)
+
+    def digests(self):
+        """Digests of the workload files the store was built from"""
+        cursor = self.db.execute("SELECT key, value FROM metadata WHERE key LIKE 'digest:%'")
+        return {key[len("digest:") :]: value for key, value in cursor}
+
+    def stats(self):
+        """Size and modification time of the local workload files the store was built from"""
+        cursor = self.db.execute("SELECT key, value FROM metadata WHERE key LIKE 'stat:%'")
+        return {key[len("stat:") :]: value for key, value in cursor}
+
+    def save_stats(self, stats):
+        try:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                [(f"stat:{filename}", stat) for filename, stat in stats.items()],
+            )
+            self.db.commit()
+        except sqlite3.Error as e:
+            # e.g. a read-only location, the files are hashed again next time
+            logger.debug(f"Unable to save the workload file stats to {self.path}: {e}")
+
+    def close(self):
+        self.db.close()
+        if self.temporary:
+            os.remove(self.path)
+
+    def count_connections(self):
+        return self.db.execute("SELECT COUNT(*) FROM connections").fetchone()[0]
+
+    def connections(self, filters=None):
+        """Connections in the format of connections.json that can match the filters"""
+        condition, params = filter_clause(filters, "connections")
+        cursor = self.db.execute(
+            f"SELECT connection FROM connections WHERE {condition} ORDER BY id", params
+        )
+        for (connection,) in cursor:
+            yield json.loads(connection)
+
+    def transactions(self, filters=None):
+        """Transactions in the format of SQLs.json.gz that can match the filters, read one
+        at a time in start time order"""
+        condition, params = filter_clause(filters)
+        yield from self._transactions(f"WHERE {condition} ORDER BY start_us, xid", params)
+
+    def connection_transactions(self, connection_key):
+        """Transactions of one connection key, in start time order"""
+        yield from self._transactions(
+            "WHERE connection_key = ? ORDER BY start_us, xid", [connection_key]
+        )
+
+    def _transactions(self, clause, params):
+        cursor = self.db.execute(
+            "SELECT xid, pid, database_name, username, time_interval, queries FROM transactions "
+            + clause,
+            params,
+        )
+        for xid, pid, database_name, username, time_interval, queries in cursor:
+            yield {
+                "xid": xid,
+                "pid": pid,
+                "db": database_name,
+                "user": username,
+                "time_interval": bool(time_interval),
+                "queries": json.loads(zlib.decompress(queries)),
+            }
+
+
+def convert_workload(workload_location):
+    """Build the workload store of an extracted JSON workload, local or on s3"""
+    workload_location = workload_location.rstrip("/")
+    if workload_location.startswith("s3://"):
+        handle, path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+    else:
+        path = f"{workload_location}/{STORE_FILENAME}"
+
+    writer = WorkloadStoreWriter(path)
+    writer.add_connections(
+        json.loads(load_file(f"{workload_location}/connections.json", decode=True))
+    )
+    writer.add_transactions(iter_compressed_transactions(f"{workload_location}/SQLs.json.gz"))
+    writer.close(source_digests(workload_location), source_stats(workload_location))
+
+    if workload_location.startswith("s3://"):
+        url = urlparse(f"{workload_location}/{STORE_FILENAME}", allow_fragments=False)
+        logger.info(f"Transferring workload store to {url.geturl()}")
+        s3_upload(path, url.netloc, url.path.lstrip("/"))
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the workload store (workload.db) of an extracted workload"
+    )
+    parser.add_argument("workload_location", help="local directory or s3 location of the workload")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    convert_workload(args.workload_location)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import datetime
+import pickle
+import unittest
+
+from core.replay.amplifier import (
+    CLONE_XID_OFFSET,
+    ConnectionClone,
+    amplify_connections,
+    clone_xid,
+    remap_schemas,
+)
+from core.replay.connections_parser import ConnectionLog
+from core.replay.scheduler import find_idle_gaps
+from core.replay.transactions_parser import Query, Transaction, compile_query
+
+start = datetime.datetime(2023, 2, 1, 10, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def get_connection_log(start_sec, pid):
+    connection_log = ConnectionLog(
+        start + datetime.timedelta(seconds=start_sec),
+        start + datetime.timedelta(seconds=start_sec + 10),
+        "dev",
+        "analyst",
+        pid,
+        "",
+        True,
+        "all on",
+        f"dev_analyst_{pid}",
+    )
+    query_time = start + datetime.timedelta(seconds=start_sec + 1)
+    connection_log.transactions = [
+        Transaction(
+            True,
+            "dev",
+            "analyst",
+            pid,
+            "100",
+            [
+                Query(
+                    query_time,
+                    query_time,
+                    "select * from sales.orders join Sales.items using (id);",
+                )
+            ],
+            f"dev_analyst_{pid}",
+        )
+    ]
+    return connection_log
+
+
+class TestAmplifyConnections(unittest.TestCase):
+    def test_no_amplification(self):
+        connection_logs = [get_connection_log(0, "1")]
+        self.assertIs(amplify_connections(connection_logs, {}), connection_logs)
+        self.assertIs(
+            amplify_connections(connection_logs, {"amplification_factor": 1}), connection_logs
+        )
+
+    def test_clones_sorted_by_start_time(self):
+        connection_logs = [get_connection_log(0, "1"), get_connection_log(5, "2")]
+        amplified = amplify_connections(
+            connection_logs,
+            {"amplification_factor": 3, "amplification_jitter_sec": 10, "amplification_seed": 7},
+        )
+        self.assertEqual(len(amplified), 6)
+        self.assertIs(amplified[0], connection_logs[0])
+        start_times = [c.session_initiation_time for c in amplified]
+        self.assertEqual(start_times, sorted(start_times))
+        clones = [c for c in amplified if isinstance(c, ConnectionClone)]
+        self.assertEqual(sorted(c.clone_idx for c in clones), [1, 1, 2, 2])
+        for clone in clones:
+            self.assertLessEqual(clone.time_offset_us, 10_000_000)
+            # unchanged attributes are read from the original
+            self.assertIs(clone.transactions, clone.source.transactions)
+            self.assertEqual(clone.database_name, "dev")
+
+    def test_seeded_jitter_is_repeatable(self):
+        config = {
+            "amplification_factor": 4,
+            "amplification_jitter_sec": 60,
+            "amplification_seed": 1,
+        }
+        first = amplify_connections([get_connection_log(0, "1")], config)
+        second = amplify_connections([get_connection_log(0, "1")], config)
+        self.assertEqual(
+            [c.session_initiation_time for c in first], [c.session_initiation_time for c in second]
+        )
+
+
+class TestConnectionClone(unittest.TestCase):
+    def test_materialize(self):
+        source = get_connection_log(0, "1")
+        clone = ConnectionClone(source, 2, 3_000_000, "analyst_2", {"sales": "sales_2"})
+
+        connection = clone.materialize()
+        self.assertIsInstance(connection, ConnectionLog)
+        self.assertEqual(connection.username, "analyst_2")
+        self.assertEqual(connection.pid, "1-2")
+        self.assertEqual(
+            connection.session_initiation_time,
+            source.session_initiation_time + datetime.timedelta(seconds=3),
+        )
+        transaction = connection.transactions[0]
+        self.assertEqual(transaction.username, "analyst_2")
+        self.assertEqual(
+            transaction.queries[0].start_time,
+            source.transactions[0].queries[0].start_time + datetime.timedelta(seconds=3),
+        )
+        self.assertEqual(
+            transaction.queries[0].text,
+            "select * from sales_2.orders join sales_2.items using (id);",
+        )
+        # the original is left untouched
+        self.assertEqual(source.username, "analyst")
+        self.assertEqual(source.transactions[0].xid, "100")
+        self.assertIn("sales.orders", source.transactions[0].queries[0].text)
+
+    def test_clone_xids_are_distinct(self):
+        source = get_connection_log(0, "1")
+        source.transactions[0].queries[0].plan = compile_query(
+            source.transactions[0].queries[0].text, "100", 0, {}
+        )
+        transactions = [
+            ConnectionClone(source, idx, 0, "analyst").materialize().transactions[0]
+            for idx in (1, 2)
+        ]
+        self.assertEqual(
+            [t.xid for t in transactions],
+            [str(100 + CLONE_XID_OFFSET), str(100 + 2 * CLONE_XID_OFFSET)],
+        )
+        self.assertEqual(
+            len({t.get_base_filename() for t in transactions + source.transactions}), 3
+        )
+        self.assertIn(
+            f'"xid": "{100 + CLONE_XID_OFFSET}"', transactions[0].queries[0].plan.tag_prefix
+        )
+        self.assertIn('"xid": "100"', source.transactions[0].queries[0].plan.tag_prefix)
+        self.assertEqual(clone_xid("abc", 3), "abc-3")
+
+    def test_idle_gaps_use_shifted_query_times(self):
+        source = get_connection_log(0, "1")
+        clone = ConnectionClone(source, 1, 100_000_000, "analyst")
+        self.assertEqual(
+            list(clone.query_times_us()),
+            [
+                (start_us + 100_000_000, end_us + 100_000_000)
+                for start_us, end_us in source.query_times_us()
+            ],
+        )
+        # idle from the query of the original, 1 sec in, to the start of the clone
+        self.assertEqual(
+            find_idle_gaps([source, clone], start, 30_000_000_000),
+            [(1_000_000_000, 100_000_000_000)],
+        )
+
+    def test_original_materializes_to_itself(self):
+        source = get_connection_log(0, "1")
+        self.assertIs(source.materialize(), source)
+
+    def test_pickle(self):
+        clone = ConnectionClone(get_connection_log(0, "1"), 1, 0, "analyst")
+        copy = pickle.loads(pickle.dumps(clone))
+        self.assertEqual(copy.session_initiation_time, clone.session_initiation_time)
+        self.assertEqual(copy.materialize().pid, "1-1")
+
+    def test_remap_schemas(self):
+        self.assertEqual(
+            remap_schemas('select 1 from presales.x, sales . y, "sales".z', {"sales": "s1"}),
+            'select 1 from presales.x, s1 . y, "sales".z',
+        )
+        self.assertEqual(remap_schemas("select 1;", {}), "select 1;")
@@ -0,0 +1,136 @@
+import asyncio
+import datetime
+import unittest
+from unittest.mock import patch, MagicMock, Mock
+
+from core.replay.async_connection import AsyncConnection
+from core.replay.async_worker import AsyncReplayWorker
+from core.replay.connections_parser import ConnectionLog
+from core.replay.stats import init_stats
+from core.replay.transactions_parser import Transaction, Query
+
+config = {
+    "target_cluster_endpoint": "test.redshift.us-east-1.redshift.amazonaws.com:1111/dev",
+    "default_interface": "psql",
+    "odbc_driver": None,
+    "log_level": "info",
+    "replay_engine": "asyncio",
+    "async_executor_threads": 2,
+    "limit_concurrent_connections": 1,
+    "split_multi": False,
+    "execute_copy_statements": "false",
+    "execute_unload_statements": "false",
+    "replay_output": None,
+}
+
+first_event_time = datetime.datetime(2023, 2, 1, 10, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def get_connection_log():
+    connection_log = ConnectionLog(
+        session_initiation_time=first_event_time,
+        disconnection_time=first_event_time + datetime.timedelta(seconds=1),
+        database_name="dev",
+        username="awsuser",
+        pid="13203827",
+        application_name="",
+        time_interval_between_transactions=False,
+        time_interval_between_queries="all off",
+        connection_key="dev_awsuser_13203827",
+    )
+    query = Query(first_event_time, first_event_time, "select 1;")
+    connection_log.transactions = [
+        Transaction(False, "dev", "awsuser", "13203827", "100", [query], "dev_awsuser_13203827")
+    ]
+    return connection_log
+
+
+def get_async_connection(connection_log, thread_stats):
+    return AsyncConnection(
+        0,
+        0,
+        connection_log,
+        "psql",
+        None,
+        # replay started an hour ago, so nothing in this workload needs to wait
+        datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(hours=1),
+        first_event_time,
+        [],
+        thread_stats,
+        MagicMock(),
+        None,
+        None,
+        None,
+        config,
+        1,
+        executor=None,
+    )
+
+
+class TestAsyncReplayWorker(unittest.TestCase):
+    @patch("core.replay.async_worker.random.randrange", lambda a, b: 0)
+    @patch("core.replay.async_worker.AsyncConnection")
+    @patch.object(AsyncReplayWorker, "logger")
+    @patch("core.replay.worker.init_logging")
+    def test_replay_job_present(self, mock_init_logging, mock_log, mock_async_connection):
+        async def run_async():
+            return None
+
+        mock_async_connection.return_value.run_async = run_async
+        mock_queue = MagicMock()
+        mock_queue.get.side_effect = [{"job_id": 0, "connection": get_connection_log()}, False]
+        worker_stats = init_stats({})
+
+        worker = AsyncReplayWorker(
+            0,
+            datetime.datetime.now(tz=datetime.timezone.utc),
+            first_event_time,
+            mock_queue,
+            worker_stats,
+            None,
+            MagicMock(),
+            None,
+            config,
+            1,
+            [],
+            "test_replay_id",
+        )
+        worker.replay()
+
+        self.assertEqual(mock_async_connection.call_count, 1)
+        self.assertEqual(mock_async_connection.call_args.kwargs["executor"]._max_workers, 2)
+        mock_log.debug.assert_any_call("Got termination signal, finishing up.")
+        mock_log.debug.assert_any_call("Waiting for 1 connections to finish...")
+        mock_log.debug.assert_any_call("Process 0 finished")
+
+
+class TestAsyncConnection(unittest.TestCase):
+    @patch("core.replay.connection_thread.ReplayPrep")
+    @patch("core.replay.connection_thread.db_connect")
+    def test_run_async(self, mock_db_connect, mock_replay_prep):
+        mock_connection = Mock()
+        mock_db_connect.return_value = mock_connection
+        thread_stats = init_stats({})
+
+        conn = get_async_connection(get_connection_log(), thread_stats)
+        asyncio.run(conn.run_async())
+
+        mock_connection.cursor.return_value.execute.assert_called_once()
+        mock_connection.commit.assert_called_once()
+        mock_connection.close.assert_called_once()
+        self.assertEqual(thread_stats["query_success"], 1)
+        self.assertEqual(thread_stats["transaction_success"], 1)
+
+    @patch("core.replay.connection_thread.ReplayPrep")
+    @patch("core.replay.connection_thread.db_connect")
+    def test_run_async_connection_error(self, mock_db_connect, mock_replay_prep):
+        mock_db_connect.side_effect = [Exception("Failed to connect")]
+        thread_stats = init_stats({})
+
+        conn = get_async_connection(get_connection_log(), thread_stats)
+        conn.connection_semaphore = Mock()
+        asyncio.run(conn.run_async())
+
+        conn.connection_semaphore.release.assert_called_once()
+        self.assertEqual(len(thread_stats["connection_error_log"]), 1)
+        self.assertEqual(thread_stats["query_success"], 0)
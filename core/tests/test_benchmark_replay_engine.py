@@ -0,0 +1,89 @@
+import unittest
+
+import numpy as np
+
+from core.benchmark.replay_engine import (
+    FakeDriver,
+    Latency,
+    generate_workload,
+    run_benchmark,
+    trace_results,
+)
+from core.replay.statement_trace import MERGED_DTYPE
+
+
+class TestLatency(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(Latency.parse("constant:2").sample_sec(), 0.002)
+        uniform = Latency.parse("uniform:1:3", seed=1)
+        self.assertTrue(all(0.001 <= uniform.sample_sec() <= 0.003 for _ in range(100)))
+        lognormal = Latency.parse("lognormal:5:0.5", seed=1)
+        samples = sorted(lognormal.sample_sec() for _ in range(1001))
+        self.assertAlmostEqual(samples[500], 0.005, delta=0.001)
+        self.assertEqual(str(lognormal), "lognormal:5:0.5")
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            Latency.parse("gamma:5")
+        with self.assertRaises(ValueError):
+            Latency.parse("uniform:5")
+
+    def test_fake_driver_errors(self):
+        driver = FakeDriver(Latency("constant", 0), Latency("constant", 0), error_rate=1)
+        cursor = driver.connect().cursor()
+        with self.assertRaises(Exception) as cm:
+            cursor.execute("select 1;")
+        self.assertEqual(cm.exception.args[0]["C"], "XX000")
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_workload(self):
+        connection_logs, first_event_time, total_queries = generate_workload(10, 5, 2, 3, 100)
+        self.assertEqual(len(connection_logs), 10)
+        self.assertEqual(total_queries, 60)
+        self.assertEqual(connection_logs[0].session_initiation_time, first_event_time)
+        self.assertEqual(
+            connection_logs[5].session_initiation_us - connection_logs[0].session_initiation_us,
+            1_000_000,
+        )
+        queries = [
+            query
+            for transaction in connection_logs[1].transactions
+            for query in transaction.queries
+        ]
+        self.assertEqual(
+            [query.start_us - connection_logs[1].session_initiation_us for query in queries],
+            [100_000 * idx for idx in range(1, 7)],
+        )
+        self.assertIsNotNone(queries[0].plan)
+
+    def test_trace_results(self):
+        trace = np.zeros(4, dtype=MERGED_DTYPE)
+        trace["job_id"] = [0, 0, 1, 2]
+        trace["start_ns"] = [0, 500_000_000, 1_000_000_000, 2_000_000_000]
+        trace["lateness_ns"] = [-1_000, 0, 2_000_000, 4_000_000]
+        results = trace_results(trace)
+        self.assertEqual(results["statements"], 4)
+        self.assertEqual(results["sessions_per_sec"], 1)
+        self.assertEqual(results["statements_per_sec"], 1.5)
+        self.assertEqual(results["max_statement_lateness_ms"], 4)
+        self.assertEqual(results["statement_lateness_ms"]["p50"], 1)
+
+    def test_replay_on_fake_driver(self):
+        # a short end to end replay, to catch engine regressions without a cluster
+        results = run_benchmark(
+            sessions=40,
+            sessions_per_sec=40,
+            transactions=2,
+            statements=2,
+            connect_latency="constant:1",
+            statement_latency="uniform:0:2",
+        )
+        self.assertEqual(results["sessions"], 40)
+        self.assertEqual(results["queries"], 160)
+        self.assertEqual(results["statements"], 160)
+        self.assertEqual(results["query_errors"] + results["connection_errors"], 0)
+        # generous, to only fail when statements are held up by the engine
+        self.assertLess(results["statement_lateness_ms"]["p99"], 1000)
+        self.assertGreater(results["workers_cpu_sec"], 0)
+        self.assertGreater(results["worker_rss_mb"], 0)
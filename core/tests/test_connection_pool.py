@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from core.replay.connection_pool import ConnectionPool, pool_key
+from core.replay.connections_parser import ConnectionLog
+from core.replay.stats import init_stats
+
+key = ("awsuser", "dev")
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_from_config(self):
+        self.assertIsNone(ConnectionPool.from_config({}))
+        pool = ConnectionPool.from_config({"connection_pool": True, "connection_pool_size": "4"})
+        self.assertEqual(pool.max_size, 4)
+        self.assertEqual(pool.reset_statement, "RESET ALL")
+
+    def test_pool_key(self):
+        connection_log = ConnectionLog(None, None, "dev", "IAM:admin", "123")
+        self.assertEqual(pool_key(connection_log, {"master_username": "awsuser"}), key)
+
+    def test_reuses_and_resets_connections(self):
+        num_connections = MagicMock()
+        pool = ConnectionPool(num_connections=num_connections)
+        stats = init_stats({})
+        connect = MagicMock(side_effect=lambda: MagicMock())
+
+        pool.reserve(key, stats)
+        conn = pool.acquire(key, connect, stats)
+        pool.release(key, conn)
+        conn.rollback.assert_called_once()
+        conn.cursor.return_value.execute.assert_called_once_with("RESET ALL")
+
+        pool.reserve(key, stats)
+        self.assertIs(pool.acquire(key, connect, stats), conn)
+        pool.release(key, conn)
+        # other users get their own connections
+        pool.reserve(("other", "dev"), stats)
+        self.assertIsNot(pool.acquire(("other", "dev"), connect, stats), conn)
+
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual(stats["pool_reuses"], 1)
+        self.assertEqual(stats["max_pool_connections"], 2)
+        pool.close()
+        conn.close.assert_called_once()
+        num_connections.decrement.assert_called_once()
+
+    def test_closes_connection_that_fails_to_reset(self):
+        pool = ConnectionPool()
+        stats = init_stats({})
+        conn = MagicMock()
+        conn.rollback.side_effect = Exception("connection lost")
+        pool.reserve(key, stats)
+        pool.acquire(key, lambda: conn, stats)
+        pool.release(key, conn)
+        conn.close.assert_called_once()
+        self.assertEqual(pool.num_open, 0)
+        self.assertEqual(pool.idle[key], [])
+
+    def test_failed_session_isnt_reused(self):
+        pool = ConnectionPool()
+        stats = init_stats({})
+        conn = MagicMock()
+        pool.reserve(key, stats)
+        pool.acquire(key, lambda: conn, stats)
+        pool.release(key, conn, reusable=False)
+        conn.close.assert_called_once()
+        conn.rollback.assert_not_called()
+
+    def test_reserve_waits_for_free_connection(self):
+        pool = ConnectionPool(max_size=1)
+        stats = init_stats({})
+        pool.reserve(key, stats)
+        conn = pool.acquire(key, MagicMock, stats)
+
+        waiter_stats = init_stats({})
+        waiter = threading.Thread(target=pool.reserve, args=(key, waiter_stats))
+        waiter.start()
+        waiter.join(timeout=0.1)
+        self.assertTrue(waiter.is_alive())
+
+        pool.release(key, conn)
+        waiter.join(timeout=1)
+        self.assertFalse(waiter.is_alive())
+        self.assertGreaterEqual(waiter_stats["pool_wait_sec"], 0.1)
+        self.assertIs(pool.acquire(key, MagicMock, waiter_stats), conn)
+
+    def test_release_without_connection_frees_slot(self):
+        pool = ConnectionPool(max_size=1)
+        stats = init_stats({})
+        pool.reserve(key, stats)
+        pool.release(key, None)
+        start = time.perf_counter()
+        pool.reserve(key, stats)
+        self.assertLess(time.perf_counter() - start, 1)
+
+    def test_reserve_async_waits_on_event_loop(self):
+        pool = ConnectionPool(max_size=1)
+        stats = init_stats({})
+        pool.reserve(key, stats)
+        conn = pool.acquire(key, MagicMock, stats)
+
+        async def reserve_while_other_user_proceeds():
+            waiter = asyncio.create_task(pool.reserve_async(key, stats))
+            # a full key doesn't block the loop or the other users of the pool
+            await pool.reserve_async(("other", "dev"), stats)
+            self.assertFalse(waiter.done())
+            # released from a driver thread, like a connection finishing its session
+            await asyncio.get_running_loop().run_in_executor(None, pool.release, key, conn)
+            await asyncio.wait_for(waiter, timeout=1)
+
+        asyncio.run(reserve_while_other_user_proceeds())
+        self.assertEqual(pool.reserved[key], 1)
+        self.assertEqual(pool.waiters, {})
@@ -7,11 +7,19 @@ from core.replay.connection_thread import (
     remove_comments,
     parse_error,
 )
+from core.replay.connection_pool import ConnectionPool
 from core.replay.connections_parser import ConnectionLog
-from core.replay.transactions_parser import Transaction, Query
+from core.replay.metrics_server import render_metrics
+from core.replay.scheduler import ReplayClock
+from core.replay.statement_trace import StatementTrace
+from core.replay.stats import CONNECTION_LATENESS_HISTOGRAM, SharedStats, init_stats
+from core.replay.transactions_parser import Transaction, Query, compile_query
 import datetime
+import tempfile
 import threading
 
+import sqlparse
+
 config_dict = {
     "tag": "",
     "workload_location": "test-location/Edited_10_Extraction_devsaba-sr-test_2023-01-23T09:46:24.784062+00:00",
@@ -97,17 +105,7 @@ def get_connection_thread(connection_log):
             2023, 2, 1, 10, 0, 0, 0, tzinfo=datetime.timezone.utc
         ),
         error_logger="",
-        thread_stats={
-            "connection_diff_sec": 0,
-            "transaction_success": 0,
-            "transaction_error": 0,
-            "query_success": 0,
-            "query_error": 0,
-            "connection_error_log": {},
-            "transaction_error_log": {},
-            "multi_statements": 0,
-            "executed_queries": 0,
-        },
+        thread_stats=init_stats({}),
         num_connections=MagicMock(),
         peak_connections="",
         connection_semaphore=Mock(),
@@ -139,7 +137,6 @@ def get_connection_log(transactions=[], time_interval_between_transactions=True)
 
 
 class TestConnectionThread(unittest.TestCase):
-    @patch("core.replay.connection_thread.current_offset_ms", lambda _: 0.5)
     @patch.object(ConnectionThread, "execute_transactions")
     @patch.object(ConnectionThread, "initiate_connection")
     def test_run_with_connection(
@@ -150,7 +147,6 @@ class TestConnectionThread(unittest.TestCase):
         get_connection_thread(get_connection_log()).run()
         assert mock_execute_transactions.called
 
-    @patch("core.replay.connection_thread.current_offset_ms", lambda _: 0.5)
     @patch.object(ConnectionThread, "execute_transactions")
     @patch.object(ConnectionThread, "initiate_connection")
     def test_run_without_connection(
@@ -160,7 +156,6 @@ class TestConnectionThread(unittest.TestCase):
         get_connection_thread(get_connection_log()).run()
         assert mock_execute_transactions.not_called
 
-    @patch("core.replay.connection_thread.current_offset_ms", lambda _: 0.5)
     @patch.object(ConnectionThread, "initiate_connection")
     def test_run_exception_while_connecting(self, mock_initiate_connection):
         mock_initiate_connection.return_value.__enter__.side_effect = [
@@ -183,6 +178,54 @@ class TestConnectionThread(unittest.TestCase):
         assert c.close.called
         assert conn_thread.connection_semaphore.release.called
         self.assertEqual(conn_thread.thread_stats.get("connection_error_log", None), {})
+        self.assertEqual(conn_thread.thread_stats["connects"], 1)
+        self.assertEqual(
+            conn_thread.thread_stats["max_connect_sec"], conn_thread.thread_stats["connect_sec"]
+        )
+        # the session start is checked when connecting
+        self.assertEqual(conn_thread.thread_stats["late_connections"], 1)
+        # the replay started 15 minutes after the first event
+        self.assertEqual(conn_thread.thread_stats[CONNECTION_LATENESS_HISTOGRAM[-1]], 1)
+        self.assertGreaterEqual(conn_thread.thread_stats["max_connection_lateness_sec"], 900)
+
+    @patch("core.replay.connection_thread.db_connect")
+    @patch("core.replay.connection_thread.ReplayPrep")
+    def test_initiate_connection_from_pool(self, mock_replay_prep, mock_db_connect):
+        mock_replay_prep.get_connection_credentials.return_value = {}
+        mock_db_connect.side_effect = lambda *args, **kwargs: Mock()
+        pool = ConnectionPool()
+        connections = []
+        for _ in range(2):
+            conn_thread = get_connection_thread(get_connection_log())
+            conn_thread.connection_pool = pool
+            conn_thread.reserve_pooled_connection()
+            with conn_thread.initiate_connection("awsuser") as conn:
+                connections.append(conn)
+            # returned to the pool instead of closed
+            conn.close.assert_not_called()
+        self.assertIs(connections[0], connections[1])
+        mock_db_connect.assert_called_once()
+        self.assertEqual(conn_thread.thread_stats["pool_reuses"], 1)
+        self.assertEqual(pool.reserved[("awsuser", "dev")], 0)
+
+    @patch("core.replay.connection_thread.db_connect")
+    @patch("core.replay.connection_thread.ReplayPrep")
+    def test_preconnect_waits_for_session_start(self, mock_replay_prep, mock_db_connect):
+        mock_replay_prep.get_connection_credentials.return_value = {}
+        mock_db_connect.return_value = Mock()
+        conn_thread = get_connection_thread(get_connection_log())
+        conn_thread.config = dict(config_dict, preconnect_lead_ms=250)
+        conn_thread.preconnect_lead_ns = 250_000_000
+        conn_thread.clock = Mock(wraps=conn_thread.clock)
+
+        with conn_thread.initiate_connection("Test") as conn:
+            # the session start is only checked once it is due
+            self.assertEqual(conn_thread.thread_stats["late_connections"], 0)
+            conn_thread.wait_for_session_start()
+        self.assertIsNotNone(conn)
+        conn_thread.clock.wait_until.assert_called_once_with(0)
+        self.assertEqual(conn_thread.thread_stats["connects"], 1)
+        self.assertEqual(conn_thread.thread_stats["late_connections"], 1)
 
     @patch("core.replay.connection_thread.db_connect")
     @patch("core.replay.connection_thread.ReplayPrep")
@@ -198,6 +241,7 @@ class TestConnectionThread(unittest.TestCase):
         self.assertIsNone(c)
         assert conn_thread.connection_semaphore.release.called
         self.assertTrue(len(conn_thread.thread_stats.get("connection_error_log", {})))
+        self.assertEqual(conn_thread.thread_stats["connects"], 0)
 
     @patch("time.sleep")
     @patch.object(ConnectionThread, "execute_transaction")
@@ -258,6 +302,59 @@ class TestConnectionThread(unittest.TestCase):
 
 
 
+    @patch("time.sleep")
+    @patch.object(ConnectionThread, "execute_transactions")
+    @patch.object(ConnectionThread, "initiate_connection")
+    def test_run_waits_until_disconnection_time(
+        self, mock_initiate_connection, mock_execute_transactions, patched_time_sleep
+    ):
+        mock_initiate_connection.return_value.__enter__.return_value = MagicMock()
+        conn_thread = get_connection_thread(get_connection_log())
+        # the session ends 1 sec after the first event, which is 1 sec from now
+        conn_thread.replay_start = datetime.datetime.now(tz=datetime.timezone.utc)
+        conn_thread.first_event_time = conn_thread.connection_log.session_initiation_time
+        conn_thread.clock = ReplayClock.from_config(
+            conn_thread.replay_start, conn_thread.first_event_time, config_dict
+        )
+
+        conn_thread.run()
+        patched_time_sleep.assert_called_once()
+        self.assertLessEqual(patched_time_sleep.call_args[0][0], 1)
+
+    @patch("time.sleep")
+    @patch.object(ConnectionThread, "should_execute_sql", lambda a, b: True)
+    def test_execute_transaction_records_lateness(self, patched_time_sleep):
+        mock_connection = Mock()
+        transactions = get_transactions([query_1])
+        conn_thread = get_connection_thread(get_connection_log(transactions))
+
+        conn_thread.execute_transaction(transactions[0], mock_connection)
+        # the replay started years ago, so the query is long overdue
+        self.assertEqual(conn_thread.thread_stats["late_queries"], 1)
+        self.assertGreater(conn_thread.thread_stats["max_query_lateness_sec"], 3600)
+        patched_time_sleep.assert_not_called()
+
+    @patch.object(ConnectionThread, "should_execute_sql", lambda a, b: True)
+    def test_live_stats_rise_during_connection(self):
+        transactions = get_transactions([query_1, query_3])
+        conn_thread = get_connection_thread(get_connection_log(transactions))
+        with tempfile.TemporaryDirectory() as spool_dir:
+            shared_stats = SharedStats(2, spool_dir)
+            conn_thread.live_stats = shared_stats.worker(1)
+
+            def scrape():
+                return render_metrics(shared_stats.snapshot(), 0, {}).splitlines()
+
+            for idx, query in enumerate(transactions[0].queries):
+                conn_thread.record_query_lateness(0.3)
+                conn_thread.execute_query(transactions[0], idx, query, Mock(), [])
+                # counted while the connection is still running, not when it is joined
+                self.assertIn(f'replay_queries_succeeded_total{{worker="1"}} {idx + 1}', scrape())
+                self.assertIn(
+                    f'replay_query_lateness_seconds_count{{worker="1"}} {idx + 1}', scrape()
+                )
+            self.assertEqual(conn_thread.thread_stats["query_success"], 2)
+
     @patch("time.sleep")
     @patch.object(ConnectionThread, "should_execute_sql", lambda a, b: True)
     def test_execute_transaction_valid_sql_success(
@@ -317,6 +414,50 @@ class TestConnectionThread(unittest.TestCase):
         patched_time_sleep.assert_not_called()
         self.assertFalse(conn_thread.thread_stats.get("query_success"))
 
+    @patch("core.replay.transactions_parser.sqlparse.split", wraps=sqlparse.split)
+    def test_execute_query_uses_plan(self, mock_split):
+        mock_cursor = Mock()
+        transactions = get_transactions([query_1])
+        conn_thread = get_connection_thread(get_connection_log(transactions))
+        query = Query(query_1.start_time, query_1.end_time, "select 1; select 2;")
+        query.plan = compile_query(query.text, "100", 0, {"split_multi": True})
+        mock_split.assert_called_once()
+
+        conn_thread.execute_query(transactions[0], 0, query, mock_cursor, [])
+
+        # no parsing when the query is executed
+        mock_split.assert_called_once()
+        self.assertEqual(mock_cursor.execute.call_count, 2)
+        self.assertTrue(mock_cursor.execute.call_args[0][0].startswith('/* {"xid": "100"'))
+        self.assertEqual(conn_thread.thread_stats["executed_queries"], 2)
+
+    def test_execute_query_records_trace(self):
+        mock_cursor = Mock(rowcount=5)
+        mock_cursor.execute.side_effect = [
+            None,
+            Exception({"S": "ERROR", "C": "42601", "M": "syntax error"}),
+        ]
+        transactions = get_transactions([query_1], xid="100")
+        conn_thread = get_connection_thread(get_connection_log(transactions))
+        conn_thread.error_logger = []
+        conn_thread.statement_trace = StatementTrace("unused", buffer_rows=4)
+        query = Query(query_1.start_time, query_1.end_time, "select 1; select 2;")
+        query.plan = compile_query(query.text, "100", 3, {"split_multi": True})
+
+        conn_thread.execute_query(transactions[0], 3, query, mock_cursor, [], 1_000_000)
+
+        rows = conn_thread.statement_trace.buffer[: conn_thread.statement_trace.size]
+        self.assertEqual(list(rows["xid"]), [100, 100])
+        self.assertEqual(list(rows["query_idx"]), [3, 3])
+        self.assertEqual(list(rows["statement_idx"]), [0, 1])
+        self.assertEqual(list(rows["scheduled_ns"]), [1_000_000, 1_000_000])
+        self.assertEqual(list(rows["rows"]), [5, -1])
+        self.assertEqual(list(rows["error_code"]), [b"", b"42601"])
+        self.assertTrue((rows["end_ns"] >= rows["start_ns"]).all())
+        self.assertEqual(
+            list(rows["lateness_ns"]), list(rows["start_ns"] - rows["scheduled_ns"])
+        )
+
     def test_should_execute_sql_copy_from_s3_in_sql(self):
         connection_thread = get_connection_thread(
             get_connection_log(get_transactions([query_1]))
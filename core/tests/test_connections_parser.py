@@ -1,3 +1,4 @@
+import datetime
 from unittest.mock import patch, mock_open
 import unittest
 from core.replay.connections_parser import parse_connections
@@ -158,3 +159,105 @@ class TestConnectionsParser(unittest.TestCase):
             filters,
         )
         self.assertEqual(total_connections, 0)
+
+    @patch("core.replay.connections_parser.client")
+    @patch("core.replay.connections_parser.json")
+    def test_parse_connections_epoch_microseconds(self, mock_json, mock_client):
+        mock_json.loads.return_value = [
+            {
+                "session_initiation_time": 1673279295313000,
+                "disconnection_time": 1673279295872000,
+                "database_name": "dev",
+                "username": "awsuser",
+                "pid": "1073815778",
+                "application_name": "",
+                "time_interval_between_transactions": True,
+                "time_interval_between_queries": "transaction",
+            }
+        ]
+        mock_client.get_object.return_value = mock_json
+
+        connections, total_connections = parse_connections(
+            "s3://test/extracts/epoch",
+            time_interval_between_transactions,
+            time_interval_between_queries,
+            filters,
+        )
+        self.assertEqual(connections[0].session_initiation_us, 1673279295313000)
+        self.assertEqual(
+            connections[0].session_initiation_time,
+            datetime.datetime(2023, 1, 9, 15, 48, 15, 313000, tzinfo=datetime.timezone.utc),
+        )
+        self.assertEqual(connections[0].to_json()["disconnection_time"], 1673279295872000)
+
+    @patch("core.replay.connections_parser.client")
+    @patch("core.replay.connections_parser.json")
+    def test_parse_connections_shares_identity_fields(self, mock_json, mock_client):
+        mock_json.loads.return_value = [
+            {
+                "session_initiation_time": 1673279295313000 + idx,
+                "disconnection_time": None,
+                "database_name": "".join(["d", "ev"]),
+                "username": "".join(["aws", "user"]),
+                "pid": str(100 + idx),
+                "application_name": None,
+                "time_interval_between_transactions": True,
+                "time_interval_between_queries": "transaction",
+            }
+            for idx in range(2)
+        ]
+        mock_client.get_object.return_value = mock_json
+
+        connections, total_connections = parse_connections(
+            "s3://test/extracts/epoch",
+            time_interval_between_transactions,
+            time_interval_between_queries,
+            filters,
+        )
+        self.assertEqual(total_connections, 2)
+        self.assertIs(connections[0].username, connections[1].username)
+        self.assertIs(connections[0].database_name, connections[1].database_name)
+        self.assertIsNone(connections[0].application_name)
+
+    @patch("core.replay.connections_parser.client")
+    @patch("core.replay.connections_parser.json")
+    def test_parse_connections_filters_before_parsing(self, mock_json, mock_client):
+        def get_connection(username, start_sec, end_sec):
+            return {
+                # unparseable times are never read for connections that are filtered out
+                "session_initiation_time": 1673279295000000 + start_sec * 1_000_000
+                if username.startswith("etl")
+                else "not a time",
+                "disconnection_time": 1673279295000000 + end_sec * 1_000_000,
+                "database_name": "dev",
+                "username": username,
+                "pid": "100",
+                "application_name": "",
+                "time_interval_between_transactions": True,
+                "time_interval_between_queries": "transaction",
+            }
+
+        mock_json.loads.return_value = [
+            get_connection("etl_1", 0, 10),
+            get_connection("etl_2", 20, 30),
+            get_connection("etl_3", 40, 50),
+            get_connection("bi", 20, 30),
+        ]
+        mock_client.get_object.return_value = mock_json
+        window_filters = {
+            "include": dict(filters["include"], username=["etl_*"]),
+            "exclude": filters["exclude"],
+            "start_time": "2023-01-09T15:48:26+00:00",
+            "end_time": "2023-01-09T15:48:55+00:00",
+        }
+
+        with self.assertNoLogs("WorkloadReplicatorLogger", level="ERROR"):
+            connections, total_connections = parse_connections(
+                "s3://test/extracts/epoch",
+                time_interval_between_transactions,
+                time_interval_between_queries,
+                window_filters,
+            )
+        self.assertEqual([c.username for c in connections], ["etl_2"])
+        self.assertEqual(total_connections, 4)
+
@@ -0,0 +1,105 @@
+import datetime
+import pickle
+import time
+import unittest
+from unittest.mock import patch
+
+from core.replay.connections_parser import ConnectionLog
+from core.replay.credential_broker import CredentialBroker, replay_username
+from core.replay.stats import init_stats
+
+config = {
+    "master_username": "awsuser",
+    "credentials_prefetch_threads": 4,
+}
+
+
+def get_connection_log(username, database_name):
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    return ConnectionLog(now, now, database_name, username, "123")
+
+
+def mock_credentials(self, username, database=None, skip_cache=False):
+    return {"username": username, "database": database, "password": "secret"}
+
+
+@patch("core.replay.credential_broker.ReplayPrep.get_connection_credentials", mock_credentials)
+class TestCredentialBroker(unittest.TestCase):
+    def test_replay_username(self):
+        self.assertEqual(replay_username("IAM:someone", config), "awsuser")
+        self.assertEqual(replay_username("IAMR:someone", config), "awsuser")
+        self.assertEqual(replay_username("analyst", config), "analyst")
+
+    def test_prefetch_distinct_users(self):
+        broker = CredentialBroker(config)
+        with patch.object(CredentialBroker, "fetch", wraps=broker.fetch) as mock_fetch:
+            broker.prefetch(
+                [
+                    get_connection_log("analyst", "dev"),
+                    get_connection_log("analyst", "dev"),
+                    get_connection_log("analyst", "prod"),
+                    get_connection_log("IAM:someone", "dev"),
+                ]
+            )
+        self.assertEqual(mock_fetch.call_count, 3)
+        self.assertEqual(
+            set(broker.credentials.keys()),
+            {("analyst", "dev"), ("analyst", "prod"), ("awsuser", "dev")},
+        )
+
+    def test_get_credentials_hit_and_miss(self):
+        broker = CredentialBroker(config)
+        broker.prefetch([get_connection_log("analyst", "dev")])
+        stats = init_stats({})
+
+        credentials = broker.get_credentials("analyst", "dev", stats)
+        self.assertEqual(credentials["database"], "dev")
+        self.assertEqual(stats["credential_cache_hits"], 1)
+        self.assertEqual(stats["credential_fetches"], 0)
+
+        credentials = broker.get_credentials("analyst", "prod", stats)
+        self.assertEqual(credentials["database"], "prod")
+        broker.get_credentials("analyst", "prod", stats)
+        self.assertEqual(stats["credential_cache_hits"], 2)
+        self.assertEqual(stats["credential_cache_misses"], 1)
+        self.assertEqual(stats["credential_fetches"], 1)
+
+    def test_expired_credentials_are_fetched_again(self):
+        broker = CredentialBroker(config)
+        broker.credentials[("analyst", "dev")] = (time.time() - 3600, {"password": "old"})
+        stats = init_stats({})
+
+        credentials = broker.get_credentials("analyst", "dev", stats)
+        self.assertEqual(credentials["password"], "secret")
+        self.assertEqual(stats["credential_fetches"], 1)
+
+    def test_refresh_stale(self):
+        broker = CredentialBroker(config)
+        broker.credentials[("analyst", "dev")] = (time.time() - 1600, {"password": "old"})
+        broker.credentials[("analyst", "prod")] = (time.time(), {"password": "fresh"})
+        broker.used.update(broker.credentials.keys())
+
+        broker.refresh_stale()
+        self.assertEqual(broker.credentials[("analyst", "dev")][1]["password"], "secret")
+        self.assertEqual(broker.credentials[("analyst", "prod")][1]["password"], "fresh")
+
+    def test_refresh_stale_only_renews_keys_handed_out(self):
+        broker = CredentialBroker(config)
+        broker.credentials[("analyst", "dev")] = (time.time() - 1600, {"password": "old"})
+        broker.credentials[("analyst", "prod")] = (time.time() - 1600, {"password": "old"})
+        broker.get_credentials("analyst", "dev")
+
+        with patch.object(CredentialBroker, "fetch", wraps=broker.fetch) as mock_fetch:
+            broker.refresh_stale()
+        mock_fetch.assert_called_once_with("analyst", "dev")
+        self.assertEqual(broker.credentials[("analyst", "prod")][1]["password"], "old")
+
+    def test_pickle_keeps_cache(self):
+        broker = CredentialBroker(config)
+        broker.prefetch([get_connection_log("analyst", "dev")])
+        broker.ensure_refresher(interval_sec=3600)
+
+        copy = pickle.loads(pickle.dumps(broker))
+        self.assertIsNone(copy.refresher)
+        self.assertEqual(copy.used, set())
+        self.assertEqual(copy.credentials, broker.credentials)
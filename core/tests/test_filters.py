@@ -1,7 +1,7 @@
 import unittest
 from core.replay.connections_parser import ConnectionLog
-from core.replay.prep import ReplayPrep
-from common.util import matches_filters
+from core.replay.prep import ReplayPrep, InvalidFilterException
+from common.util import compile_filters, filter_time_window, in_time_window, matches_filters
 import datetime
 import yaml
 
@@ -220,6 +220,91 @@ class TestFilters(unittest.TestCase):
         )
         self.assertTrue(matches_filters(self._connection, filters))
 
+    def test_prefix_and_regex(self):
+        filter_str = """filters:
+                          include:
+                              username: ['use*', 're:etl_[0-9]+']
+                          exclude:
+                              database_name: ['re:db[2-9]']
+                     """
+        filters = ReplayPrep.validate_and_normalize_filters(
+            ConnectionLog, yaml.safe_load(filter_str)["filters"]
+        )
+        self.assertTrue(matches_filters(self._connection, filters))
+        self._connection.username = "etl_42"
+        self.assertTrue(matches_filters(self._connection, filters))
+        # regular expressions must match the whole value
+        self._connection.username = "etl_42x"
+        self.assertFalse(matches_filters(self._connection, filters))
+        self._connection.username = "user1"
+        self._connection.database_name = "db2"
+        self.assertFalse(matches_filters(self._connection, filters))
+
+    def test_compile_filters_on_raw_records(self):
+        filter_str = """filters:
+                          include:
+                              database_name: ['db1', 'db2']
+                          exclude:
+                              username: ['tmp*']
+                     """
+        filters = ReplayPrep.validate_and_normalize_filters(
+            ConnectionLog, yaml.safe_load(filter_str)["filters"]
+        )
+        predicate = compile_filters(filters, {"database_name": "db", "username": "user"})
+        self.assertTrue(predicate({"db": "db2", "user": "etl", "pid": "1"}))
+        self.assertFalse(predicate({"db": "db3", "user": "etl", "pid": "1"}))
+        self.assertFalse(predicate({"db": "db1", "user": "tmp_load", "pid": "1"}))
+
+    def test_time_window(self):
+        filter_str = """filters:
+                          start_time: '2023-01-09T15:00:00+00:00'
+                          end_time: 2023-01-09 16:00:00
+                     """
+        filters = ReplayPrep.validate_and_normalize_filters(
+            ConnectionLog, yaml.safe_load(filter_str)["filters"]
+        )
+        window = filter_time_window(filters)
+        window_start_us, window_end_us = window
+        self.assertEqual(window_end_us - window_start_us, 3600 * 1_000_000)
+        self.assertTrue(in_time_window(window_start_us - 1, window_start_us, *window))
+        self.assertFalse(in_time_window(window_start_us - 2, window_start_us - 1, *window))
+        self.assertFalse(in_time_window(window_end_us, None, *window))
+        self.assertTrue(in_time_window(None, None, *window))
+
+    def test_time_window_dates(self):
+        filter_str = """filters:
+                          start_time: 2023-01-09
+                          end_time: 2023-01-10
+                     """
+        filters = ReplayPrep.validate_and_normalize_filters(
+            ConnectionLog, yaml.safe_load(filter_str)["filters"]
+        )
+        window_start_us, window_end_us = filter_time_window(filters)
+        self.assertEqual(window_start_us, filter_time_window({"start_time": "2023-01-09"})[0])
+        self.assertEqual(window_end_us - window_start_us, 86400 * 1_000_000)
+
+    def test_invalid_regex_and_time_window(self):
+        for filter_str in [
+            """filters:
+                  include:
+                      username: ['re:etl_[0-9']
+            """,
+            """filters:
+                  start_time: 'yesterday'
+            """,
+            """filters:
+                  start_time: [2023, 1, 9]
+            """,
+            """filters:
+                  start_time: '2023-01-09T16:00:00+00:00'
+                  end_time: '2023-01-09T15:00:00+00:00'
+            """,
+        ]:
+            with self.assertRaises(InvalidFilterException):
+                ReplayPrep.validate_and_normalize_filters(
+                    ConnectionLog, yaml.safe_load(filter_str)["filters"]
+                )
+
 
 if __name__ == "__main__":
     unittest.main()
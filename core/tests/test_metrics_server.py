@@ -0,0 +1,73 @@
+import socket
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+
+from core.replay.metrics_server import MetricsServer, render_metrics
+from core.replay.stats import (
+    QUERY_LATENESS_HISTOGRAM,
+    SharedStats,
+    collect_stats,
+    init_stats,
+    record_lateness,
+)
+
+
+class TestMetricsServer(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.shared_stats = SharedStats(2, self.spool_dir.name)
+        thread_stats = init_stats({})
+        thread_stats["query_success"] = 3
+        thread_stats["query_error"] = 1
+        for lateness_sec in (-0.005, 0.0015, 0.3, 120):
+            record_lateness(thread_stats, QUERY_LATENESS_HISTOGRAM, lateness_sec)
+        thread_stats["query_lateness_sec"] = 120.3015
+        collect_stats(self.shared_stats.worker(1), thread_stats)
+
+    def tearDown(self):
+        self.spool_dir.cleanup()
+
+    def test_render_metrics(self):
+        text = render_metrics(self.shared_stats.snapshot(), 7, {"shared": 12})
+        lines = text.splitlines()
+        self.assertIn("# TYPE replay_queries_succeeded_total counter", lines)
+        self.assertIn('replay_queries_succeeded_total{worker="0"} 0', lines)
+        self.assertIn('replay_queries_succeeded_total{worker="1"} 3', lines)
+        self.assertIn('replay_queries_failed_total{worker="1"} 1', lines)
+        self.assertIn("replay_peak_connections 7", lines)
+        self.assertIn('replay_queued_connections{worker="shared"} 12', lines)
+
+        self.assertIn("# TYPE replay_query_lateness_seconds histogram", lines)
+        self.assertIn('replay_query_lateness_seconds_bucket{worker="1",le="0"} 1', lines)
+        self.assertIn('replay_query_lateness_seconds_bucket{worker="1",le="0.001"} 1', lines)
+        self.assertIn('replay_query_lateness_seconds_bucket{worker="1",le="0.002"} 2', lines)
+        self.assertIn('replay_query_lateness_seconds_bucket{worker="1",le="60"} 3', lines)
+        self.assertIn('replay_query_lateness_seconds_bucket{worker="1",le="+Inf"} 4', lines)
+        self.assertIn('replay_query_lateness_seconds_count{worker="1"} 4', lines)
+        self.assertIn('replay_query_lateness_seconds_sum{worker="1"} 120.3015', lines)
+
+    def test_serves_metrics(self):
+        server = MetricsServer(self.shared_stats, 0, queued_connections=lambda: {0: 2, 1: 0})
+        server.peak_connections = 3
+        server.start()
+        try:
+            with urllib.request.urlopen(server.address, timeout=5) as response:
+                self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+                text = response.read().decode("utf-8")
+            self.assertIn('replay_queries_succeeded_total{worker="1"} 3', text)
+            self.assertIn('replay_queued_connections{worker="0"} 2', text)
+            self.assertIn("replay_peak_connections 3", text)
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(server.address.replace("/metrics", "/other"), timeout=5)
+        finally:
+            server.stop()
+
+    def test_from_config(self):
+        self.assertIsNone(MetricsServer.from_config({}, self.shared_stats))
+        with socket.socket() as busy:
+            busy.bind(("127.0.0.1", 0))
+            busy.listen()
+            port = busy.getsockname()[1]
+            self.assertIsNone(MetricsServer.from_config({"metrics_port": port}, self.shared_stats))
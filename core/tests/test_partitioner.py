@@ -0,0 +1,133 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+from core.replay.connections_parser import ConnectionLog
+from core.replay.partitioner import partition_connections, preview_load, write_shards, ShardQueue
+from core.replay.transactions_parser import Query, Transaction
+
+start = datetime.datetime(2023, 2, 1, 10, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def get_connection_log(start_sec, end_sec, pid, num_queries=0):
+    connection_log = ConnectionLog(
+        start + datetime.timedelta(seconds=start_sec),
+        start + datetime.timedelta(seconds=end_sec),
+        "dev",
+        "awsuser",
+        str(pid),
+    )
+    if num_queries:
+        query_time = start + datetime.timedelta(seconds=start_sec)
+        queries = [Query(query_time, query_time, "select 1;") for _ in range(num_queries)]
+        connection_log.transactions = [
+            Transaction(False, "dev", "awsuser", str(pid), str(pid), queries, "key")
+        ]
+    return connection_log
+
+
+class TestPartitionConnections(unittest.TestCase):
+    def test_round_robin(self):
+        connections = [get_connection_log(i, i + 1, i) for i in range(5)]
+
+        shards = partition_connections(connections, 2, "round_robin")
+
+        self.assertEqual([job["job_id"] for job in shards[0]], [0, 2, 4])
+        self.assertEqual([job["job_id"] for job in shards[1]], [1, 3])
+        self.assertIs(shards[1][0]["connection"], connections[1])
+
+    def test_bin_pack_spreads_overlapping_sessions(self):
+        # short and long sessions alternate, so round robin puts all three long sessions
+        # on worker 0
+        connections = [
+            get_connection_log(0, 100, 1),
+            get_connection_log(1, 2, 2),
+            get_connection_log(3, 100, 3),
+            get_connection_log(4, 5, 4),
+            get_connection_log(6, 100, 5),
+        ]
+
+        round_robin = partition_connections(connections, 2, "round_robin")
+        self.assertEqual([job["job_id"] for job in round_robin[0]], [0, 2, 4])
+
+        shards = partition_connections(connections, 2, "bin_pack")
+        self.assertEqual([job["job_id"] for job in shards[0]], [0, 3, 4])
+        self.assertEqual([job["job_id"] for job in shards[1]], [1, 2])
+
+    def test_load_balance_spreads_busy_sessions(self):
+        # two busy and two idle sessions, all open for the whole replay. Counting
+        # sessions alone would put both busy sessions on the same worker.
+        connections = [
+            get_connection_log(0, 100, 1, num_queries=1000),
+            get_connection_log(1, 100, 2),
+            get_connection_log(2, 100, 3),
+            get_connection_log(3, 100, 4, num_queries=1000),
+        ]
+
+        bin_pack = partition_connections(connections, 2, "bin_pack")
+        self.assertEqual([job["job_id"] for job in bin_pack[0]], [0, 3])
+        self.assertEqual([job["job_id"] for job in bin_pack[1]], [1, 2])
+
+        shards = partition_connections(connections, 2, "load_balance")
+        self.assertEqual([job["job_id"] for job in shards[0]], [0])
+        self.assertEqual([job["job_id"] for job in shards[1]], [1, 2, 3])
+
+    def test_load_balance_reuses_workers_of_closed_sessions(self):
+        connections = [
+            get_connection_log(0, 100, 1),
+            get_connection_log(1, 2, 2),
+            get_connection_log(3, 100, 3),
+            get_connection_log(4, 5, 4),
+            get_connection_log(6, 100, 5),
+        ]
+        shards = partition_connections(connections, 2, "load_balance")
+        self.assertEqual([job["job_id"] for job in shards[0]], [0, 3, 4])
+        self.assertEqual([job["job_id"] for job in shards[1]], [1, 2])
+
+    def test_preview_load(self):
+        connections = [
+            get_connection_log(0, 10, 1, num_queries=20),
+            get_connection_log(5, 15, 2, num_queries=10),
+            get_connection_log(10, 20, 3),
+        ]
+        preview = preview_load(partition_connections(connections, 2, "round_robin"))
+        self.assertEqual(
+            preview[0],
+            {
+                "connections": 2,
+                "transactions": 1,
+                "queries": 20,
+                # the first session ends when the third starts
+                "peak_sessions": 1,
+                "peak_queries_per_sec": 2.0,
+            },
+        )
+        self.assertEqual(preview[1]["queries"], 10)
+        self.assertEqual(preview[1]["peak_queries_per_sec"], 1.0)
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            partition_connections([], 2, "random")
+
+
+class TestShardQueue(unittest.TestCase):
+    def test_write_and_read_shards(self):
+        connections = [get_connection_log(i, i + 1, i) for i in range(3)]
+        shards = partition_connections(connections, 2, "round_robin")
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_shards(shards, directory)
+            self.assertEqual(len(paths), 2)
+            self.assertTrue(all(os.path.exists(path) for path in paths))
+
+            queue = ShardQueue(paths[0], len(shards[0]))
+            self.assertFalse(queue.empty())
+            # the size is known before the shard is loaded
+            self.assertEqual(queue.qsize(), 2)
+            jobs = [queue.get(timeout=10), queue.get(timeout=10)]
+            self.assertEqual([job["job_id"] for job in jobs], [0, 2])
+            self.assertEqual(jobs[1]["connection"], connections[2])
+            self.assertTrue(queue.empty())
+            self.assertIs(queue.get(timeout=10), False)
+            self.assertIs(queue.get(timeout=10), False)
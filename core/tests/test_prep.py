@@ -292,11 +292,14 @@ class TestGetConnectionCredentials(unittest.TestCase):
         )
 
 
+@patch("core.replay.prep.WorkloadStore.open", return_value=None)
 class TestCorrelateTransactionsWithConnections(unittest.TestCase):
     @patch.object(TransactionsParser, "__init__", return_value=None)
     @patch.object(TransactionsParser, "parse_transactions")
     @patch("core.replay.prep.parse_connections")
-    def test_success(self, patched_parse_connections, patched_parse_transactions, mock_obj):
+    def test_success(
+        self, patched_parse_connections, patched_parse_transactions, mock_obj, mock_open_store
+    ):
         connection_log = ConnectionLog(
             datetime.datetime.now(tz=datetime.timezone.utc),
             datetime.datetime.now(tz=datetime.timezone.utc),
@@ -347,6 +350,96 @@ class TestCorrelateTransactionsWithConnections(unittest.TestCase):
         self.assertEqual(transaction_count, 1)
         self.assertEqual(total_connections, 1)
 
+    @patch.object(TransactionsParser, "__init__", return_value=None)
+    @patch.object(TransactionsParser, "parse_transactions")
+    @patch("core.replay.prep.parse_connections")
+    def test_amplification(
+        self, patched_parse_connections, patched_parse_transactions, mock_obj, mock_open_store
+    ):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        connection_log = ConnectionLog(now, now, "dev", "awsuser", "123", "app", True, True, "key")
+        patched_parse_connections.return_value = [connection_log], 1
+        query = Query(start_time=now, end_time=now, text="select 1;")
+        patched_parse_transactions.return_value = [
+            Transaction(True, "dev", "awsuser", "123", "345", [query], "dev_awsuser_123")
+        ]
+        p = ReplayPrep(
+            {
+                "workload_location": "s3://test-bucket/test-workload-location",
+                "time_interval_between_transactions": "true",
+                "time_interval_between_queries": "true",
+                "filters": [],
+                "amplification_factor": 3,
+                "amplification_jitter_sec": 2,
+            }
+        )
+        (
+            conxn_logs,
+            query_count,
+            transaction_count,
+            first_event_time,
+            last_event_time,
+            total_connections,
+        ) = p.correlate_transactions_with_connections("test-replay")
+        self.assertEqual(len(conxn_logs), 3)
+        self.assertIn(connection_log, conxn_logs)
+        self.assertEqual(query_count, 3)
+        self.assertEqual(transaction_count, 3)
+        self.assertEqual(first_event_time, now)
+        self.assertLessEqual(last_event_time, now + datetime.timedelta(seconds=2))
+
+    @patch.object(TransactionsParser, "__init__", return_value=None)
+    @patch.object(TransactionsParser, "parse_transactions")
+    @patch("core.replay.prep.parse_connections")
+    def test_matches_most_recent_connection_of_key(
+        self, patched_parse_connections, patched_parse_transactions, mock_obj, mock_open_store
+    ):
+        start = datetime.datetime(2023, 2, 1, 10, 0, 0, 500000, tzinfo=datetime.timezone.utc)
+
+        def at(sec):
+            return start + datetime.timedelta(seconds=sec)
+
+        # a pooled user reusing the same pid, and another user interleaved with it
+        connection_logs = [
+            ConnectionLog(at(sec), at(sec + 5), "dev", username, "123", "app", True, True)
+            for sec, username in [(0, "pool"), (1, "other"), (10, "pool"), (20, "pool")]
+        ]
+        patched_parse_connections.return_value = connection_logs, 4
+
+        def get_transaction(username, xid, start_sec, query_secs=(0,)):
+            queries = [
+                Query(at(start_sec + q), at(start_sec + q + 1), "select 1;") for q in query_secs
+            ]
+            return Transaction(False, "dev", username, "123", xid, queries, f"dev_{username}_123")
+
+        transactions = [
+            get_transaction("pool", "1", -5),
+            get_transaction("pool", "2", 2, query_secs=(0, 3)),
+            # the session start is truncated to the second, so this still matches at 10
+            get_transaction("pool", "3", 9.6),
+            get_transaction("other", "4", 12),
+            get_transaction("pool", "5", 25),
+        ]
+        patched_parse_transactions.return_value = transactions
+        p = ReplayPrep(
+            {
+                "workload_location": "s3://test-bucket/test-workload-location",
+                "time_interval_between_transactions": "true",
+                "time_interval_between_queries": "true",
+                "filters": [],
+            }
+        )
+        conxn_logs, query_count, transaction_count, _, _, _ = (
+            p.correlate_transactions_with_connections("test-replay")
+        )
+        self.assertEqual(
+            [[t.xid for t in c.transactions] for c in conxn_logs],
+            [["2"], ["4"], ["3"], ["5"]],
+        )
+        self.assertEqual(transactions[1].queries[0].time_interval, 2)
+        self.assertEqual(query_count, 5)
+        self.assertEqual(transaction_count, 5)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,118 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+
+from core.replay.connections_parser import ConnectionLog
+from core.replay.prep import ReplayPrep
+from core.replay.prep_cache import PrepCache, cache_key, file_digest
+from core.replay.transactions_parser import Query, Transaction
+
+now = datetime.datetime(2023, 2, 1, 10, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def get_prepared():
+    connection_log = ConnectionLog(now, now, "dev", "awsuser", "123", "app", True, True)
+    query = Query(now, now + datetime.timedelta(seconds=1), "select 1;")
+    connection_log.transactions = [
+        Transaction(True, "dev", "awsuser", "123", "345", [query], "dev_awsuser_123")
+    ]
+    return [connection_log], 1, 1, now, now, 1
+
+
+class TestPrepCache(unittest.TestCase):
+    def setUp(self):
+        self.workload_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        for filename, content in [("SQLs.json.gz", b"sqls"), ("connections.json", b"[]")]:
+            with open(os.path.join(self.workload_dir, filename), "wb") as f:
+                f.write(content)
+        self.config = {
+            "workload_location": self.workload_dir,
+            "filters": {},
+            "time_interval_between_transactions": "all on",
+            "time_interval_between_queries": "all on",
+            "execute_copy_statements": "false",
+            "execute_unload_statements": "false",
+            "prep_cache_location": self.cache_dir,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.workload_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def test_disabled(self):
+        self.assertIsNone(PrepCache.from_config({"prep_cache_location": None}, "replay"))
+
+    def test_file_digest(self):
+        self.assertIsNone(file_digest(os.path.join(self.workload_dir, "missing")))
+        self.assertEqual(
+            file_digest(os.path.join(self.workload_dir, "connections.json")),
+            "4f53cda18c2baa0c0354bb5f9a3ecbe5ed12ab4d8e11ba873c2f11161202b945",
+        )
+
+    def test_key_depends_on_contents_and_settings(self):
+        key = cache_key(self.config, "replay")
+        self.assertEqual(cache_key(dict(self.config, prep_cache_location="other"), "replay2"), key)
+        self.assertNotEqual(cache_key(dict(self.config, filters={"include": {}}), "replay"), key)
+        self.assertNotEqual(
+            cache_key(dict(self.config, time_interval_between_queries="all off"), "replay"), key
+        )
+        with open(os.path.join(self.workload_dir, "connections.json"), "wb") as f:
+            f.write(b"[{}]")
+        self.assertNotEqual(cache_key(self.config, "replay"), key)
+
+    def test_key_depends_on_replay_id_with_unloads(self):
+        config = dict(self.config, execute_unload_statements="true")
+        self.assertNotEqual(cache_key(config, "replay"), cache_key(config, "replay2"))
+
+    def test_save_and_load(self):
+        cache = PrepCache.from_config(self.config, "replay")
+        self.assertIsNone(cache.load())
+        cache.save(get_prepared())
+        connection_logs, query_count, transaction_count, first, last, total = (
+            PrepCache.from_config(self.config, "replay").load()
+        )
+        self.assertEqual(connection_logs, get_prepared()[0])
+        self.assertEqual(connection_logs[0].transactions[0].queries[0].text, "select 1;")
+        self.assertEqual((query_count, transaction_count, first, last, total), (1, 1, now, now, 1))
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(cache.location)])
+
+    def test_ignores_unreadable_entry(self):
+        cache = PrepCache.from_config(self.config, "replay")
+        with open(cache.location, "wb") as f:
+            f.write(b"not a cache entry")
+        self.assertIsNone(cache.load())
+
+    def test_ignores_entry_of_other_key(self):
+        PrepCache(self.cache_dir, "other").save(get_prepared())
+        os.rename(
+            os.path.join(self.cache_dir, "prep-other.pkl.gz"),
+            os.path.join(self.cache_dir, "prep-key.pkl.gz"),
+        )
+        self.assertIsNone(PrepCache(self.cache_dir, "key").load())
+
+    @patch("core.replay.prep_cache.boto3.client")
+    def test_s3_errors_disable_cache(self, patched_client):
+        denied = ClientError({"Error": {"Code": "AccessDenied"}}, "HeadObject")
+        patched_client.return_value.head_object.side_effect = denied
+        patched_client.return_value.download_file.side_effect = denied
+        with self.assertLogs("WorkloadReplicatorLogger", level="WARNING"):
+            config = dict(self.config, workload_location="s3://bucket/workload")
+            self.assertIsNone(PrepCache.from_config(config, "replay"))
+        with self.assertLogs("WorkloadReplicatorLogger", level="WARNING"):
+            self.assertIsNone(PrepCache("s3://bucket/cache", "key").load())
+
+    @patch.object(ReplayPrep, "load_workload", side_effect=lambda replay_id: get_prepared())
+    def test_replay_prep_uses_cache(self, patched_load_workload):
+        for _ in range(2):
+            connection_logs, *_ = ReplayPrep(
+                dict(self.config, amplification_factor=2)
+            ).correlate_transactions_with_connections("replay")
+            # amplification is applied to the cached connections
+            self.assertEqual(len(connection_logs), 2)
+        patched_load_workload.assert_called_once()
@@ -151,7 +151,7 @@ class TestReportGen(unittest.TestCase):
         mock_get_raw_data.assert_called_with(
             self.report, self.bucket, "someprefixanalysis/someid", "query2"
         )
-        mock_pdf_gen.assert_called_once_with(self.report, None)
+        mock_pdf_gen.assert_called_once_with(self.report, None, None)
         self.assertTrue(mock_upload.call_count == 3)
 
     @patch("common.util.cluster_dict")
@@ -0,0 +1,201 @@
+import asyncio
+import datetime
+import unittest
+from unittest.mock import patch
+
+from common.util import datetime_to_us
+from core.replay.connections_parser import ConnectionLog
+from core.replay.scheduler import (
+    JobFeeder,
+    ReplayClock,
+    ReplayTimeline,
+    find_idle_gaps,
+    timedelta_ns,
+)
+from core.replay.transactions_parser import Query, Transaction
+
+first_event_time = datetime.datetime(2023, 2, 1, 10, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def at(sec):
+    return first_event_time + datetime.timedelta(seconds=sec)
+
+
+def get_connection_log(start_sec, query_times):
+    connection_log = ConnectionLog(at(start_sec), at(start_sec + 1000), "dev", "awsuser", "123")
+    queries = [Query(at(start), at(end), "select 1;") for start, end in query_times]
+    connection_log.transactions = [
+        Transaction(False, "dev", "awsuser", "123", "100", queries, "dev_awsuser_123")
+    ]
+    return connection_log
+
+
+def get_clock(elapsed_sec, slack_ms=10):
+    replay_start = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
+        seconds=elapsed_sec
+    )
+    return ReplayClock(replay_start, first_event_time, slack_ms)
+
+
+class TestReplayClock(unittest.TestCase):
+    def test_timedelta_ns(self):
+        self.assertEqual(
+            timedelta_ns(datetime.timedelta(seconds=1, microseconds=5)), 1_000_005_000
+        )
+        self.assertEqual(timedelta_ns(datetime.timedelta(microseconds=-1)), -1000)
+
+    def test_deadline_relative_to_first_event(self):
+        clock = get_clock(0)
+        event_time = first_event_time + datetime.timedelta(minutes=1, microseconds=250)
+        self.assertEqual(clock.deadline_ns(datetime_to_us(event_time)), 60_000_250_000)
+        self.assertIsInstance(clock.deadline_ns(datetime_to_us(event_time)), int)
+
+    def test_anchored_to_replay_start(self):
+        clock = get_clock(30)
+        self.assertAlmostEqual(clock.elapsed_ns() / 1e9, 30, delta=1)
+        self.assertAlmostEqual(clock.remaining_sec(60_000_000_000), 30, delta=1)
+
+    def test_naive_replay_start(self):
+        clock = ReplayClock(
+            datetime.datetime.now() - datetime.timedelta(seconds=5), first_event_time
+        )
+        self.assertAlmostEqual(clock.elapsed_ns() / 1e9, 5, delta=1)
+
+    @patch("time.sleep")
+    def test_wait_until_sleeps_remaining_time(self, patched_time_sleep):
+        clock = get_clock(30)
+        clock.wait_until(40_000_000_000)
+        patched_time_sleep.assert_called_once()
+        self.assertAlmostEqual(patched_time_sleep.call_args[0][0], 10, delta=1)
+
+    @patch("time.sleep")
+    def test_wait_until_past_deadline_reports_lateness(self, patched_time_sleep):
+        clock = get_clock(30)
+        lateness_sec = clock.wait_until(20_000_000_000)
+        patched_time_sleep.assert_not_called()
+        self.assertAlmostEqual(lateness_sec, 10, delta=1)
+        self.assertTrue(clock.is_late(lateness_sec))
+
+    @patch("time.sleep")
+    def test_wait_until_within_slack(self, patched_time_sleep):
+        clock = get_clock(30, slack_ms=5000)
+        lateness_sec = clock.wait_until(31_000_000_000)
+        patched_time_sleep.assert_not_called()
+        self.assertLess(lateness_sec, 0)
+        self.assertFalse(clock.is_late(lateness_sec))
+
+    def test_wait_until_async(self):
+        clock = get_clock(0)
+        deadline_ns = clock.elapsed_ns() + 20_000_000
+        lateness_sec = asyncio.run(clock.wait_until_async(deadline_ns))
+        self.assertGreaterEqual(lateness_sec, 0)
+        self.assertLess(lateness_sec, 1)
+
+    def test_from_config_default_slack(self):
+        clock = ReplayClock.from_config(
+            datetime.datetime.now(tz=datetime.timezone.utc), first_event_time, {}
+        )
+        self.assertEqual(clock.slack_sec, 0.01)
+
+
+class TestReplayTimeline(unittest.TestCase):
+    def test_not_configured(self):
+        self.assertIsNone(ReplayTimeline.from_config({}, [], first_event_time))
+        self.assertIsNone(
+            ReplayTimeline.from_config(
+                {"replay_speed": 1, "max_idle_gap_sec": ""}, [], first_event_time
+            )
+        )
+
+    def test_replay_speed(self):
+        timeline = ReplayTimeline.from_config({"replay_speed": 4}, [], first_event_time)
+        self.assertEqual(timeline.replay_ns(60_000_000_000), 15_000_000_000)
+        self.assertEqual(timeline.gap_ns(2_000_000_000), 500_000_000)
+
+    def test_find_idle_gaps(self):
+        connection_logs = [
+            get_connection_log(0, [(0, 5), (100, 110)]),
+            get_connection_log(3, [(4, 20)]),
+            get_connection_log(500, [(500, 501)]),
+        ]
+        self.assertEqual(
+            find_idle_gaps(connection_logs, first_event_time, 30_000_000_000),
+            [(20_000_000_000, 100_000_000_000), (110_000_000_000, 500_000_000_000)],
+        )
+
+    def test_collapse_idle_gaps(self):
+        # idle from 20 to 100 and from 110 to 500 sec, shortened to 30 sec each
+        timeline = ReplayTimeline(
+            1,
+            30_000_000_000,
+            [(20_000_000_000, 100_000_000_000), (110_000_000_000, 500_000_000_000)],
+        )
+        self.assertEqual(timeline.replay_ns(10_000_000_000), 10_000_000_000)
+        self.assertEqual(timeline.replay_ns(40_000_000_000), 40_000_000_000)
+        self.assertEqual(timeline.replay_ns(60_000_000_000), 50_000_000_000)
+        self.assertEqual(timeline.replay_ns(100_000_000_000), 50_000_000_000)
+        self.assertEqual(timeline.replay_ns(105_000_000_000), 55_000_000_000)
+        self.assertEqual(timeline.replay_ns(500_000_000_000), 90_000_000_000)
+        self.assertEqual(timeline.gap_ns(45_000_000_000), 30_000_000_000)
+
+    def test_clock_applies_timeline(self):
+        connection_logs = [get_connection_log(0, [(0, 1), (300, 301)])]
+        timeline = ReplayTimeline.from_config(
+            {"replay_speed": 2, "max_idle_gap_sec": 10}, connection_logs, first_event_time
+        )
+        clock = ReplayClock(
+            datetime.datetime.now(tz=datetime.timezone.utc), first_event_time, 10, timeline
+        )
+        self.assertEqual(clock.deadline_ns(datetime_to_us(at(300))), 5_500_000_000)
+        self.assertEqual(clock.gap_ns(60_000_000_000), 5_000_000_000)
+
+
+class TestJobFeeder(unittest.TestCase):
+    def test_feeds_jobs_within_lookahead(self):
+        # the replay started 10 sec into the workload
+        clock = get_clock(10)
+        connection_logs = [get_connection_log(sec, []) for sec in (0, 5, 30, 3600)]
+        queued = []
+        feeder = JobFeeder(connection_logs, lambda job: queued.append(job) or True, clock, 30, 2)
+        feeder.start()
+        feeder.join(timeout=1)
+        # the connection an hour in isn't due yet
+        self.assertTrue(feeder.is_alive())
+        self.assertEqual([job["job_id"] for job in queued], [0, 1, 2])
+        self.assertIs(queued[2]["connection"], connection_logs[2])
+        feeder.stop()
+        feeder.join(timeout=1)
+        self.assertFalse(feeder.is_alive())
+        self.assertEqual(feeder.jobs_queued, 3)
+
+    def test_no_lookahead_queues_everything(self):
+        connection_logs = [get_connection_log(sec, []) for sec in (0, 3600)]
+        queued = []
+        feeder = JobFeeder.from_config(
+            connection_logs,
+            lambda job: queued.append(job) or True,
+            get_clock(0),
+            {"job_lookahead_sec": None},
+            2,
+        )
+        feeder.run()
+        self.assertEqual([job and job["job_id"] for job in queued], [0, 1, False, False])
+
+    def test_stops_when_put_fails(self):
+        feeder = JobFeeder([get_connection_log(0, [])] * 3, lambda job: False, get_clock(0), 30, 2)
+        feeder.run()
+        self.assertEqual(feeder.jobs_queued, 0)
+
+    def test_add_worker(self):
+        queued = []
+        put = lambda job: queued.append(job) or True
+        feeder = JobFeeder([get_connection_log(0, [])], put, get_clock(0), None, 2)
+        self.assertTrue(feeder.add_worker())
+        feeder.run()
+        # the added worker gets a termination signal as well
+        self.assertEqual(queued[1:], [False, False, False])
+        # and so does a worker added once the feeder is done
+        self.assertTrue(feeder.add_worker())
+        self.assertEqual(queued[1:], [False, False, False, False])
+        feeder.stop()
+        self.assertFalse(feeder.add_worker())
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from core.replay.statement_trace import (
+    StatementTrace,
+    error_code,
+    merge_traces,
+    numeric_xid,
+    read_trace,
+    worker_trace_path,
+)
+
+
+class TestStatementTrace(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def record(self, trace, job_id, scheduled_ns, code=""):
+        trace.record(job_id, 100, 0, 0, scheduled_ns, scheduled_ns + 5, scheduled_ns + 10, 1, code)
+
+    def test_disabled(self):
+        self.assertIsNone(StatementTrace.from_config({}, "replay", 0))
+
+    def test_flushes_full_buffer_in_chunks(self):
+        trace = StatementTrace.from_config(
+            {"statement_trace": True, "statement_trace_buffer_rows": 2}, "replay", 0
+        )
+        for job_id in range(5):
+            self.record(trace, job_id, job_id * 100, "" if job_id else "42601")
+        self.assertEqual(trace.rows_written, 4)
+        trace.flush()
+        self.assertEqual(trace.rows_written, 5)
+
+        rows = read_trace(trace.path)
+        self.assertEqual(list(rows["job_id"]), [0, 1, 2, 3, 4])
+        self.assertEqual(list(rows["lateness_ns"]), [5] * 5)
+        self.assertEqual(rows["error_code"][0], b"42601")
+        self.assertEqual(rows["rows"][1], 1)
+
+    def test_merge_traces(self):
+        config = {"statement_trace": True}
+        traces = [StatementTrace.from_config(config, "replay", idx) for idx in range(3)]
+        self.record(traces[0], 0, 300)
+        self.record(traces[1], 1, 100)
+        self.record(traces[0], 2, 200)
+        for trace in traces:
+            trace.flush()
+
+        merged = merge_traces("replay", 3)
+        self.assertEqual(list(merged["job_id"]), [1, 2, 0])
+        self.assertEqual(list(merged["worker"]), [1, 0, 0])
+        self.assertFalse(os.path.exists(worker_trace_path("replay", 0)))
+
+        saved = np.load("core/logs/replay_log-replay/statement_trace.npz")
+        self.assertEqual(list(saved["scheduled_ns"]), [100, 200, 300])
+        self.assertEqual(list(saved["end_ns"] - saved["start_ns"]), [5, 5, 5])
+
+    def test_error_code(self):
+        self.assertEqual(error_code(Exception({"S": "ERROR", "C": "57014"})), "57014")
+        self.assertEqual(error_code(Exception("connection reset")), "ERROR")
+
+    def test_numeric_xid(self):
+        self.assertEqual(numeric_xid("2612671"), 2612671)
+        self.assertEqual(numeric_xid("abc"), -1)
@@ -1,7 +1,22 @@
 import unittest
 from unittest.mock import patch, call
-from core.replay.stats import percent, print_stats, display_stats, init_stats, collect_stats
-from multiprocessing.managers import SyncManager
+import tempfile
+from core.replay.stats import (
+    percent,
+    print_stats,
+    display_stats,
+    init_stats,
+    collect_stats,
+    SharedStats,
+    ConnectionCounter,
+    ErrorSpool,
+    CONNECTION_LATENESS_HISTOGRAM,
+    QUERY_LATENESS_HISTOGRAM,
+    histogram_percentile,
+    lateness_percentiles,
+    lateness_table,
+    record_lateness,
+)
 
 
 stats = {
@@ -64,17 +79,13 @@ class TestStats(unittest.TestCase):
 
     @patch("replay.stats.logger.info")
     def test_display_stats(self, mock_logger):
-        manager = SyncManager()
-        manager.start()
         stats = {
             "connection_diff_sec": 1.734,
             "query_success": 10,
             "query_error": 2,
         }
 
-        peak_conn = manager.Value(int, 3)
-
-        display_stats(stats, 100, peak_conn)
+        display_stats(stats, 100, 3)
 
         mock_logger.assert_called_once_with(
             "Queries executed: 12 of 100 (12.0%)  [Success: 10 (83.3%), Failed: 2 (16.7%), Peak connections: 3]"
@@ -99,3 +110,136 @@ class TestStats(unittest.TestCase):
         self.assertEqual(aggregated_stats["connection_diff_sec"], stats["connection_diff_sec"])
         self.assertEqual(aggregated_stats["transaction_success"], stats["transaction_success"])
         self.assertEqual(aggregated_stats["transaction_error_log"], stats["transaction_error_log"])
+
+    def test_collect_connect_time(self):
+        worker_stats = init_stats({})
+        for connect_sec in (0.5, 0.1):
+            thread_stats = init_stats({})
+            thread_stats["connects"] = 1
+            thread_stats["connect_sec"] = connect_sec
+            thread_stats["max_connect_sec"] = connect_sec
+            collect_stats(worker_stats, thread_stats)
+        self.assertEqual(worker_stats["connects"], 2)
+        self.assertAlmostEqual(worker_stats["connect_sec"], 0.6)
+        self.assertEqual(worker_stats["max_connect_sec"], 0.5)
+
+
+class TestLatenessHistogram(unittest.TestCase):
+    def test_record_lateness(self):
+        stats = init_stats({})
+        for lateness_sec in (-1, 0, 0.0005, 0.001, 0.0011, 100):
+            record_lateness(stats, QUERY_LATENESS_HISTOGRAM, lateness_sec)
+        self.assertEqual(stats["query_lateness_bucket_0"], 2)
+        self.assertEqual(stats["query_lateness_bucket_1"], 2)
+        self.assertEqual(stats["query_lateness_bucket_2"], 1)
+        self.assertEqual(stats[QUERY_LATENESS_HISTOGRAM[-1]], 1)
+
+        aggregated = init_stats({})
+        collect_stats(aggregated, stats)
+        collect_stats(aggregated, stats)
+        self.assertEqual(aggregated["query_lateness_bucket_0"], 4)
+
+    def test_histogram_percentile(self):
+        stats = init_stats({})
+        self.assertIsNone(histogram_percentile(stats, QUERY_LATENESS_HISTOGRAM, 50))
+        for lateness_sec in [0] * 90 + [0.004] * 9 + [0.3]:
+            record_lateness(stats, QUERY_LATENESS_HISTOGRAM, lateness_sec)
+        self.assertEqual(histogram_percentile(stats, QUERY_LATENESS_HISTOGRAM, 50), 0)
+        self.assertEqual(histogram_percentile(stats, QUERY_LATENESS_HISTOGRAM, 90), 0)
+        self.assertEqual(histogram_percentile(stats, QUERY_LATENESS_HISTOGRAM, 99), 0.005)
+        self.assertEqual(histogram_percentile(stats, QUERY_LATENESS_HISTOGRAM, 100), 0.5)
+        record_lateness(stats, QUERY_LATENESS_HISTOGRAM, 3600)
+        self.assertIsNone(histogram_percentile(stats, QUERY_LATENESS_HISTOGRAM, 100))
+
+    def test_lateness_table(self):
+        stats = init_stats({})
+        self.assertIsNone(lateness_table(stats))
+        for lateness_sec in [-0.001] * 98 + [0.015, 2.5]:
+            record_lateness(stats, CONNECTION_LATENESS_HISTOGRAM, lateness_sec)
+        stats["late_connections"] = 2
+        stats["max_connection_lateness_sec"] = 2.5
+
+        self.assertEqual(
+            lateness_percentiles(
+                stats, CONNECTION_LATENESS_HISTOGRAM, "max_connection_lateness_sec"
+            ),
+            {
+                "events": 100,
+                "p50": "on time",
+                "p90": "on time",
+                "p99": "<= 0.02 sec",
+                "max": "2.500 sec",
+            },
+        )
+        self.assertEqual(
+            lateness_table(stats),
+            [
+                ["", "Count", "Late", "p50", "p90", "p99", "Max"],
+                ["Connections", 100, 2, "on time", "on time", "<= 0.02 sec", "2.500 sec"],
+            ],
+        )
+        # the last buckets are bounded by the maximum
+        stats["max_connection_lateness_sec"] = 0.0123
+        self.assertEqual(lateness_table(stats)[1][5], "<= 0.0123 sec")
+
+
+class TestSharedStats(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.shared_stats = SharedStats(2, self.spool_dir.name)
+
+    def tearDown(self):
+        self.spool_dir.cleanup()
+
+    def test_collect_into_worker_stats(self):
+        worker_stats = self.shared_stats.worker(1)
+        thread_stats = init_stats({})
+        thread_stats["connection_diff_sec"] = -2.5
+        thread_stats["query_success"] = 3
+        thread_stats["transaction_error"] = 1
+        thread_stats["transaction_error_log"]["dev-user-1-2"] = [["select 1;", "error"]]
+
+        collect_stats(worker_stats, thread_stats)
+        collect_stats(worker_stats, thread_stats)
+
+        self.assertEqual(worker_stats["query_success"], 6)
+        self.assertEqual(worker_stats["connection_diff_sec"], -2.5)
+
+        snapshot = self.shared_stats.snapshot()
+        self.assertEqual(snapshot[0]["query_success"], 0)
+        self.assertEqual(snapshot[1]["query_success"], 6)
+        self.assertEqual(snapshot[1]["transaction_error"], 2)
+        self.assertEqual(snapshot[1]["transaction_error_log"], {})
+
+        stats = self.shared_stats.collect()
+        self.assertEqual(
+            stats[1]["transaction_error_log"], {"dev-user-1-2": [["select 1;", "error"]]}
+        )
+        self.assertEqual(stats[0]["transaction_error_log"], {})
+
+    def test_add_worker(self):
+        shared_stats = SharedStats(2, self.spool_dir.name, capacity=3)
+        self.assertEqual(list(shared_stats.snapshot()), [0, 1])
+        worker_stats = shared_stats.add_worker()
+        worker_stats["query_success"] = 4
+        self.assertEqual(shared_stats.snapshot()[2]["query_success"], 4)
+        self.assertIsNone(shared_stats.add_worker())
+        self.assertIsNone(self.shared_stats.add_worker())
+
+    def test_connection_counter(self):
+        counter_0 = ConnectionCounter(self.shared_stats.worker(0))
+        counter_1 = ConnectionCounter(self.shared_stats.worker(1))
+        counter_0.increment()
+        counter_1.increment()
+        counter_1.increment()
+        counter_0.decrement()
+
+        self.assertEqual(counter_0.value, 2)
+        self.assertEqual(self.shared_stats.snapshot()[1]["active_connections"], 2)
+
+    def test_error_spool(self):
+        spool = ErrorSpool(self.shared_stats.spool_path(0, "query_errors"))
+        self.assertEqual(spool.read(), [])
+        spool.append({"code": "42601", "user": "awsuser"})
+
+        self.assertEqual(spool.read(), [{"code": "42601", "user": "awsuser"}])
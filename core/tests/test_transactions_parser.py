@@ -1,8 +1,22 @@
 import unittest
 import datetime
+import gzip
+import io
+import os
+import tempfile
 from dateutil.tz import tzutc
 from unittest.mock import patch
-from core.replay.transactions_parser import TransactionsParser, Transaction, Query
+import json
+from common.util import datetime_to_us
+from core.replay.transactions_parser import (
+    TransactionsParser,
+    Transaction,
+    Query,
+    compile_query,
+    should_execute_statement,
+    iter_compressed_transactions,
+    JsonStreamReader,
+)
 
 config = {
     "tag": "",
@@ -83,18 +97,13 @@ transaction_dict = {
 }
 
 
-def mock_filters(a, b):
-    return True
-
-
 class TestTransactionParser(unittest.TestCase):
     # need to test more in this function
 
-    @patch("core.replay.transactions_parser.matches_filters", mock_filters)
-    @patch.object(Transaction, "start_time")
+    @patch.object(Transaction, "start_us")
     @patch.object(TransactionsParser, "parse_transaction")
     @patch("core.replay.transactions_parser.parse_copy_replacements")
-    @patch("core.replay.transactions_parser.retrieve_compressed_json")
+    @patch("core.replay.transactions_parser.iter_compressed_transactions")
     def test_parse_transactions_copy_statements_True(
         self, mock_retrieve_json, mock_copy_repl, mock_parse_trans, mock_time
     ):
@@ -122,7 +131,7 @@ class TestTransactionParser(unittest.TestCase):
             queries,
             transaction_key,
         )
-        mock_retrieve_json.return_value = sql_json
+        mock_retrieve_json.return_value = sql_json["transactions"].values()
 
         parser = TransactionsParser(config, replay_id)
 
@@ -154,11 +163,10 @@ class TestTransactionParser(unittest.TestCase):
         )
         assert class_object[0].pid == "1073815778"
 
-    @patch("core.replay.transactions_parser.matches_filters", mock_filters)
-    @patch.object(Transaction, "start_time")
+    @patch.object(Transaction, "start_us")
     @patch.object(TransactionsParser, "parse_transaction")
     @patch("core.replay.transactions_parser.parse_copy_replacements")
-    @patch("core.replay.transactions_parser.retrieve_compressed_json")
+    @patch("core.replay.transactions_parser.iter_compressed_transactions")
     def test_parse_transactions_copy_statements_False(
         self, mock_retrieve_json, mock_copy_repl, mock_parse_trans, mock_time
     ):
@@ -187,7 +195,7 @@ class TestTransactionParser(unittest.TestCase):
             transaction_key,
         )
         mock_time = True
-        mock_retrieve_json.return_value = sql_json
+        mock_retrieve_json.return_value = sql_json["transactions"].values()
 
         parser = TransactionsParser(config, replay_id)
         queries = Query(start_time, end_time, q["text"])
@@ -214,11 +222,10 @@ class TestTransactionParser(unittest.TestCase):
             [],
         )
 
-    @patch("core.replay.transactions_parser.matches_filters", mock_filters)
-    @patch.object(Transaction, "start_time")
+    @patch.object(Transaction, "start_us")
     @patch.object(TransactionsParser, "parse_transaction")
     @patch("core.replay.transactions_parser.parse_copy_replacements")
-    @patch("core.replay.transactions_parser.retrieve_compressed_json")
+    @patch("core.replay.transactions_parser.iter_compressed_transactions")
     def test_parse_transactions_start_time_false(
         self, mock_retrieve_json, mock_copy_repl, mock_parse_trans, mock_time
     ):
@@ -245,7 +252,7 @@ class TestTransactionParser(unittest.TestCase):
             queries,
             transaction_key,
         )
-        mock_retrieve_json.return_value = sql_json
+        mock_retrieve_json.return_value = sql_json["transactions"].values()
 
         parser = TransactionsParser(config, replay_id)
         queries = Query(start_time, end_time, q["text"])
@@ -296,8 +303,8 @@ class TestTransactionParser(unittest.TestCase):
         parser.parse_transaction(transaction_dict, None)
 
         mock_Query.assert_called_once_with(
-            datetime.datetime(2022, 12, 27, 17, 0, tzinfo=tzutc()),
-            datetime.datetime(2022, 12, 27, 17, 1, tzinfo=tzutc()),
+            datetime_to_us(datetime.datetime(2022, 12, 27, 17, 0, tzinfo=tzutc())),
+            datetime_to_us(datetime.datetime(2022, 12, 27, 17, 1, tzinfo=tzutc())),
             "COPY  /* 0001_01_call_center_copy.sql.0 !CF:IR-fb3d5188-8604-11ed-b844-022e2270cad7.load-tables.load-tables.s0001.f0001.1.1:CF! */public.call_center \n            FROM 's3://location/call_center/'\n                credentials '' \n                region 'us-east-1' \n                gzip delimiter '|';",
         )
 
@@ -704,3 +711,282 @@ class TestTransactionParser(unittest.TestCase):
             text,
             "COPY  /* 0001_01_call_center_copy.sql.0 !CF:IR-fb3d5188-8604-11ed-b844-022e2270cad7.load-tables.load-tables.s0001.f0001.1.1:CF! */public.call_center \n            FROM 's3://test-location'\n                 IAM_ROLE 'This_is_a_test_role' \n                region 'us-east-1' \n                gzip delimiter '|';",
         )
+
+
+class TestTimestamps(unittest.TestCase):
+    def test_epoch_microseconds_match_iso_timestamps(self):
+        def get_transaction_dict(record_time, start_time):
+            return {
+                "xid": "1519323",
+                "pid": "1073750303",
+                "db": "dev",
+                "user": "awsuser",
+                "time_interval": True,
+                "queries": [
+                    {
+                        "record_time": record_time,
+                        "start_time": start_time,
+                        "end_time": None,
+                        "text": "select 1;",
+                    }
+                ],
+            }
+
+        parser = TransactionsParser(config, replay_id)
+        from_iso = parser.parse_transaction(
+            get_transaction_dict("2022-12-27T16:43:34+00:00", "2022-12-27T16:43:30.5+00:00"), None
+        )
+        from_us = parser.parse_transaction(
+            get_transaction_dict(1672159414000000, 1672159410500000), None
+        )
+        for transaction in (from_iso, from_us):
+            query = transaction.queries[0]
+            self.assertEqual((query.start_us, query.end_us), (1672159410500000, 1672159414000000))
+            self.assertEqual(transaction.start_us(), 1672159410500000)
+        self.assertEqual(
+            from_us.start_time(),
+            datetime.datetime(2022, 12, 27, 16, 43, 30, 500000, tzinfo=datetime.timezone.utc),
+        )
+
+
+class TestCompileQuery(unittest.TestCase):
+    def test_parse_transaction_compiles_queries(self):
+        transaction_dict = {
+            "xid": "1519323",
+            "pid": "1073750303",
+            "db": "tpcds_1g",
+            "user": "rsperf",
+            "time_interval": True,
+            "queries": [
+                {
+                    "record_time": "2022-12-27T16:43:34+00:00",
+                    "start_time": None,
+                    "end_time": None,
+                    "text": "select 1; select 2;",
+                },
+                {
+                    "record_time": "2022-12-27T16:43:35+00:00",
+                    "start_time": None,
+                    "end_time": None,
+                    "text": "unload ('select 1') to 's3://bucket/prefix';",
+                },
+            ],
+        }
+        parser = TransactionsParser(
+            dict(config, split_multi=True, execute_unload_statements="false"), replay_id
+        )
+        transaction = parser.parse_transaction(transaction_dict, None)
+
+        first, second = [query.plan for query in transaction.queries]
+        self.assertTrue(first.split)
+        self.assertEqual(first.statements, [("select 1;", True), ("select 2;", True)])
+        self.assertEqual(
+            second.statements, [("unload ('select 1') to 's3://bucket/prefix';", False)]
+        )
+        self.assertIn('"query_idx": 1,', second.tag_prefix)
+
+    def test_repeated_queries_share_text_and_statements(self):
+        def get_transaction_dict(xid):
+            return {
+                "xid": xid,
+                "pid": "1073750303",
+                "db": "tpcds_1g",
+                "user": "rsperf",
+                "time_interval": True,
+                "queries": [
+                    {
+                        "record_time": "2022-12-27T16:43:34+00:00",
+                        "start_time": None,
+                        "end_time": None,
+                        # a new str object for every transaction, as json decoding gives
+                        "text": "".join(["select 1; ", "select 2;"]),
+                    }
+                ],
+            }
+
+        parser = TransactionsParser(dict(config, split_multi=True), replay_id)
+        first = parser.parse_transaction(get_transaction_dict("1"), None).queries[0]
+        second = parser.parse_transaction(get_transaction_dict("2"), None).queries[0]
+        self.assertIs(first.text, second.text)
+        self.assertIs(first.plan.statements, second.plan.statements)
+        self.assertNotEqual(first.plan.tag_prefix, second.plan.tag_prefix)
+        self.assertFalse(hasattr(first, "__dict__"))
+
+    def test_tagged_matches_json_tags(self):
+        replay_start = datetime.datetime(
+            2023, 2, 1, 10, 0, tzinfo=datetime.timezone.utc
+        ).isoformat()
+        plan = compile_query("select 1;", "1519323", 3, {"split_multi": False})
+        self.assertFalse(plan.split)
+
+        json_tags = {
+            "xid": "1519323",
+            "query_idx": 3,
+            "replay_start": replay_start,
+            "source": "Test-Drive",
+        }
+        self.assertEqual(
+            plan.tagged("select 1;", json.dumps(replay_start)),
+            "/* {} */ {}".format(json.dumps(json_tags), "select 1;"),
+        )
+
+    def test_should_execute_statement(self):
+        copy_config = {"execute_copy_statements": "true", "replay_output": None}
+        self.assertTrue(should_execute_statement("select 1", {}))
+        self.assertFalse(should_execute_statement(None, {}))
+        self.assertFalse(should_execute_statement("copy t from 's3://bucket'", {}))
+        self.assertTrue(should_execute_statement("COPY t FROM 's3://bucket'", copy_config))
+        self.assertFalse(should_execute_statement("unload ('x') to 's3://bucket'", copy_config))
+
+
+class TestParseInProcesses(unittest.TestCase):
+    def get_transaction_dicts(self):
+        # out of order, with duplicate start times, so the merge must break ties by xid
+        return [
+            {
+                "xid": str(xid),
+                "pid": str(1000 + xid % 3),
+                "db": "dev",
+                "user": "awsuser",
+                "time_interval": True,
+                "queries": [
+                    {
+                        "record_time": f"2023-01-09T15:{minute:02d}:15+00:00",
+                        "start_time": None,
+                        "end_time": None,
+                        "text": f"select {xid % 2}; select 2;",
+                    }
+                ],
+            }
+            for xid, minute in enumerate([30, 10, 20, 10, 50, 40, 10, 5, 20])
+        ]
+
+    @patch("core.replay.transactions_parser.PARSE_CHUNK_SIZE", 2)
+    @patch("core.replay.transactions_parser.iter_compressed_transactions")
+    def test_same_order_as_one_process(self, patched_iter_compressed_transactions):
+        results = []
+        for processes in (1, 3):
+            patched_iter_compressed_transactions.return_value = self.get_transaction_dicts()
+            parser = TransactionsParser(dict(config, parse_processes=processes), replay_id)
+            results.append(parser.parse_transactions())
+        serial, parallel = results
+        self.assertEqual(
+            [(t.xid, t.start_us(), t.pid) for t in parallel],
+            [(t.xid, t.start_us(), t.pid) for t in serial],
+        )
+        self.assertEqual([t.xid for t in parallel][:3], ["7", "1", "3"])
+        self.assertEqual(
+            [q.plan.statements for t in parallel for q in t.queries],
+            [q.plan.statements for t in serial for q in t.queries],
+        )
+        # texts parsed in different processes are shared again
+        texts = {id(q.text) for t in parallel for q in t.queries}
+        self.assertEqual(len(texts), 2)
+
+    @patch("core.replay.transactions_parser.multiprocessing.Pool")
+    @patch("core.replay.transactions_parser.iter_compressed_transactions")
+    def test_one_process_by_default(self, patched_iter_compressed_transactions, patched_pool):
+        patched_iter_compressed_transactions.return_value = self.get_transaction_dicts() * 2
+        with patch("core.replay.transactions_parser.PARSE_CHUNK_SIZE", 2):
+            parser = TransactionsParser(dict(config, parse_processes=None), replay_id)
+            self.assertEqual(len(parser.parse_transactions()), 18)
+        patched_pool.assert_not_called()
+
+    @patch("core.replay.transactions_parser.multiprocessing.Pool")
+    @patch("core.replay.transactions_parser.iter_compressed_transactions")
+    def test_single_chunk_parsed_in_process(
+        self, patched_iter_compressed_transactions, patched_pool
+    ):
+        patched_iter_compressed_transactions.return_value = self.get_transaction_dicts()
+        parser = TransactionsParser(dict(config, parse_processes=4), replay_id)
+        self.assertEqual(len(parser.parse_transactions()), 9)
+        patched_pool.assert_not_called()
+
+
+class TestFilterPushdown(unittest.TestCase):
+    @patch("core.replay.transactions_parser.iter_compressed_transactions")
+    def test_filtered_transactions_are_not_parsed(self, patched_iter_compressed_transactions):
+        transaction_dicts = [
+            dict(
+                transaction_dict,
+                xid=str(xid),
+                db=db,
+                queries=[dict(transaction_dict["queries"][0], record_time=record_time)],
+            )
+            for xid, db, record_time in [
+                (1, "dev", "2023-01-09T15:48:15+00:00"),
+                (2, "other", "2023-01-09T15:48:15+00:00"),
+                (3, "dev", "2023-01-09T16:48:15+00:00"),
+            ]
+        ]
+        patched_iter_compressed_transactions.return_value = transaction_dicts
+        filters = {
+            "include": dict(config["filters"]["include"], database_name=["dev"]),
+            "exclude": config["filters"]["exclude"],
+            "end_time": "2023-01-09T16:00:00+00:00",
+        }
+        parser = TransactionsParser(dict(config, filters=filters, parse_processes=1), replay_id)
+        with patch.object(
+            TransactionsParser, "parse_transaction", wraps=parser.parse_transaction
+        ) as patched_parse_transaction:
+            transactions = parser.parse_transactions()
+        self.assertEqual([t.xid for t in transactions], ["1"])
+        patched_parse_transaction.assert_called_once()
+
+
+class TestIterCompressedTransactions(unittest.TestCase):
+    def setUp(self):
+        self.workload = {
+            "transactions": {
+                str(xid): {
+                    "xid": str(xid),
+                    "pid": "1073815778",
+                    "db": "dev",
+                    "user": "awsuser",
+                    "time_interval": True,
+                    "queries": [
+                        {
+                            "record_time": "2023-01-09T15:48:15+00:00",
+                            "start_time": None,
+                            "end_time": None,
+                            "text": f"select {xid} as \"n\u00e4me\", '{{}}' from t; "
+                            f"-- {xid * 1.5}",
+                        }
+                    ],
+                }
+                for xid in range(100, 150)
+            }
+        }
+        handle, self.path = tempfile.mkstemp(suffix=".json.gz")
+        with os.fdopen(handle, "wb") as f:
+            f.write(gzip.compress(json.dumps(self.workload, indent=2).encode("utf-8")))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_matches_json_loads(self):
+        self.assertEqual(
+            list(iter_compressed_transactions(self.path)),
+            list(self.workload["transactions"].values()),
+        )
+
+    def test_values_split_across_chunks(self):
+        for chunk_size in (1, 7, 64):
+            self.assertEqual(
+                list(iter_compressed_transactions(self.path, chunk_size)),
+                list(self.workload["transactions"].values()),
+            )
+
+    def test_other_keys_and_empty_transactions(self):
+        reader = JsonStreamReader(io.StringIO('{"version": [1, 2.5e3], "transactions": {}}'), 3)
+        members = {}
+        for key in reader.keys():
+            members[key] = reader.value() if key == "version" else list(reader.keys())
+        self.assertEqual(members, {"version": [1, 2500.0], "transactions": []})
+
+    def test_malformed_stream(self):
+        reader = JsonStreamReader(io.StringIO('{"transactions": {"1": {"xid": '), 4)
+        with self.assertRaises(ValueError):
+            for _ in reader.keys():
+                for _ in reader.keys():
+                    reader.value()
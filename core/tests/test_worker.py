@@ -1,3 +1,5 @@
+import itertools
+import threading
 import unittest
 from unittest.mock import patch, MagicMock
 from core.replay.worker import ReplayWorker
@@ -5,9 +7,14 @@ import datetime
 import logging
 from core.replay.transactions_parser import Transaction, Query
 from core.replay.connections_parser import ConnectionLog
+from core.replay.scheduler import ReplayClock
 from dateutil.tz import tzutc
 from queue import Empty
-from core.replay.stats import init_stats
+from core.replay.stats import (
+    CONNECTION_LATENESS_HISTOGRAM,
+    QUERY_LATENESS_HISTOGRAM,
+    init_stats,
+)
 
 
 num_connections = MagicMock()
@@ -84,8 +91,8 @@ connection = ConnectionLog(
 
 class TestWorker(unittest.TestCase):
     @patch("core.replay.worker.threading")
-    @patch.object(ConnectionLog, "offset_ms")
-    @patch("core.replay.worker.datetime")
+    @patch.object(ReplayClock, "deadline_ns")
+    @patch.object(ReplayClock, "elapsed_ns", lambda self: 2_000_000_000)
     @patch("core.replay.worker.init_stats")
     @patch("core.replay.worker.ConnectionThread")
     @patch.object(ReplayWorker, "join_finished_threads")
@@ -98,8 +105,7 @@ class TestWorker(unittest.TestCase):
         mock_finished_thread,
         mock_conn_thread,
         mock_init_stats,
-        mock_datetime,
-        mock_offset_log,
+        mock_deadline_ns,
         mock_thread,
     ):
         mock_queue = MagicMock()
@@ -109,7 +115,6 @@ class TestWorker(unittest.TestCase):
         mock_finished_thread.return_value = True
         mock_conn_thread.start.return_value = True
         mock_init_stats.return_value = True
-        mock_datetime.datetime.now.return_value = datetime.datetime(2023, 1, 1, 0, 0, 2)
         mock_thread.current_thread.name.return_value = "0"
         mock_thread.Lock.return_value = True
         mock_thread.enumerate.return_value = [1, 1, 1]
@@ -119,7 +124,7 @@ class TestWorker(unittest.TestCase):
 
         mock_queue.get.side_effect = [{"job_id": 0, "connection": connection}, False]
         replay_start_time = datetime.datetime(2023, 1, 1, 0, 0, 0)
-        mock_offset_log.return_value = 3000
+        mock_deadline_ns.return_value = 3_000_000_000
 
         worker = ReplayWorker(
             process_idx,
@@ -139,10 +144,12 @@ class TestWorker(unittest.TestCase):
         worker.replay()
 
         mock_log.debug.assert_any_call(
-            "Got job 1, delay +1.000 sec (extracted connection time: 1000)"
+            "Got job 1, delay +1.000 sec (extracted connection time: "
+            "1970-01-01 00:00:00.001000+00:00)"
         )
         mock_log.debug.assert_any_call(
-            "Starting job 1 (extracted connection time: 1000). 3, 1 connections active."
+            "Starting job 1 (extracted connection time: 1970-01-01 00:00:00.001000+00:00). 3, 1 "
+            "connections active."
         )
         mock_log.debug.assert_any_call("Got termination signal, finishing up.")
         mock_log.debug.assert_any_call("Waiting for 1 connections to finish...")
@@ -196,8 +203,8 @@ class TestWorker(unittest.TestCase):
 
     @patch("core.replay.worker.time")
     @patch("core.replay.worker.threading")
-    @patch.object(ConnectionLog, "offset_ms")
-    @patch("core.replay.worker.datetime")
+    @patch.object(ReplayClock, "deadline_ns")
+    @patch.object(ReplayClock, "elapsed_ns", lambda self: 2_000_000_000)
     @patch("core.replay.worker.init_stats")
     @patch("core.replay.worker.ConnectionThread")
     @patch.object(ReplayWorker, "join_finished_threads")
@@ -210,8 +217,7 @@ class TestWorker(unittest.TestCase):
         mock_finished_thread,
         mock_conn_thread,
         mock_init_stats,
-        mock_datetime,
-        mock_offset_log,
+        mock_deadline_ns,
         mock_thread,
         mock_time,
     ):
@@ -223,7 +229,6 @@ class TestWorker(unittest.TestCase):
         mock_finished_thread.return_value = True
         mock_conn_thread.start.return_value = True
         mock_init_stats.return_value = True
-        mock_datetime.datetime.now.return_value = datetime.datetime(2023, 1, 1, 0, 0, 2)
         mock_thread.current_thread.name.return_value = "0"
         mock_thread.Lock.return_value = True
         mock_thread.enumerate.return_value = [1, 1, 1]
@@ -233,7 +238,7 @@ class TestWorker(unittest.TestCase):
         connection.transactions = transaction
         mock_queue.get.side_effect = [{"job_id": 0, "connection": connection}, False]
         replay_start_time = datetime.datetime(2023, 1, 1, 0, 0, 0)
-        mock_offset_log.return_value = 3000
+        mock_deadline_ns.return_value = 3_000_000_000
 
         worker = ReplayWorker(
             process_idx,
@@ -259,8 +264,8 @@ class TestWorker(unittest.TestCase):
 
     @patch("core.replay.worker.time")
     @patch("core.replay.worker.threading")
-    @patch.object(ConnectionLog, "offset_ms")
-    @patch("core.replay.worker.datetime")
+    @patch.object(ReplayClock, "deadline_ns")
+    @patch.object(ReplayClock, "elapsed_ns", lambda self: 2_000_000_000)
     @patch("core.replay.worker.init_stats")
     @patch("core.replay.worker.ConnectionThread")
     @patch.object(ReplayWorker, "join_finished_threads")
@@ -273,8 +278,7 @@ class TestWorker(unittest.TestCase):
         mock_finished_thread,
         mock_conn_thread,
         mock_init_stats,
-        mock_datetime,
-        mock_offset_log,
+        mock_deadline_ns,
         mock_thread,
         mock_time,
     ):
@@ -285,7 +289,6 @@ class TestWorker(unittest.TestCase):
         mock_finished_thread.return_value = True
         mock_conn_thread.start.return_value = True
         mock_init_stats.return_value = True
-        mock_datetime.datetime.now.return_value = datetime.datetime(2023, 1, 1, 0, 0, 2)
         mock_thread.current_thread.name.return_value = "0"
         mock_thread.Lock.return_value = True
         mock_thread.enumerate.return_value = [1, 1, 1]
@@ -296,7 +299,7 @@ class TestWorker(unittest.TestCase):
 
         mock_queue.get.side_effect = [Empty, Empty, False]
         replay_start_time = datetime.datetime(2023, 1, 1, 0, 0, 0)
-        mock_offset_log.return_value = 3000
+        mock_deadline_ns.return_value = 3_000_000_000
 
         worker = ReplayWorker(
             process_idx,
@@ -318,9 +321,71 @@ class TestWorker(unittest.TestCase):
         mock_log.debug.assert_any_call("No jobs for 10 seconds (timeout 120)")
         mock_log.warning.assert_any_call("Queue empty for 210 sec, exiting")
 
+    @patch("core.replay.worker.time")
+    def test_next_job_waits_while_jobs_pending(self, mock_time):
+        mock_queue = MagicMock()
+        mock_queue.get.side_effect = [Empty] * 50 + [False]
+        mock_time.time.side_effect = itertools.count(100, 100)
+        jobs_pending = threading.Event()
+        jobs_pending.set()
+
+        worker = ReplayWorker(
+            process_idx,
+            datetime.datetime(2023, 1, 1, 0, 0, 0),
+            first_event_time,
+            mock_queue,
+            worker_stats,
+            None,
+            num_connections,
+            peak_connections,
+            config,
+            total_connections,
+            error_logger,
+            replay_id,
+            jobs_pending=jobs_pending,
+        )
+        # the queue stays empty far longer than empty_queue_timeout_sec
+        self.assertIs(worker.next_job(), False)
+
+        # once the feeder is done, an empty queue times out again
+        jobs_pending.clear()
+        mock_queue.get.side_effect = [Empty] * 50
+        self.assertIsNone(worker.next_job())
+
+    @patch("core.replay.worker.time")
+    def test_next_job_waits_while_throttled(self, mock_time):
+        mock_queue = MagicMock()
+        mock_queue.get.return_value = False
+        stats = {"throttled": 1}
+
+        def sleep(sec):
+            # the parent lets the worker take connections again after three polls
+            if mock_time.sleep.call_count == 3:
+                stats["throttled"] = 0
+
+        mock_time.sleep.side_effect = sleep
+
+        worker = ReplayWorker(
+            process_idx,
+            datetime.datetime(2023, 1, 1, 0, 0, 0),
+            first_event_time,
+            mock_queue,
+            stats,
+            None,
+            num_connections,
+            peak_connections,
+            config,
+            total_connections,
+            error_logger,
+            replay_id,
+        )
+        self.assertIs(worker.next_job(), False)
+        self.assertEqual(mock_time.sleep.call_count, 3)
+        mock_queue.get.assert_called_once()
+
     @patch("core.replay.worker.threading")
-    @patch.object(ConnectionLog, "offset_ms")
-    @patch("core.replay.worker.datetime")
+    @patch.object(ReplayClock, "deadline_ns")
+    @patch.object(ReplayClock, "elapsed_ns", lambda self: 2_000_000_000)
     @patch("core.replay.worker.init_stats")
     @patch("core.replay.worker.ConnectionThread")
     @patch.object(ReplayWorker, "join_finished_threads")
@@ -333,8 +398,7 @@ class TestWorker(unittest.TestCase):
         mock_finished_thread,
         mock_conn_thread,
         mock_init_stats,
-        mock_datetime,
-        mock_offset_log,
+        mock_deadline_ns,
         mock_thread,
     ):
         mock_queue = MagicMock()
@@ -344,7 +408,6 @@ class TestWorker(unittest.TestCase):
         mock_finished_thread.return_value = True
         mock_conn_thread.start.return_value = True
         mock_init_stats.return_value = True
-        mock_datetime.datetime.now.return_value = datetime.datetime(2023, 1, 1, 0, 0, 2)
         mock_thread.current_thread.name.return_value = "0"
         mock_thread.Lock.return_value = True
         mock_thread.enumerate.return_value = [1, 1, 1]
@@ -354,7 +417,7 @@ class TestWorker(unittest.TestCase):
 
         mock_queue.get.side_effect = [{"job_id": 0, "connection": connection}, False]
         replay_start_time = datetime.datetime(2023, 1, 1, 0, 0, 0)
-        mock_offset_log.return_value = datetime.datetime(2023, 1, 1, 0, 2, 0)
+        mock_deadline_ns.side_effect = TypeError("unsupported operand type(s)")
 
         worker = ReplayWorker(
             process_idx,
@@ -376,6 +439,25 @@ class TestWorker(unittest.TestCase):
         mock_log.error.assert_called()
         mock_log.debug.assert_called()
 
+    def test_job_deadline_with_preconnect_lead(self):
+        worker = ReplayWorker(
+            process_idx,
+            replay_start_time,
+            first_event_time,
+            MagicMock(),
+            worker_stats,
+            connection_semaphore,
+            num_connections,
+            peak_connections,
+            dict(config, preconnect_lead_ms=250),
+            total_connections,
+            error_logger,
+            replay_id,
+        )
+        job = {"job_id": 0, "connection": connection}
+        with patch.object(ReplayClock, "deadline_ns", return_value=10_000_000_000):
+            self.assertEqual(worker.job_deadline_ns(job), 9_750_000_000)
+
     @patch("core.replay.worker.collect_stats")
     def test_join_finished_threads(self, mock_stats):
         mock_queue = MagicMock()
@@ -423,6 +505,25 @@ class TestWorker(unittest.TestCase):
                 "transaction_error_log": {},
                 "multi_statements": 0,
                 "executed_queries": 0,
+                "credential_cache_hits": 0,
+                "credential_cache_misses": 0,
+                "credential_fetches": 0,
+                "credential_fetch_sec": 0,
+                "late_connections": 0,
+                "late_queries": 0,
+                "query_lateness_sec": 0,
+                "max_query_lateness_sec": 0,
+                "connects": 0,
+                "connect_sec": 0,
+                "max_connect_sec": 0,
+                "pool_reuses": 0,
+                "pool_wait_sec": 0,
+                "max_pool_connections": 0,
+                "connection_lateness_sec": 0,
+                "max_connection_lateness_sec": 0,
+                **{slot: 0 for slot in QUERY_LATENESS_HISTOGRAM + CONNECTION_LATENESS_HISTOGRAM},
             },
+            # the worker stats are a dict, not shared, so nothing was added live
+            (),
         )
         self.assertEqual(length, 1)
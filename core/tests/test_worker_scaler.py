@@ -0,0 +1,108 @@
+import os
+import unittest
+
+from core.replay.stats import QUERY_LATENESS_HISTOGRAM, init_stats, record_lateness
+from core.replay.worker_scaler import WorkerScaler, process_cpu_sec
+
+
+def worker_row(jobs_started=0, dispatch_lag_sec=0, late_queries=(), active_connections=0):
+    stats = init_stats({})
+    stats["jobs_started"] = jobs_started
+    stats["dispatch_lag_sec"] = dispatch_lag_sec
+    stats["active_connections"] = active_connections
+    for lateness_sec in late_queries:
+        record_lateness(stats, QUERY_LATENESS_HISTOGRAM, lateness_sec)
+    return stats
+
+
+class TestWorkerScaler(unittest.TestCase):
+    def setUp(self):
+        self.scaler = WorkerScaler(max_workers=3, lag_threshold_sec=1, cpu_threshold=0.8)
+        # baseline of two idle workers
+        throttled, spawn = self.scaler.evaluate(
+            {0: worker_row(), 1: worker_row()}, {0: 0, 1: 0}, now=0
+        )
+        self.assertEqual((throttled, spawn), (set(), 0))
+
+    def test_from_config(self):
+        self.assertIsNone(WorkerScaler.from_config({}, 4))
+        scaler = WorkerScaler.from_config(
+            {"adaptive_workers": True, "max_workers": "8", "adaptive_interval_sec": 5}, 4
+        )
+        self.assertEqual(scaler.max_workers, 8)
+        self.assertEqual(scaler.interval_sec, 5)
+        self.assertEqual(scaler.lag_threshold_sec, 1)
+        self.assertTrue(scaler.due(0))
+
+    def test_steers_away_from_saturated_worker(self):
+        snapshot = {
+            0: worker_row(jobs_started=10, dispatch_lag_sec=3),
+            1: worker_row(jobs_started=2),
+        }
+        with self.assertLogs("WorkloadReplicatorLogger", level="INFO") as logs:
+            throttled, spawn = self.scaler.evaluate(snapshot, {0: 9.5, 1: 1}, now=10)
+        self.assertEqual((throttled, spawn), ({0}, 0))
+        self.assertIn("Worker 0 is behind", logs.output[0])
+
+        # the worker hasn't dispatched since it was throttled and is idle again
+        throttled, spawn = self.scaler.evaluate(snapshot, {0: 10, 1: 2}, now=20)
+        self.assertEqual((throttled, spawn), (set(), 0))
+
+    def test_throttled_worker_exits(self):
+        snapshot = {
+            0: worker_row(jobs_started=10, dispatch_lag_sec=3),
+            1: worker_row(jobs_started=2),
+        }
+        self.assertEqual(self.scaler.evaluate(snapshot, {0: 9.5, 1: 1}, now=10), ({0}, 0))
+        # worker 0 is gone from the workers still running
+        throttled, spawn = self.scaler.evaluate({1: worker_row(jobs_started=3)}, {1: 2}, now=20)
+        self.assertEqual((throttled, spawn), (set(), 0))
+
+    def test_lag_without_cpu_isnt_saturation(self):
+        # late, but the worker has cpu to spare, e.g. waiting on the cluster
+        snapshot = {
+            0: worker_row(jobs_started=10, dispatch_lag_sec=3),
+            1: worker_row(jobs_started=2),
+        }
+        self.assertEqual(self.scaler.evaluate(snapshot, {0: 2, 1: 1}, now=10), (set(), 0))
+
+    def test_adds_worker_when_all_busy(self):
+        snapshot = {
+            0: worker_row(jobs_started=10, late_queries=[5] * 10),
+            1: worker_row(jobs_started=10, dispatch_lag_sec=2),
+        }
+        with self.assertLogs("WorkloadReplicatorLogger", level="INFO") as logs:
+            throttled, spawn = self.scaler.evaluate(snapshot, {0: 9, 1: 9}, now=10)
+        # no worker has headroom to take the connections, and one more fits under max_workers
+        self.assertEqual((throttled, spawn), (set(), 1))
+        self.assertIn("adding 1 worker(s)", logs.output[0])
+
+        # the new worker has headroom, so the busy ones are steered around instead
+        snapshot = {
+            0: worker_row(jobs_started=20, late_queries=[5] * 20),
+            1: worker_row(jobs_started=20, dispatch_lag_sec=2),
+            2: worker_row(),
+        }
+        throttled, spawn = self.scaler.evaluate(snapshot, {0: 18, 1: 18, 2: 0.5}, now=20)
+        self.assertEqual((throttled, spawn), ({0, 1}, 0))
+
+    def test_max_workers(self):
+        scaler = WorkerScaler(max_workers=2)
+        scaler.evaluate({0: worker_row(), 1: worker_row()}, {}, now=0)
+        snapshot = {
+            0: worker_row(jobs_started=1, dispatch_lag_sec=5),
+            1: worker_row(jobs_started=1, dispatch_lag_sec=5),
+        }
+        # without cpu times, lag alone decides
+        self.assertEqual(scaler.evaluate(snapshot, {}, now=10), (set(), 0))
+
+    def test_release(self):
+        self.scaler.throttled = {1}
+        self.scaler.release()
+        self.assertEqual(self.scaler.throttled, set())
+
+    def test_process_cpu_sec(self):
+        cpu_sec = process_cpu_sec(os.getpid())
+        if os.path.exists("/proc"):
+            self.assertGreater(cpu_sec, 0)
+        self.assertIsNone(process_cpu_sec(-1))
@@ -0,0 +1,196 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from core.replay.connections_parser import parse_connections
+from core.replay.prep_cache import file_digest
+from core.replay.transactions_parser import TransactionsParser
+from core.replay.workload_store import (
+    STORE_FILENAME,
+    WorkloadStore,
+    convert_workload,
+    filter_clause,
+)
+
+all_filters = {
+    "include": {"database_name": ["*"], "username": ["*"], "pid": ["*"]},
+    "exclude": {"database_name": [], "username": [], "pid": []},
+}
+
+config = {
+    "workload_location": "",
+    "filters": all_filters,
+    "execute_copy_statements": "false",
+    "execute_unload_statements": "false",
+    "replay_output": None,
+    "split_multi": True,
+}
+
+
+def get_connection_json(username, pid, start):
+    return {
+        "session_initiation_time": f"2023-01-09 15:{start}:00+00:00",
+        "disconnection_time": "2023-01-09 15:59:00+00:00",
+        "application_name": "",
+        "database_name": "dev",
+        "username": username,
+        "pid": pid,
+        "time_interval_between_transactions": True,
+        "time_interval_between_queries": "all on",
+    }
+
+
+def get_transaction_json(username, pid, xid, start):
+    return {
+        "xid": xid,
+        "pid": pid,
+        "db": "dev",
+        "user": username,
+        "time_interval": True,
+        "queries": [
+            {
+                "record_time": f"2023-01-09T15:{start}:05+00:00",
+                "start_time": f"2023-01-09T15:{start}:01+00:00",
+                "end_time": None,
+                "text": f"select {xid};",
+            },
+            {
+                "record_time": f"2023-01-09T15:{start}:02+00:00",
+                "start_time": None,
+                "end_time": None,
+                "text": "select 'second';",
+            },
+        ],
+    }
+
+
+class TestWorkloadStore(unittest.TestCase):
+    def setUp(self):
+        self.workload_location = tempfile.mkdtemp()
+        self.connections_json = [
+            get_connection_json("analyst", "100", "10"),
+            get_connection_json("etl", "200", "05"),
+        ]
+        self.transactions_json = {
+            "31": get_transaction_json("analyst", "100", "31", "30"),
+            "12": get_transaction_json("etl", "200", "12", "20"),
+            "11": get_transaction_json("analyst", "100", "11", "20"),
+        }
+        with open(f"{self.workload_location}/connections.json", "w") as f:
+            f.write(json.dumps(self.connections_json, indent=4))
+        with gzip.open(f"{self.workload_location}/SQLs.json.gz", "wb") as f:
+            f.write(json.dumps({"transactions": self.transactions_json}).encode("utf-8"))
+        convert_workload(self.workload_location)
+        self.store = WorkloadStore.open(self.workload_location)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.workload_location)
+
+    def test_open_without_store(self):
+        os.remove(f"{self.workload_location}/{STORE_FILENAME}")
+        self.assertIsNone(WorkloadStore.open(self.workload_location))
+
+    def test_ignores_stale_store(self):
+        self.assertEqual(set(self.store.digests()), {"SQLs.json.gz", "connections.json"})
+        # extracted again without saving a store
+        with open(f"{self.workload_location}/connections.json", "w") as f:
+            f.write(json.dumps(self.connections_json[:1], indent=4))
+        with self.assertLogs("WorkloadReplicatorLogger", level="WARNING"):
+            self.assertIsNone(WorkloadStore.open(self.workload_location))
+
+    def test_unchanged_files_are_not_hashed(self):
+        self.store.close()
+        with patch("core.replay.workload_store.file_digest") as mock_digest:
+            self.store = WorkloadStore.open(self.workload_location)
+        self.assertIsNotNone(self.store)
+        mock_digest.assert_not_called()
+
+    def test_touched_files_are_hashed_once(self):
+        self.store.close()
+        os.utime(f"{self.workload_location}/SQLs.json.gz", ns=(0, 0))
+        with patch("core.replay.workload_store.file_digest", wraps=file_digest) as mock_digest:
+            self.store = WorkloadStore.open(self.workload_location)
+            self.assertIsNotNone(self.store)
+            self.assertEqual(mock_digest.call_count, 2)
+            # the new modification time was saved
+            self.store.close()
+            self.store = WorkloadStore.open(self.workload_location)
+            self.assertEqual(mock_digest.call_count, 2)
+
+    def test_filter_clause(self):
+        self.assertEqual(filter_clause(all_filters), ("1", []))
+        filters = {
+            "include": {"database_name": ["*"], "username": ["etl", "bi"], "pid": ["*"]},
+            "exclude": {"database_name": ["tmp"], "username": [], "pid": []},
+        }
+        self.assertEqual(
+            filter_clause(filters),
+            ("database_name NOT IN (?) AND username IN (?, ?)", ["tmp", "etl", "bi"]),
+        )
+
+    def test_filter_clause_patterns_and_time_window(self):
+        filters = {
+            "include": {"database_name": ["*"], "username": ["etl_*"], "pid": ["*"]},
+            "exclude": {"database_name": ["tmp", "re:scratch_.*"], "username": [], "pid": []},
+            "start_time": 1000,
+            "end_time": 2000,
+        }
+        self.assertEqual(
+            filter_clause(filters),
+            (
+                "database_name NOT IN (?) AND start_us < ? AND start_us >= ?",
+                ["tmp", 2000, 1000],
+            ),
+        )
+        # connections that started before the window may still be open in it
+        self.assertEqual(
+            filter_clause(filters, "connections"),
+            ("database_name NOT IN (?) AND start_us < ?", ["tmp", 2000]),
+        )
+
+    def test_connections_round_trip(self):
+        self.assertEqual(list(self.store.connections()), self.connections_json)
+        self.assertEqual(self.store.count_connections(), 2)
+
+    def test_transactions_in_start_order(self):
+        self.assertEqual(
+            list(self.store.transactions()),
+            [self.transactions_json[xid] for xid in ("11", "12", "31")],
+        )
+
+    def test_filters_pushed_down(self):
+        filters = {
+            "include": {"database_name": ["*"], "username": ["etl"], "pid": ["*"]},
+            "exclude": {"database_name": [], "username": [], "pid": []},
+        }
+        self.assertEqual([t["xid"] for t in self.store.transactions(filters)], ["12"])
+        connections, total_connections = parse_connections(
+            self.workload_location, "", "", filters, self.store
+        )
+        self.assertEqual([c.username for c in connections], ["etl"])
+        self.assertEqual(total_connections, 2)
+
+    def test_connection_transactions(self):
+        self.assertEqual(
+            [t["xid"] for t in self.store.connection_transactions("dev_analyst_100")],
+            ["11", "31"],
+        )
+
+    def test_parse_transactions_from_store(self):
+        parser = TransactionsParser(
+            dict(config, workload_location=self.workload_location), "replay", self.store
+        )
+        from_store = parser.parse_transactions()
+        parser.store = None
+        from_json = parser.parse_transactions()
+
+        self.assertEqual([t.xid for t in from_store], ["11", "12", "31"])
+        self.assertEqual(
+            [[(q.start_time, q.text) for q in t.queries] for t in from_store],
+            [[(q.start_time, q.text) for q in t.queries] for t in from_json],
+        )